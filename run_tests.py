@@ -1,10 +1,22 @@
 #!/usr/bin/env python
+import asyncio
+import csv
+from datetime import datetime, timedelta
+import hashlib
 import tempfile
 import os
+from os.path import join
+import re
 import shutil
+import socket
+import threading
+import time
 import unittest
-from io import BytesIO
+from io import BytesIO, StringIO
 
+import openpyxl
+import premailer
+import sqlalchemy
 from werkzeug.datastructures import MultiDict
 
 import talky
@@ -22,8 +34,14 @@ class TalkyBaseTestCase(unittest.TestCase):
         talky.app.config['FILE_PATH'] = tempfile.mkdtemp()
         # Prepare the test client
         self.client = talky.app.test_client()
-        # Prevent sending email
+        # Prevent sending email, the outbox is only sent by calling outbox.drain
         talky.mail.send = lambda msg: print(f'Skipped sending {msg}')
+        talky.app.extensions['mail'].suppress = True
+        talky.app.config['MAIL_WORKERS'] = 0
+        # Handle events before commit returns so the queued emails can be checked
+        talky.app.config['EVENT_WORKERS'] = 0
+        # There is no hub to push live events to unless a test starts one
+        talky.app.config['LIVE_EVENTS'] = None
         # Fill the dummy database
         with talky.app.app_context():
             from talky import create_database
@@ -32,6 +50,10 @@ class TalkyBaseTestCase(unittest.TestCase):
     def tearDown(self):
         os.close(self.db_fd)
         os.unlink(talky.app.config['DATABASE_FILE'])
+        # Remove the write-ahead log if it is present
+        for suffix in ['-wal', '-shm']:
+            if os.path.isfile(talky.app.config['DATABASE_FILE'] + suffix):
+                os.unlink(talky.app.config['DATABASE_FILE'] + suffix)
         shutil.rmtree(talky.app.config['FILE_PATH'])
 
     def login(self, username, password):
@@ -58,6 +80,440 @@ class TalkyBaseTestCase(unittest.TestCase):
                          min_submissions, min_comments)
 
 
+class TalkyDatabaseTestCase(TalkyBaseTestCase):
+    def query_plan(self, query):
+        compiled = query.statement.compile(dialect=talky.db.engine.dialect)
+        params = [compiled.params[k] for k in compiled.positiontup]
+        cursor = talky.db.session.connection().connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + str(compiled), params)
+        return [row[-1] for row in cursor.fetchall()]
+
+    def test_query_plans(self):
+        talk = self.get_talk(min_submissions=1, min_comments=1)
+        schema = talky.schema
+        with talky.app.app_context():
+            queries = [
+                schema.Comment.query.filter(schema.Comment.talk_id == talk.id).order_by(schema.Comment.time),
+                schema.Submission.query.filter(schema.Submission.talk_id == talk.id),
+                schema.Submission.query.filter(schema.Submission.talk_id == talk.id,
+                                               schema.Submission.version == 1),
+                schema.Experiment.query.join(schema.Experiment.interesting_talks).filter(
+                    schema.Talk.id == talk.id),
+                schema.Talk.query.join(schema.Talk.interesting_to).filter(schema.Experiment.name == 'LHCb'),
+                schema.Category.query.join(schema.Category.talks).filter(schema.Talk.id == talk.id),
+            ]
+            for query in queries:
+                plan = self.query_plan(query)
+                assert not any(detail.startswith('SCAN') for detail in plan), plan
+
+    def check_talk_counters(self):
+        with talky.app.app_context():
+            for talk in talky.schema.Talk.query.all():
+                submissions = sorted(talk.submissions, key=lambda s: s.time)
+                times = [c.time for c in talk.comments] + [s.time for s in submissions]
+                assert talk.comment_count == len(talk.comments)
+                assert talk.latest_submission_id == (submissions[-1].id if submissions else None)
+                assert talk.last_activity == (max(times) if times else None)
+
+    def test_talk_counters(self):
+        self.check_talk_counters()
+
+        talk = self.get_talk(experiment='LHCb', min_submissions=1, min_comments=1)
+        rv = self.client.post(
+            f'/view/{talk.id}/{talk.view_key}/comment/',
+            data=dict(parent_comment_id='None', name='Name', email='first.last@domain.org', comment='Comment'),
+        )
+        assert rv.status == '302 FOUND'
+        with BytesIO(b'Example contents') as f:
+            rv = self.client.post(
+                f'/upload/{talk.id}/{talk.upload_key}/',
+                data=dict(file=(f, 'example.pdf')),
+            )
+        assert rv.status == '302 FOUND'
+        self.check_talk_counters()
+
+        with talky.app.app_context():
+            _talk = talky.schema.Talk.query.get(talk.id)
+            comment_id = _talk.comments[0].id
+            submission_id = _talk.latest_submission_id
+        self.login('userlhcb', 'user')
+        self.client.get(f'/view/{talk.id}/{talk.view_key}/comment/{comment_id}/delete/')
+        self.client.get(f'/view/{talk.id}/{talk.view_key}/submission/{submission_id}/delete/')
+        self.logout()
+        self.check_talk_counters()
+
+    def test_repair_counters(self):
+        from talky.upgrade_database import repair_counters
+        with talky.app.app_context():
+            talky.db.session.execute('UPDATE talk SET comment_count = 1000, latest_submission_id = NULL')
+            talky.db.session.commit()
+        repair_counters()
+        self.check_talk_counters()
+
+    def test_sqlite_pragmas(self):
+        with talky.app.app_context():
+            assert talky.db.session.execute('PRAGMA journal_mode').scalar() == 'wal'
+            assert talky.db.session.execute('PRAGMA busy_timeout').scalar() == \
+                talky.app.config['SQLITE_PRAGMAS']['busy_timeout']
+            assert talky.db.session.execute('PRAGMA synchronous').scalar() == 1
+
+    def test_read_only_session(self):
+        from talky import replica
+        talk = self.get_talk(min_submissions=1)
+        engines = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            engines.append(conn.engine)
+
+        talky.db.event.listen(sqlalchemy.engine.Engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            rv = self.client.get(f'/view/{talk.id}/{talk.view_key}/')
+            assert rv.status == '200 OK'
+            rv = self.client.get(f'/view/{talk.id}/{talk.view_key}/submission/v1/')
+            assert rv.status == '200 OK'
+            with talky.app.app_context():
+                read_only_engine = replica.get_engine()
+                primary_engine = talky.db.engine
+            assert engines and set(engines) == {read_only_engine}
+            # Connections are shared between the threads serving requests
+            assert isinstance(read_only_engine.pool, sqlalchemy.pool.QueuePool)
+
+            # Writes stay on the primary
+            engines.clear()
+            rv = self.client.post(
+                f'/view/{talk.id}/{talk.view_key}/comment/',
+                data=dict(parent_comment_id='None', name='Name', email='first.last@domain.org', comment='Comment'),
+            )
+            assert rv.status == '302 FOUND'
+            assert engines and set(engines) == {primary_engine}
+        finally:
+            talky.db.event.remove(sqlalchemy.engine.Engine, 'before_cursor_execute', before_cursor_execute)
+
+        with talky.app.app_context():
+            _talk = replica.session.query(talky.schema.Talk).get(talk.id)
+            _talk.title = 'Modified'
+            with self.assertRaises(RuntimeError):
+                replica.session.commit()
+            replica.session.rollback()
+            with self.assertRaises(sqlalchemy.exc.OperationalError):
+                replica.session.execute('DELETE FROM talk')
+
+        # Without a replica other databases use the primary engine
+        talky.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        try:
+            with talky.app.app_context():
+                assert replica.get_engine() is talky.db.engine
+        finally:
+            talky.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + talky.app.config['DATABASE_FILE']
+
+    def test_upgrade(self):
+        from talky.upgrade_database import upgrade_db
+        with talky.app.app_context():
+            # Recreate an association table as it was before primary keys were added
+            n_rows = talky.db.session.query(talky.schema.roles_users).count()
+            talky.db.session.execute('ALTER TABLE roles_users RENAME TO roles_users_tmp')
+            talky.db.session.execute('CREATE TABLE roles_users (user_id INTEGER, role_id INTEGER)')
+            talky.db.session.execute('INSERT INTO roles_users SELECT * FROM roles_users_tmp')
+            talky.db.session.execute('INSERT INTO roles_users SELECT * FROM roles_users_tmp')
+            talky.db.session.execute('DROP TABLE roles_users_tmp')
+            talky.db.session.execute('DROP INDEX ix_comment_talk_id_time')
+            talky.db.session.execute('DROP TABLE talk_search')
+            # Remove columns which were added after the first release
+            talky.db.session.execute('ALTER TABLE talk DROP COLUMN cache_version')
+            talky.db.session.execute('ALTER TABLE comment DROP COLUMN depth')
+            talky.db.session.commit()
+
+            upgrade_db()
+            upgrade_db()
+
+            inspector = talky.db.inspect(talky.db.engine)
+            assert inspector.get_pk_constraint('roles_users')['constrained_columns'] == ['user_id', 'role_id']
+            assert 'ix_comment_talk_id_time' in {i['name'] for i in inspector.get_indexes('comment')}
+            assert talky.db.session.query(talky.schema.roles_users).count() == n_rows
+            n_talks = talky.db.session.query(talky.schema.Talk).count()
+            assert talky.db.session.execute('SELECT count(*) FROM talk_search').scalar() == n_talks
+            # Existing rows are given the default values of the new columns
+            talk = talky.schema.Talk.query.first()
+            assert talky.db.session.query(talky.schema.Talk).filter_by(cache_version=None).count() == 0
+            for comment in talky.schema.Comment.query:
+                assert comment.depth == comment.path.count('/') - 1
+            assert talky.db.session.query(talky.schema.Comment).filter(talky.schema.Comment.depth > 0).count()
+            columns = {c['name']: c for c in inspector.get_columns('talk')}
+            assert not columns['cache_version']['nullable']
+
+        talky.page_cache.talk_pages.clear()
+        rv = self.client.get(f'/view/{talk.id}/{talk.view_key}/')
+        cursor = re.search(rb'data-cursor="([0-9.]+)"', rv.data).group(1).decode()
+        rv = self.client.get(f'/view/{talk.id}/{talk.view_key}/updates/', query_string=dict(since=cursor))
+        assert rv.status == '304 NOT MODIFIED'
+
+
+class TalkySearchTestCase(TalkyBaseTestCase):
+    def search(self, text):
+        rv = self.client.get('/secure/user/all', query_string=dict(search=text))
+        assert rv.status == '200 OK'
+        return rv.data
+
+    def test_search(self):
+        talk = self.get_talk(experiment='LHCb')
+        with talky.app.app_context():
+            _talk = talky.schema.Talk.query.get(talk.id)
+            _talk.title = 'Observation of a pentaquark'
+            _talk.abstract = 'Evidence for exotic hadrons'
+            talky.db.session.commit()
+            other_talk = talky.schema.Talk.query.filter(
+                talky.schema.Talk.experiment_id == _talk.experiment_id,
+                talky.schema.Talk.id != talk.id
+            ).first()
+            other_title = other_talk.title.encode('utf-8')
+
+        self.login('userlhcb', 'user')
+        assert b'Observation of a pentaquark' in self.search('pentaquark')
+        assert b'Observation of a pentaquark' in self.search('exotic hadr')
+        assert b'Observation of a pentaquark' not in self.search('pentaquark tetraquark')
+        assert other_title not in self.search('pentaquark')
+        # Punctuation alone shouldn't be passed to the full-text index
+        assert b'Observation of a pentaquark' in self.search('"*')
+
+        # Comments are searched too
+        rv = self.client.post(
+            f'/view/{other_talk.id}/{other_talk.view_key}/comment/',
+            data=dict(parent_comment_id='None', name='Name', email='first.last@domain.org',
+                      comment='What about the pentaquark?'),
+        )
+        assert rv.status == '302 FOUND'
+        data = self.search('pentaquark')
+        assert other_title in data
+        # Matches in the title are ranked higher than matches in comments
+        assert data.index(b'Observation of a pentaquark') < data.index(other_title)
+
+        with talky.app.app_context():
+            comment_id = talky.schema.Talk.query.get(other_talk.id).comments[-1].id
+        self.client.get(f'/view/{other_talk.id}/{other_talk.view_key}/comment/{comment_id}/delete/')
+        assert other_title not in self.search('pentaquark')
+
+    def test_rebuild_search(self):
+        from talky.search import rebuild_index
+        talk = self.get_talk()
+        with talky.app.app_context():
+            talky.db.session.execute('DROP TABLE talk_search')
+            talky.db.session.commit()
+        rebuild_index()
+
+        self.login('userlhcb', 'user')
+        assert talk.title.encode('utf-8') in self.search(talk.title)
+
+
+class TalkyListingTestCase(TalkyBaseTestCase):
+    def get_page(self, url):
+        rv = self.client.get(url)
+        assert rv.status == '200 OK'
+        data = rv.data.decode('utf-8')
+        talk_ids = [int(i) for i in re.findall(r'details/\?id=(\d+)', data)]
+        links = dict(re.findall(r'<a href="(/[^"]+)">(&lt;|&gt;)</a>', data))
+        links = {label: url.replace('&amp;', '&') for url, label in links.items()}
+        return data, talk_ids, links.get('&lt;'), links.get('&gt;')
+
+    def test_keyset_pagination(self):
+        with talky.app.app_context():
+            expected = [
+                talk.id for talk in talky.schema.Talk.query.join(talky.schema.Talk.conference).order_by(
+                    talky.schema.Conference.start_date.desc(), talky.schema.Talk.id.desc())
+            ]
+        self.login('userlhcb', 'user')
+
+        # Follow the next links to the end
+        pages = []
+        data, talk_ids, previous_url, next_url = self.get_page('/secure/user/all?page_size=3')
+        assert previous_url is None
+        pages.append(talk_ids)
+        while next_url:
+            assert 'after=' in next_url
+            data, talk_ids, previous_url, next_url = self.get_page(next_url)
+            assert previous_url is not None
+            pages.append(talk_ids)
+        assert sum(pages, []) == expected
+        assert all(len(talk_ids) == 3 for talk_ids in pages[:-1])
+
+        # Then follow the previous links back to the start
+        for talk_ids in pages[-2::-1]:
+            data, _talk_ids, previous_url, next_url = self.get_page(previous_url)
+            assert _talk_ids == talk_ids
+            assert next_url is not None
+        assert previous_url is None
+
+        # Sorting by date in ascending order is also paged with a cursor
+        data, talk_ids, previous_url, next_url = self.get_page('/secure/user/all?page_size=3&sort=0')
+        assert 'after=' in next_url
+        assert talk_ids == expected[::-1][:3]
+
+        rv = self.client.get('/secure/user/all?after=invalid')
+        assert rv.status == '400 BAD REQUEST'
+
+    def test_exact_count(self):
+        with talky.app.app_context():
+            n_talks = talky.schema.Talk.query.count()
+        self.login('userlhcb', 'user')
+        data, talk_ids, previous_url, next_url = self.get_page('/secure/user/all')
+        assert f'{n_talks} talks' not in data
+
+        talky.app.config['LISTING_EXACT_COUNT'] = True
+        try:
+            data, talk_ids, previous_url, next_url = self.get_page('/secure/user/all')
+        finally:
+            talky.app.config['LISTING_EXACT_COUNT'] = False
+        assert f'{n_talks} talks' in data
+
+    def get_count(self, url):
+        """Return the count shown on a list view and the number of count queries made"""
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        # Listen to every engine to include the read-only sessions
+        engine = sqlalchemy.engine.Engine
+        talky.db.event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            rv = self.client.get(url)
+        finally:
+            talky.db.event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+        assert rv.status == '200 OK'
+        count = int(re.search(r'List \((\d+)\)', rv.data.decode('utf-8')).group(1))
+        return count, sum('count(' in statement for statement in statements)
+
+    def add_contact(self):
+        with talky.app.app_context():
+            experiment = talky.schema.Experiment.query.filter_by(name='LHCb').one()
+            talky.db.session.add(talky.schema.Contact(email='new.contact@domain.org', experiment=experiment))
+            talky.db.session.commit()
+
+    def test_count_cache(self):
+        self.login('userlhcb', 'user')
+        count, n_count_queries = self.get_count('/secure/user/contact/')
+        assert n_count_queries == 1
+        assert self.get_count('/secure/user/contact/') == (count, 0)
+
+        # Modifying the database invalidates the cached counts
+        self.add_contact()
+        assert self.get_count('/secure/user/contact/') == (count + 1, 1)
+        assert self.get_count('/secure/user/contact/') == (count + 1, 0)
+        # Including when it is modified by another process as the counter is shared
+        with talky.app.app_context():
+            with talky.db.engine.begin() as connection:
+                connection.execute('UPDATE change_counter SET value = value + 1')
+        assert self.get_count('/secure/user/contact/') == (count + 1, 1)
+
+        # Approximate counts are reused until they time out
+        talky.app.config['APPROXIMATE_COUNTS'] = True
+        try:
+            self.add_contact()
+            assert self.get_count('/secure/user/contact/') == (count + 1, 0)
+        finally:
+            talky.app.config['APPROXIMATE_COUNTS'] = False
+        assert self.get_count('/secure/user/contact/') == (count + 2, 1)
+
+    def test_export(self):
+        with talky.app.app_context():
+            talks = talky.schema.Talk.query.join(talky.schema.Talk.conference).order_by(
+                talky.schema.Conference.start_date.desc(), talky.schema.Talk.id).all()
+            expected = [
+                [str(t.conference_date.date()), t.conference.name, t.title, t.experiment.name,
+                 ', '.join(sorted(e.name for e in t.interesting_to)), t.duration, t.speaker, t.abstract or '']
+                for t in talks
+            ]
+        self.login('userlhcb', 'user')
+
+        # Use several batches
+        batch_size = talky.app.config['EXPORT_BATCH_SIZE']
+        talky.app.config['EXPORT_BATCH_SIZE'] = 2
+        try:
+            rv = self.client.get('/secure/user/export/csv/')
+            assert rv.status == '200 OK'
+            rows = list(csv.reader(StringIO(rv.data.decode('utf-8'))))
+            rv = self.client.get('/secure/user/export/xlsx/')
+            assert rv.status == '200 OK'
+            sheet = openpyxl.load_workbook(BytesIO(rv.data), read_only=True).active
+            # Closes the temporary file
+            rv.close()
+            xlsx_rows = [['' if v is None else v for v in row] for row in sheet.iter_rows(values_only=True)]
+        finally:
+            talky.app.config['EXPORT_BATCH_SIZE'] = batch_size
+        assert rows[0] == ['Conference Date', 'Conference', 'Title', 'Experiment', 'Interesting To',
+                           'Duration', 'Speaker', 'Abstract']
+        assert rows[1:] == expected
+        assert xlsx_rows == rows
+
+        rv = self.client.get('/secure/user/export/csv/?flt1_experiment_experiment_name_equals=LHCb')
+        rows = list(csv.reader(StringIO(rv.data.decode('utf-8'))))
+        assert rows[1:] == [row for row in expected if row[3] == 'LHCb']
+
+    def get_api_pages(self, url):
+        talks = []
+        while url:
+            rv = self.client.get(url)
+            assert rv.status == '200 OK'
+            assert rv.headers['Content-Type'] == 'application/json'
+            talks.extend(rv.json['data'])
+            url = rv.json['next'] and f'{url.split("&after=")[0]}&after={rv.json["next"]}'
+        return talks
+
+    def test_api_talks(self):
+        self.login('userlhcb', 'user')
+        for view in ['flagged', 'given', 'other', 'all']:
+            data, talk_ids, previous_url, next_url = self.get_page(f'/secure/user/{view}?page_size=1000')
+            talks = self.get_api_pages(f'/secure/api/talks?view={view}&limit=2')
+            assert [talk['id'] for talk in talks] == talk_ids
+        assert set(talks[0]) == set(talky.interface.api.TALK_DEFAULT_FIELDS)
+
+        rv = self.client.get(f'/secure/api/talks/{talks[0]["id"]}?fields=id,title,interesting_to,categories')
+        assert set(rv.json['data']) == {'id', 'title', 'interesting_to', 'categories'}
+        with talky.app.app_context():
+            talk = talky.schema.Talk.query.get(talks[0]['id'])
+            assert rv.json['data']['title'] == talk.title
+            assert rv.json['data']['interesting_to'] == sorted(e.name for e in talk.interesting_to)
+            assert rv.json['data']['categories'] == sorted(c.name for c in talk.categories)
+            assert talks[0]['url'].endswith(f'/view/{talk.id}/{talk.view_key}/')
+
+        assert self.client.get('/secure/api/talks?fields=id,upload_key').status == '400 BAD REQUEST'
+        assert self.client.get('/secure/api/talks?after=invalid').status == '400 BAD REQUEST'
+        assert self.client.get('/secure/api/talks?limit=0').status == '400 BAD REQUEST'
+        assert self.client.get('/secure/api/talks/0').status == '404 NOT FOUND'
+
+        self.logout()
+        rv = self.client.get('/secure/api/talks')
+        assert rv.status == '401 UNAUTHORIZED'
+        assert rv.json == {'error': 'Authentication required'}
+
+        # Scripts can use the token returned by logging in with JSON instead of a cookie
+        rv = self.client.post('/secure/login/', json=dict(email='userlhcb', password='user'))
+        token = rv.json['response']['user']['authentication_token']
+        self.logout()
+        rv = self.client.get('/secure/api/talks?limit=1', headers={'Authentication-Token': token})
+        assert rv.status == '200 OK'
+
+    def test_api_talk_children(self):
+        talk = self.get_talk(min_submissions=1, min_comments=1)
+        self.login('userlhcb', 'user')
+        rv = self.client.get(f'/secure/api/talks/{talk.id}/comments?fields=id,comment,submission_version&limit=1')
+        assert rv.status == '200 OK'
+        comments = [rv.json['data'][0]]
+        rv = self.client.get(f'/secure/api/talks/{talk.id}/comments?limit=1000&after={rv.json["next"]}')
+        comments += rv.json['data']
+        with talky.app.app_context():
+            expected = talky.schema.Comment.query.filter_by(talk_id=talk.id).order_by(talky.schema.Comment.id).all()
+            assert [c['id'] for c in comments] == [c.id for c in expected]
+            assert comments[0]['comment'] == expected[0].comment
+            assert set(comments[0]) == {'id', 'comment', 'submission_version'}
+            versions = [s.version for s in talky.schema.Submission.query.filter_by(talk_id=talk.id)]
+
+        rv = self.client.get(f'/secure/api/talks/{talk.id}/submissions?fields=version')
+        assert sorted(s['version'] for s in rv.json['data']) == sorted(versions)
+        rv = self.client.get('/secure/api/conferences?fields=name')
+        assert rv.status == '200 OK'
+        assert all(set(c) == {'name'} for c in rv.json['data'])
+
+
 class TalkyAuthTestCase(TalkyBaseTestCase):
     def test_login_logout(self):
         # Valid login for admin
@@ -98,6 +554,105 @@ class TalkyTalkViewTestCase(TalkyBaseTestCase):
         rv = self.client.get(f'/view/{talk.id}/{talk.upload_key}/')
         assert rv.status == '404 NOT FOUND'
 
+    def count_queries(self, url):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        # Listen to every engine to include the read-only sessions
+        engine = sqlalchemy.engine.Engine
+        talky.db.event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            rv = self.client.get(url)
+        finally:
+            talky.db.event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+        assert rv.status == '200 OK'
+        return len(statements)
+
+    def test_view_query_count(self):
+        talk = self.get_talk(min_submissions=1, min_comments=1)
+        url = f'/view/{talk.id}/{talk.view_key}/'
+        n_queries = self.count_queries(url)
+
+        # Adding more comments shouldn't change the number of queries
+        with talky.app.app_context():
+            _talk = talky.schema.Talk.query.get(talk.id)
+            submission = _talk.submissions.first()
+            for i in range(20):
+                talky.db.session.add(talky.schema.Comment(
+                    name=f'Name {i}', email='first.last@domain.org', comment=f'Comment {i}',
+                    time=datetime.now(), talk=_talk, submission=submission,
+                    parent_comment_id=_talk.comments[-1].id
+                ))
+                talky.db.session.commit()
+        assert self.count_queries(url) == n_queries
+
+    def test_page_cache(self):
+        talk = self.get_talk(experiment='LHCb', min_submissions=1)
+        url = f'/view/{talk.id}/{talk.view_key}/'
+        self.count_queries(url)
+        # Cached pages only need to check the cache version of the talk
+        assert self.count_queries(url) == 1
+
+        rv = self.client.post(
+            f'/view/{talk.id}/{talk.view_key}/comment/',
+            data=dict(parent_comment_id='None', name='Name', email='first.last@domain.org',
+                      comment='A new comment'),
+        )
+        assert rv.status == '302 FOUND'
+        assert b'A new comment' in self.client.get(url).data
+
+        with talky.app.app_context():
+            _talk = talky.schema.Talk.query.get(talk.id)
+            _talk.conference.name = 'Renamed conference'
+            talky.db.session.commit()
+        assert b'Renamed conference' in self.client.get(url).data
+
+        # The modify flag and CSRF token are not shared between users
+        other_client = talky.app.test_client()
+        self.login('userlhcb', 'user')
+        user_data = self.client.get(url).data
+        anonymous_data = other_client.get(url).data
+        assert b'Delete talk' in user_data
+        assert b'Delete talk' not in anonymous_data
+        user_tokens = set(re.findall(rb'name="csrf_token" value="([^"]+)"', user_data))
+        anonymous_tokens = set(re.findall(rb'name="csrf_token" value="([^"]+)"', anonymous_data))
+        assert len(user_tokens) == len(anonymous_tokens) == 1
+        assert user_tokens != anonymous_tokens
+        assert b'__talky_csrf_token__' not in user_data + anonymous_data
+
+    @staticmethod
+    def loaded_templates(env):
+        # Jinja caches templates by (loader, name)
+        return {name for _, name in env.cache.keys()}
+
+    def test_template_cache(self):
+        talk = self.get_talk()
+        default_cache_dir = talky.app.config['TEMPLATE_CACHE_DIR']
+        talky.app.config['TEMPLATE_CACHE_DIR'] = join(talky.app.config['FILE_PATH'], 'template_cache')
+        try:
+            talky.template_cache.setup_bytecode_cache()
+            n_templates = talky.template_cache.precompile()
+            assert n_templates > 0
+            # Every template of the app and the emails is written to the cache
+            cache_files = os.listdir(talky.app.config['TEMPLATE_CACHE_DIR'])
+            assert len(cache_files) == n_templates
+            assert all(fn.endswith('.cache') for fn in cache_files)
+            assert 'talk_assigned.html' in self.loaded_templates(talky.messages.env)
+            assert 'view_talk.html' in self.loaded_templates(talky.app.jinja_env)
+
+            # Templates are loaded from the cache after it has been set up again
+            talky.template_cache.setup_bytecode_cache()
+            assert 'view_talk.html' not in self.loaded_templates(talky.app.jinja_env)
+            rv = self.client.get(f'/view/{talk.id}/{talk.view_key}/')
+            assert rv.status == '200 OK'
+            assert talk.title.encode('utf-8') in rv.data
+            assert len(os.listdir(talky.app.config['TEMPLATE_CACHE_DIR'])) == n_templates
+        finally:
+            talky.app.config['TEMPLATE_CACHE_DIR'] = default_cache_dir
+            talky.template_cache.setup_bytecode_cache()
+
     def test_view_as_admin(self):
         talk = self.get_talk()
         self.login('admin', 'admin')
@@ -172,6 +727,60 @@ class TalkySubmissionTestCase(TalkyBaseTestCase):
         assert len(file_contents) == 1024*1024*10
         assert set(file_contents) == set([' '])
 
+    def upload_example(self, talk, contents=b'0123456789'):
+        with BytesIO(contents) as f:
+            rv = self.client.post(
+                f'/upload/{talk.id}/{talk.upload_key}/',
+                data=dict(file=(f, 'example.pdf')),
+            )
+        assert rv.status == '302 FOUND'
+        with talky.app.app_context():
+            version = talky.schema.Talk.query.get(talk.id).n_submissions
+        return f'/view/{talk.id}/{talk.view_key}/submission/v{version}/'
+
+    def test_download(self):
+        talk = self.get_talk()
+        url = self.upload_example(talk)
+
+        rv = self.client.get(url)
+        assert rv.status == '200 OK'
+        assert rv.data == b'0123456789'
+        assert rv.headers['Accept-Ranges'] == 'bytes'
+        etag, last_modified = rv.headers['ETag'], rv.headers['Last-Modified']
+        assert not etag.startswith('W/')
+
+        rv = self.client.get(url, headers={'If-None-Match': etag})
+        assert rv.status == '304 NOT MODIFIED'
+        rv = self.client.get(url, headers={'If-Modified-Since': last_modified})
+        assert rv.status == '304 NOT MODIFIED'
+        rv = self.client.get(url, headers={'If-None-Match': '"other"'})
+        assert rv.status == '200 OK'
+
+        rv = self.client.get(url, headers={'Range': 'bytes=2-5'})
+        assert rv.status == '206 PARTIAL CONTENT'
+        assert rv.data == b'2345'
+        assert rv.headers['Content-Range'] == 'bytes 2-5/10'
+
+    def test_download_x_accel_redirect(self):
+        talk = self.get_talk()
+        url = self.upload_example(talk)
+
+        talky.app.config['SUBMISSION_X_ACCEL_REDIRECT'] = '/submission-files/'
+        try:
+            rv = self.client.get(url, headers={'Range': 'bytes=2-5'})
+            assert rv.status == '200 OK'
+            assert rv.data == b''
+            version = url.split('/v')[-1][:-1]
+            assert rv.headers['X-Accel-Redirect'] == f'/submission-files/{talk.id}/{version}/example.pdf'
+            rv = self.client.get(url, headers={'If-None-Match': rv.headers['ETag']})
+            assert rv.status == '304 NOT MODIFIED'
+            assert 'X-Accel-Redirect' not in rv.headers
+            # The view key is still checked
+            rv = self.client.get(url.replace(talk.view_key, 'bad_view_key'))
+            assert rv.status == '404 NOT FOUND'
+        finally:
+            talky.app.config['SUBMISSION_X_ACCEL_REDIRECT'] = None
+
     def test_upload_invalid_request(self):
         talk = self.get_talk()
 
@@ -223,6 +832,213 @@ class TalkySubmissionTestCase(TalkyBaseTestCase):
             )
         assert rv.status == '413 REQUEST ENTITY TOO LARGE'
 
+    def list_files(self):
+        return {
+            os.path.relpath(join(dirpath, fn), talky.app.config['FILE_PATH'])
+            for dirpath, dirnames, filenames in os.walk(talky.app.config['FILE_PATH'])
+            for fn in dirnames + filenames
+        } - {'.uploads'}
+
+    def test_upload_checksum(self):
+        talk = self.get_talk()
+        contents = b'Example contents' * 100000
+        url = self.upload_example(talk, contents)
+        rv = self.client.get(url)
+        assert rv.data == contents
+        with talky.app.app_context():
+            submission = talky.schema.Talk.query.get(talk.id).latest_submission
+            assert submission.sha256 == hashlib.sha256(contents).hexdigest()
+            assert submission.size == len(contents)
+        assert os.listdir(join(talky.app.config['FILE_PATH'], '.uploads')) == []
+
+    def test_upload_no_leftovers(self):
+        talk = self.get_talk()
+        files = self.list_files()
+
+        # Rejected uploads
+        with BytesIO(b'Example contents') as f:
+            rv = self.client.post(
+                f'/upload/{talk.id}/{talk.upload_key}/',
+                data=dict(file=(f, 'bad_file.zip')),
+            )
+        assert rv.status == '302 FOUND'
+        with BytesIO(b'Example contents') as f:
+            rv = self.client.post(
+                f'/upload/{talk.id}/bad_upload_key/',
+                data=dict(file=(f, 'example.pdf')),
+            )
+        assert rv.status == '404 NOT FOUND'
+
+        # The client disconnects part way through the upload
+        body = (
+            b'--boundary\r\n'
+            b'Content-Disposition: form-data; name="file"; filename="example.pdf"\r\n'
+            b'Content-Type: application/pdf\r\n\r\n' + b'x' * 100000
+        )
+        rv = self.client.post(
+            f'/upload/{talk.id}/{talk.upload_key}/',
+            input_stream=BytesIO(body),
+            content_type='multipart/form-data; boundary=boundary',
+            content_length=len(body) + 1000,
+        )
+        assert rv.status == '400 BAD REQUEST'
+
+        assert self.list_files() == files
+        assert os.listdir(join(talky.app.config['FILE_PATH'], '.uploads')) == []
+        with talky.app.app_context():
+            assert talky.schema.Talk.query.get(talk.id).n_submissions == talk.n_submissions
+
+    def test_upload_existing_directory(self):
+        talk = self.get_talk()
+        # Files are left behind when submissions are deleted with CLEANUP_FILES = False
+        os.makedirs(join(talky.app.config['FILE_PATH'], str(talk.id), str(talk.n_submissions + 1)))
+        url = self.upload_example(talk)
+        assert url.endswith(f'/v{talk.n_submissions + 2}/')
+        assert self.client.get(url).data == b'0123456789'
+
+    def submission_fn(self, talk_id, version):
+        with talky.app.app_context():
+            submission = talky.schema.Submission.query.filter_by(talk_id=talk_id, version=version).one()
+            return submission.id, talky.storage.submission_path(talk_id, version, submission.filename)
+
+    def test_deduplicated_uploads(self):
+        talk = self.get_talk(experiment='LHCb')
+        with talky.app.app_context():
+            other_talk = talky.schema.Talk.query.filter(
+                talky.schema.Talk.experiment_id == talk.experiment_id,
+                talky.schema.Talk.id != talk.id
+            ).first()
+        self.upload_example(talk)
+        self.upload_example(other_talk)
+        submission_id, fn = self.submission_fn(talk.id, talk.n_submissions + 1)
+        other_submission_id, other_fn = self.submission_fn(other_talk.id, other_talk.n_submissions + 1)
+        blob = talky.storage.blob_path(hashlib.sha256(b'0123456789').hexdigest())
+        assert os.path.samefile(fn, blob)
+        assert os.path.samefile(other_fn, blob)
+
+        # Blobs are only removed once they are no longer used
+        talky.app.config['CLEANUP_FILES'] = True
+        try:
+            # Files are only removed once the deletion is committed
+            with talky.app.app_context():
+                talky.db.session.delete(talky.schema.Submission.query.get(submission_id))
+                talky.db.session.flush()
+                assert os.path.isfile(fn)
+                talky.db.session.rollback()
+            assert os.path.isfile(fn)
+
+            self.login('userlhcb', 'user')
+            self.client.get(f'/view/{talk.id}/{talk.view_key}/submission/{submission_id}/delete/')
+            assert not os.path.exists(fn)
+            assert os.path.isfile(blob)
+            self.client.get(f'/view/{other_talk.id}/{other_talk.view_key}/submission/{other_submission_id}/delete/')
+            assert not os.path.exists(other_fn)
+            assert not os.path.exists(blob)
+        finally:
+            talky.app.config['CLEANUP_FILES'] = False
+
+    def test_removed_blob(self):
+        talk = self.get_talk()
+        self.upload_example(talk)
+        blob = talky.storage.blob_path(hashlib.sha256(b'0123456789').hexdigest())
+        # The blob is removed after store_upload has checked that it exists
+        os.remove(blob)
+        isfile, talky.storage.isfile = talky.storage.isfile, lambda path: True
+        try:
+            url = self.upload_example(talk)
+        finally:
+            talky.storage.isfile = isfile
+        assert self.client.get(url).data == b'0123456789'
+        assert os.path.isfile(blob)
+
+    def test_dedupe_files(self):
+        # Every version of a sample talk has the same contents
+        talk = self.get_talk(min_submissions=2)
+        n_bytes = os.path.getsize(self.submission_fn(talk.id, 2)[1])
+        n_files, reclaimed = talky.storage.dedupe_files()
+        assert n_files == len([f for f in self.list_files() if f.endswith('.pdf')])
+        assert reclaimed >= n_bytes
+        assert os.path.samefile(self.submission_fn(talk.id, 1)[1], self.submission_fn(talk.id, 2)[1])
+        with talky.app.app_context():
+            assert talky.schema.Submission.query.filter_by(sha256=None).count() == 0
+
+        # Running again doesn't change anything
+        assert talky.storage.dedupe_files() == (n_files, 0)
+        rv = self.client.get(f'/view/{talk.id}/{talk.view_key}/submission/v2/')
+        assert rv.status == '200 OK'
+
+    def test_previews(self):
+        talk = self.get_talk(experiment='LHCb')
+        url = self.upload_example(talk)
+        version = talk.n_submissions + 1
+        # The upload isn't a valid PDF so no previews are rendered
+        rv = self.client.get(f'/view/{talk.id}/{talk.view_key}/')
+        assert f'submission/v{version}/preview/'.encode() not in rv.data
+        assert self.client.get(url + 'preview/thumb.png').status == '404 NOT FOUND'
+
+        submission_id, fn = self.submission_fn(talk.id, version)
+        with talky.app.app_context():
+            preview_dir = talky.previews.preview_dir(talk.id, version)
+        os.makedirs(preview_dir)
+        with open(join(preview_dir, 'page-1.png'), 'wb') as f:
+            f.write(b'PNG')
+        # Pretend pdftoppm rendered a single page
+        generate, talky.previews.generate_previews = talky.previews.generate_previews, lambda *args: 1
+        try:
+            assert talky.previews.render_previews(talk.id, version) == 1
+        finally:
+            talky.previews.generate_previews = generate
+        # Only the pages which were rendered are shown
+        rv = self.client.get(f'/view/{talk.id}/{talk.view_key}/')
+        assert f'submission/v{version}/preview/thumb.png'.encode() in rv.data
+        assert f'submission/v{version}/preview/page-1.png'.encode() in rv.data
+        assert f'submission/v{version}/preview/page-2.png'.encode() not in rv.data
+        assert b'onerror="this.style' not in rv.data
+        rv = self.client.get(url + 'preview/page-1.png')
+        assert rv.status == '200 OK'
+        assert rv.mimetype == 'image/png'
+        assert rv.data == b'PNG'
+        assert self.client.get(url + 'preview/page-2.png').status == '404 NOT FOUND'
+        assert self.client.get(url + 'preview/example.pdf').status == '404 NOT FOUND'
+        assert self.client.get(
+            f'/view/{talk.id}/bad_view_key/submission/v{version}/preview/page-1.png'
+        ).status == '404 NOT FOUND'
+
+        # Previews are removed with the submission
+        talky.app.config['CLEANUP_FILES'] = True
+        try:
+            self.login('userlhcb', 'user')
+            self.client.get(f'/view/{talk.id}/{talk.view_key}/submission/{submission_id}/delete/')
+            assert not os.path.exists(preview_dir)
+            assert not os.path.exists(os.path.dirname(fn))
+        finally:
+            talky.app.config['CLEANUP_FILES'] = False
+
+        talky.app.config['PREVIEW_WORKERS'] = 0
+        try:
+            talky.page_cache.talk_pages.clear()
+            rv = self.client.get(f'/view/{talk.id}/{talk.view_key}/')
+            assert b'preview/thumb.png' not in rv.data
+        finally:
+            talky.app.config['PREVIEW_WORKERS'] = 2
+
+    @unittest.skipUnless(shutil.which('pdftoppm'), 'pdftoppm is not installed')
+    def test_render_previews(self):
+        talk = self.get_talk(min_submissions=1)
+        with talky.app.app_context():
+            submission = talky.schema.Talk.query.get(talk.id).submissions.first()
+            preview_dir = talky.previews.preview_dir(talk.id, submission.version)
+        assert talky.previews.rebuild_previews() > 0
+        assert os.path.isfile(join(preview_dir, 'thumb.png'))
+        assert os.path.isfile(join(preview_dir, 'page-1.png'))
+        with talky.app.app_context():
+            preview_pages = talky.schema.Submission.query.get(submission.id).preview_pages
+        assert preview_pages == talky.previews.count_pages(preview_dir) > 0
+        rv = self.client.get(
+            f'/view/{talk.id}/{talk.view_key}/submission/v{submission.version}/preview/thumb.png'
+        )
+        assert rv.status == '200 OK'
+
     def test_valid_delete(self):
         talk = self.get_talk(experiment='LHCb', min_submissions=1)
 
@@ -420,6 +1236,13 @@ class TalkyCommentsTestCase(TalkyBaseTestCase):
             formatted_comment += f'{line }<br \>'
         return formatted_comment.encode('utf-8')
 
+    @staticmethod
+    def thread(talk_id, path=''):
+        """The comments of a talk, or those in the subtree at path, with replies following their parent"""
+        comments = talky.schema.Comment
+        thread_filter = comments.subtree_filter(talk_id, path) if path else comments.talk_id == talk_id
+        return comments.query.filter(thread_filter).order_by(comments.path).all()
+
     def test_get(self):
         talk = self.get_talk()
         rv = self.client.get(
@@ -643,7 +1466,561 @@ class TalkyCommentsTestCase(TalkyBaseTestCase):
         assert rv.status == '200 OK'
         assert self.format_coment(comment.comment) in rv.data, comment.comment
 
-    # TODO Add tests for child comments
+    def test_reply(self):
+        talk = self.get_talk(experiment='LHCb', min_comments=1)
+        with talky.app.app_context():
+            parent = talky.schema.Talk.query.get(talk.id).comments[0]
+            parent_id, parent_path, parent_depth = parent.id, parent.path, parent.depth
+
+        rv = self.client.post(
+            f'/view/{talk.id}/{talk.view_key}/comment/',
+            data=dict(
+                parent_comment_id=str(parent_id),
+                name='First 5821 Last',
+                email='first.last@domain.org',
+                comment='Example reply 5821'
+            ),
+            follow_redirects=True
+        )
+        assert rv.status == '200 OK'
+        assert b'Example reply 5821' in rv.data
+
+        with talky.app.app_context():
+            reply = talky.schema.Comment.query.filter_by(comment='Example reply 5821').one()
+            assert reply.parent_comment_id == parent_id
+            assert reply.path == parent_path + talky.schema.Comment.path_segment(reply.id)
+            assert reply.depth == parent_depth + 1
+            assert reply.id in [c.id for c in self.thread(reply.talk_id, parent_path)]
+
+    def test_lazy_replies(self):
+        talk = self.get_talk(experiment='LHCb', min_comments=1)
+        config = talky.app.config
+        config['COMMENT_INLINE_DEPTH'], config['TALK_PAGE_CACHE_SIZE'] = 3, 0
+        try:
+            with talky.app.app_context():
+                thread_ids = [c.id for c in self.thread(talk.id) if c.depth < 3]
+                parent_id = None
+                chain = []
+                for level in range(5):
+                    comment = talky.schema.Comment(
+                        name='Name', email='first.last@domain.org', comment=f'Reply level {level}',
+                        time=datetime.now(), talk_id=talk.id, parent_comment_id=parent_id
+                    )
+                    talky.db.session.add(comment)
+                    talky.db.session.commit()
+                    parent_id = comment.id
+                    chain.append(comment.id)
+
+            # The thread is drawn in order with every element closed
+            rv = self.client.get(f'/view/{talk.id}/{talk.view_key}/')
+            assert rv.status == '200 OK'
+            assert [int(i) for i in re.findall(rb'id="comment([0-9]+)"', rv.data)] == thread_ids + chain[:3]
+            assert rv.data.count(b'<div') == rv.data.count(b'</div>')
+            assert b'Reply level 2' in rv.data
+            assert b'Reply level 3' not in rv.data
+            assert f'data-url="comment/{chain[2]}/replies/">Show 2 replies'.encode() in rv.data
+
+            rv = self.client.get(f'/view/{talk.id}/{talk.view_key}/comment/{chain[2]}/replies/')
+            assert rv.status == '200 OK'
+            assert [int(i) for i in re.findall(rb'id="comment([0-9]+)"', rv.data)] == chain[3:]
+            assert rv.data.count(b'<div') == rv.data.count(b'</div>')
+
+            # Comments with many replies are collapsed too
+            config['COMMENT_INLINE_REPLIES'] = 3
+            rv = self.client.get(f'/view/{talk.id}/{talk.view_key}/')
+            assert b'Reply level 1' not in rv.data
+            assert f'data-url="comment/{chain[0]}/replies/">Show 4 replies'.encode() in rv.data
+            rv = self.client.get(f'/view/{talk.id}/{talk.view_key}/comment/{chain[0]}/replies/')
+            assert [int(i) for i in re.findall(rb'id="comment([0-9]+)"', rv.data)] == chain[1:4]
+
+            other = self.get_talk(min_comments=1, experiment='Belle')
+            rv = self.client.get(f'/view/{other.id}/{other.view_key}/comment/{chain[0]}/replies/')
+            assert rv.status == '404 NOT FOUND'
+            rv = self.client.get(f'/view/{talk.id}/bad_view_key/comment/{chain[0]}/replies/')
+            assert rv.status == '404 NOT FOUND'
+        finally:
+            config['COMMENT_INLINE_DEPTH'], config['COMMENT_INLINE_REPLIES'] = 6, 50
+            config['TALK_PAGE_CACHE_SIZE'] = 32 * 1024 * 1024
+
+    def test_updates(self):
+        talk = self.get_talk(experiment='LHCb', min_comments=1)
+        rv = self.client.get(f'/view/{talk.id}/{talk.view_key}/')
+        cursor = re.search(rb'data-cursor="([0-9.]+)"', rv.data).group(1).decode()
+        url = f'/view/{talk.id}/{talk.view_key}/updates/'
+
+        # Polls with nothing new only look up the talk
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        talky.db.event.listen(sqlalchemy.engine.Engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            rv = self.client.get(url, query_string=dict(since=cursor))
+        finally:
+            talky.db.event.remove(sqlalchemy.engine.Engine, 'before_cursor_execute', before_cursor_execute)
+        assert rv.status == '304 NOT MODIFIED'
+        assert rv.data == b''
+        assert len(statements) == 1, statements
+
+        rv = self.client.post(f'/view/{talk.id}/{talk.view_key}/comment/', data=dict(
+            parent_comment_id='None', name='Name', email='first.last@domain.org', comment='Polled comment'
+        ))
+        with talky.app.app_context():
+            parent_id = talky.schema.Comment.query.filter_by(comment='Polled comment').one().id
+        rv = self.client.post(f'/view/{talk.id}/{talk.view_key}/comment/', data=dict(
+            parent_comment_id=str(parent_id), name='Name', email='first.last@domain.org', comment='Polled reply'
+        ))
+        with BytesIO(b'0123456789') as f:
+            rv = self.client.post(f'/upload/{talk.id}/{talk.upload_key}/', data=dict(file=(f, 'example.pdf')))
+
+        rv = self.client.get(url, query_string=dict(since=cursor))
+        assert rv.status == '200 OK'
+        comments = rv.json['comments']
+        assert [c['parent_comment_id'] for c in comments] == [None, parent_id]
+        assert 'Polled comment' in comments[0]['html']
+        assert 'Polled reply' in comments[1]['html']
+        assert comments[0]['html'].count('<div') == comments[0]['html'].count('</div>')
+        submission, = rv.json['submissions']
+        assert f'submission/v{submission["version"]}' in submission['html']
+        assert rv.json['cursor'] != cursor
+        assert {c['id'] for c in comments} <= set(rv.json['comment_ids'])
+        assert submission['id'] in rv.json['submission_ids']
+
+        cursor = rv.json['cursor']
+        rv = self.client.get(url, query_string=dict(since=cursor))
+        assert rv.status == '304 NOT MODIFIED'
+
+        # Deleted comments, including the replies to them, are no longer listed
+        self.login('userlhcb', 'user')
+        self.client.get(f'/view/{talk.id}/{talk.view_key}/comment/{parent_id}/delete/')
+        self.logout()
+        rv = self.client.get(url, query_string=dict(since=cursor))
+        assert rv.status == '200 OK'
+        assert rv.json['comments'] == []
+        assert not {c['id'] for c in comments} & set(rv.json['comment_ids'])
+        assert rv.json['comment_ids']
+        assert submission['id'] in rv.json['submission_ids']
+
+        # Pages rendered while the cache version was NULL get a usable cursor
+        rv = self.client.get(url, query_string=dict(since='None.' + cursor.split('.', 1)[1]))
+        assert rv.status == '200 OK'
+        rv = self.client.get(url, query_string=dict(since=rv.json['cursor']))
+        assert rv.status == '304 NOT MODIFIED'
+
+        rv = self.client.get(url, query_string=dict(since='invalid'))
+        assert rv.status == '400 BAD REQUEST'
+        rv = self.client.get(f'/view/{talk.id}/bad_view_key/updates/', query_string=dict(since=cursor))
+        assert rv.status == '404 NOT FOUND'
+
+    def test_live_local(self):
+        talk = self.get_talk(experiment='LHCb', min_comments=1)
+        talky.app.config['LIVE_EVENTS'] = 'local'
+        try:
+            rv = self.client.get(f'/view/{talk.id}/{talk.view_key}/live/', buffered=False)
+            assert rv.status == '200 OK'
+            assert rv.mimetype == 'text/event-stream'
+            stream = iter(rv.response)
+            assert next(stream) == b'retry: 10000\n\n'
+
+            self.client.post(f'/view/{talk.id}/{talk.view_key}/comment/', data=dict(
+                parent_comment_id='None', name='Name', email='first.last@domain.org', comment='Live comment'
+            ))
+            with talky.app.app_context():
+                comment_id = talky.schema.Comment.query.filter_by(comment='Live comment').one().id
+            assert next(stream) == f'event: comment\ndata: {{"id": {comment_id}}}\n\n'.encode()
+
+            self.login('userlhcb', 'user')
+            self.client.get(f'/view/{talk.id}/{talk.view_key}/comment/{comment_id}/delete/')
+            assert next(stream) == f'event: comment-deleted\ndata: {{"id": {comment_id}}}\n\n'.encode()
+            rv.close()
+            assert talky.live.local_broker.queues == {}
+        finally:
+            talky.app.config['LIVE_EVENTS'] = None
+
+    def test_live_hub(self):
+        talk = self.get_talk(experiment='LHCb', min_comments=1)
+        config = talky.app.config
+        config['LIVE_EVENTS'] = 'hub'
+        config['LIVE_SOCKET'] = join(config['FILE_PATH'], 'live.sock')
+        config['LIVE_PUBLISH_SOCKET'] = join(config['FILE_PATH'], 'live-publish.sock')
+        hub = talky.live.Hub('/live-events/', 25)
+        loop = asyncio.new_event_loop()
+        task = loop.create_task(talky.live.serve_hub(hub, config['LIVE_SOCKET'], config['LIVE_PUBLISH_SOCKET']))
+
+        def run():
+            try:
+                loop.run_until_complete(task)
+            except asyncio.CancelledError:
+                pass
+
+        def n_clients():
+            # The hub is only consistent between the callbacks of its event loop
+            async def count():
+                return sum(len(writers) for writers in hub.clients.values())
+            return asyncio.run_coroutine_threadsafe(count(), loop).result(10)
+
+        buffer = b''
+
+        def read_until(separator):
+            nonlocal buffer
+            while separator not in buffer:
+                chunk = client.recv(4096)
+                assert chunk, 'The hub closed the connection'
+                buffer += chunk
+            data, buffer = buffer.split(separator, 1)
+            return data + separator
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        try:
+            rv = self.client.get(f'/view/{talk.id}/{talk.view_key}/live/')
+            assert rv.status == '200 OK'
+            assert rv.headers['X-Accel-Redirect'] == f'/live-events/{talk.id}'
+
+            # Connect to the hub in the same way as nginx, the socket file
+            # exists slightly before the hub starts listening on it
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.settimeout(10)
+            for _ in range(100):
+                try:
+                    client.connect(config['LIVE_SOCKET'])
+                    break
+                except (FileNotFoundError, ConnectionRefusedError):
+                    time.sleep(0.1)
+            client.sendall(f'GET /live-events/{talk.id} HTTP/1.0\r\nHost: localhost\r\n\r\n'.encode())
+            headers = read_until(b'\r\n\r\n')
+            assert headers.startswith(b'HTTP/1.1 200 OK')
+            assert b'Content-Type: text/event-stream' in headers
+            assert read_until(b'\n\n') == talky.live.RETRY
+            assert n_clients() == 1
+
+            with BytesIO(b'0123456789') as f:
+                rv = self.client.post(f'/upload/{talk.id}/{talk.upload_key}/', data=dict(file=(f, 'example.pdf')))
+            with talky.app.app_context():
+                submission_id = talky.schema.Talk.query.get(talk.id).latest_submission_id
+            assert read_until(b'\n\n') == f'event: submission\ndata: {{"id": {submission_id}}}\n\n'.encode()
+            client.close()
+            for _ in range(100):
+                if not n_clients():
+                    break
+                time.sleep(0.1)
+            assert n_clients() == 0
+        finally:
+            config['LIVE_EVENTS'] = None
+            loop.call_soon_threadsafe(task.cancel)
+            thread.join()
+            loop.close()
+
+    def test_delete_replies(self):
+        talk = self.get_talk(experiment='LHCb', min_comments=1)
+        with talky.app.app_context():
+            comments = self.thread(talk.id)
+            # Find a comment with replies
+            parent = next(c for c in comments if c.children)
+            subtree = [c.id for c in self.thread(talk.id, parent.path)]
+            assert len(subtree) > 1
+            n_comments = len(comments)
+
+        talky.app.config['LIVE_EVENTS'] = 'local'
+        try:
+            live = self.client.get(f'/view/{talk.id}/{talk.view_key}/live/', buffered=False)
+            stream = iter(live.response)
+            assert next(stream) == b'retry: 10000\n\n'
+
+            self.login('userlhcb', 'user')
+            rv = self.client.get(
+                f'/view/{talk.id}/{talk.view_key}/comment/{subtree[0]}/delete/',
+                follow_redirects=True
+            )
+            self.logout()
+            assert rv.status == '200 OK'
+
+            # Open pages are told about the removal of every reply
+            deleted = {next(stream) for _ in subtree}
+            assert deleted == {f'event: comment-deleted\ndata: {{"id": {i}}}\n\n'.encode() for i in subtree}
+            live.close()
+        finally:
+            talky.app.config['LIVE_EVENTS'] = None
+
+        with talky.app.app_context():
+            remaining = [c.id for c in self.thread(talk.id)]
+            assert len(remaining) == n_comments - len(subtree)
+            assert not set(subtree) & set(remaining)
+
+
+class TalkyEmailTestCase(TalkyBaseTestCase):
+    def test_inline_css(self):
+        with talky.app.app_context():
+            comment = talky.schema.Comment.query.first()
+            for template in ['talk_assigned.html', 'new_talk_available.html', 'new_comment.html']:
+                html = talky.messages.env.get_template(template).render(
+                    subject='Subject', talk=comment.talk, comment=comment, domain='http://localhost'
+                )
+                expected = premailer.transform(html)
+                # The stylesheet is cached after the first email
+                assert talky.messages.inline_css(html) == expected
+                assert talky.messages.inline_css(html) == expected
+                assert 'style="' in expected
+                assert comment.talk.title in expected
+
+    def test_new_talk_recipients(self):
+        schema = talky.schema
+        with talky.app.app_context():
+            # Flag categories whose contacts overlap with each other and the users
+            lhcb = schema.Experiment.query.filter_by(name='LHCb').one()
+            contacts = schema.Contact.query.all()
+            contacts.append(schema.Contact(email='userbelle', experiment=lhcb))
+            charm = schema.Category(name='Charm 2', experiment=lhcb, contacts=contacts[:3] + contacts[-1:])
+            beauty = schema.Category(name='Beauty', experiment=lhcb, contacts=contacts[2:5])
+            for i, talk in enumerate(schema.Talk.query.all()):
+                talk.categories = [[], [charm], [charm, beauty]][i % 3]
+            talky.db.session.commit()
+
+            all_expected = {}
+            for talk in schema.Talk.query.all():
+                # The recipients as they were found before using a single query
+                expected = []
+                for user in schema.User.query.all():
+                    if user.experiment == talk.experiment:
+                        expected.append(user.email)
+                    elif user.experiment in talk.interesting_to:
+                        expected.append(user.email)
+                for category in talk.categories:
+                    expected.extend([c.email for c in category.contacts])
+
+                recipients = [email for email, in talky.db.session.execute(
+                    talky.messages.new_talk_recipients(talk.id)
+                )]
+                assert len(recipients) == len(set(recipients))
+                assert set(recipients) == set(expected), talk.id
+                all_expected[talk.id] = set(expected)
+            talk = schema.Talk.query.filter(schema.Talk.n_submissions == 0, schema.Talk.categories.any()).first()
+            talk_id, upload_key = talk.id, talk.upload_key
+
+        # Notifications are sent when the first version is uploaded
+        with BytesIO(b'0123456789') as f:
+            rv = self.client.post(f'/upload/{talk_id}/{upload_key}/', data=dict(file=(f, 'example.pdf')))
+        assert rv.status == '302 FOUND'
+        email, = self.queued_emails()
+        assert set(email.bcc.split('\n')) == all_expected[talk_id]
+
+    def queued_emails(self):
+        with talky.app.app_context():
+            return talky.schema.OutgoingEmail.query.order_by(talky.schema.OutgoingEmail.id).all()
+
+    def test_outbox(self):
+        talk = self.get_talk()
+        assert self.queued_emails() == []
+        rv = self.client.post(
+            f'/view/{talk.id}/{talk.view_key}/comment/',
+            data=dict(parent_comment_id='None', name='Name', email='first.last@domain.org',
+                      comment='A new comment'),
+        )
+        assert rv.status == '302 FOUND'
+        emails = self.queued_emails()
+        assert len(emails) == 1
+        assert emails[0].status == 'pending'
+        assert emails[0].bcc == talk.speaker
+        assert 'A new comment' in emails[0].html
+
+        with talky.app.app_context():
+            with talky.mail.record_messages() as sent:
+                assert talky.outbox.drain() == (1, 0)
+                assert talky.outbox.drain() == (0, 0)
+        assert len(sent) == 1
+        assert sent[0].bcc == [talk.speaker]
+        assert sent[0].subject == emails[0].subject
+        assert [e.status for e in self.queued_emails()] == ['sent']
+
+    def test_outbox_rollback(self):
+        talk = self.get_talk()
+        with talky.app.app_context():
+            _talk = talky.schema.Talk.query.get(talk.id)
+            _talk.speaker = 'new.speaker@domain.org'
+            talky.db.session.flush()
+            # Notifications are only handled once the change is committed
+            event, = talky.schema.PendingEvent.query.all()
+            assert (event.type, event.payload) == ('SpeakerAssigned', f'[{talk.id}]')
+            assert talky.schema.OutgoingEmail.query.count() == 0
+            talky.db.session.rollback()
+            assert talky.schema.PendingEvent.query.count() == 0
+        assert self.queued_emails() == []
+
+    def add_comments(self, talk_id, texts):
+        for text in texts:
+            talky.db.session.add(talky.schema.Comment(
+                name='Name', email='first.last@domain.org', comment=text, time=datetime.now(),
+                talk_id=talk_id
+            ))
+            talky.db.session.commit()
+
+    def test_events(self):
+        talk = self.get_talk()
+        with talky.app.app_context():
+            with talky.events.suppressed():
+                self.add_comments(talk.id, ['Suppressed'])
+            assert self.queued_emails() == []
+
+            # Events from several transactions are handled together at the end
+            with talky.events.batched():
+                self.add_comments(talk.id, ['First', 'Second'])
+                assert self.queued_emails() == []
+            assert [e.subject for e in self.queued_emails()] == [f'New comment received on {talk.title}'] * 2
+
+            # Events left by a process which died before handling them are
+            # handled in the background and deleted objects are skipped
+            comment_ids = [c.id for c in talky.schema.Comment.query.filter_by(talk_id=talk.id)]
+            for comment_id in [comment_ids[0], comment_ids[0], -1]:
+                talky.events.record(talky.db.session, talky.events.CommentPosted(comment_id))
+            talky.db.session.info.pop('pending_events')
+            talky.db.session.commit()
+            assert len(self.queued_emails()) == 2
+            talky.app.config['EVENT_WORKERS'] = 2
+            try:
+                assert talky.events.wake().result() == 3
+            finally:
+                talky.app.config['EVENT_WORKERS'] = 0
+            assert len(self.queued_emails()) == 3
+            assert talky.schema.PendingEvent.query.count() == 0
+
+            # Failures are retried later
+            talky.events.record(talky.db.session, talky.events.CommentPosted(comment_ids[0]))
+            talky.db.session.info.pop('pending_events')
+            talky.db.session.commit()
+            subscribers = talky.events._subscribers[talky.events.CommentPosted]
+            talky.events._subscribers[talky.events.CommentPosted] = [lambda session, batch: 1 / 0]
+            try:
+                assert talky.events.deliver_pending() == 0
+            finally:
+                talky.events._subscribers[talky.events.CommentPosted] = subscribers
+            event, = talky.schema.PendingEvent.query.all()
+            assert event.attempts == 1
+            assert event.next_attempt > datetime.now()
+            assert talky.events.deliver_pending() == 0
+            event.next_attempt = datetime.now()
+            talky.db.session.commit()
+            # The outbox also handles events which are due
+            talky.outbox.drain()
+            assert talky.schema.PendingEvent.query.count() == 0
+            assert len(self.queued_emails()) == 4
+
+    def test_outbox_chunks(self):
+        bcc = [f'user{i}@domain.org' for i in range(120)]
+        with talky.app.app_context():
+            talky.outbox.enqueue(talky.db.session, 'Subject', '<p>Body</p>', recipients=['a@domain.org'], bcc=bcc)
+            talky.db.session.commit()
+        emails = self.queued_emails()
+        assert [len(e.bcc.split('\n')) for e in emails] == [50, 50, 20]
+        assert [e.recipients for e in emails] == ['a@domain.org', '', '']
+        assert sorted(sum((e.bcc.split('\n') for e in emails), [])) == sorted(bcc)
+
+        talk = self.get_talk()
+        with talky.app.app_context():
+            with talky.events.suppressed():
+                self.add_comments(talk.id, ['Suppressed'])
+        assert len(self.queued_emails()) == 3
+
+    def test_outbox_retry(self):
+        with talky.app.app_context():
+            talky.outbox.enqueue(talky.db.session, 'Subject', '<p>Body</p>', recipients=['a@domain.org'])
+            talky.db.session.commit()
+
+        # Nothing is listening on port 1 so connecting fails
+        mail_state = talky.app.extensions['mail']
+        mail_state.suppress, mail_state.server, mail_state.port = False, '127.0.0.1', 1
+        try:
+            with talky.app.app_context():
+                assert talky.outbox.drain() == (0, 1)
+                email, = self.queued_emails()
+                assert email.status == 'pending'
+                assert email.attempts == 1
+                assert email.last_error
+                assert email.next_attempt > datetime.now()
+                # Not due yet
+                assert talky.outbox.drain() == (0, 0)
+
+                email = talky.schema.OutgoingEmail.query.get(email.id)
+                email.next_attempt = datetime.now()
+                email.attempts = talky.app.config['MAIL_MAX_ATTEMPTS'] - 1
+                talky.db.session.commit()
+                assert talky.outbox.drain() == (0, 1)
+                assert self.queued_emails()[0].status == 'failed'
+        finally:
+            mail_state.suppress, mail_state.server, mail_state.port = True, 'CHANGE_ME', 465
+
+        # The admin interface shows the failures and can send them again
+        self.login('admin', 'admin')
+        rv = self.client.get('/secure/admin/outgoingemail/')
+        assert rv.status == '200 OK'
+        assert b'0 pending' in rv.data
+        assert b'1 failed' in rv.data
+        rv = self.client.post(
+            '/secure/admin/outgoingemail/action/',
+            data=dict(action='retry', rowid=[str(self.queued_emails()[0].id)]),
+            follow_redirects=True
+        )
+        assert rv.status == '200 OK'
+        assert b'1 pending' in rv.data
+        with talky.app.app_context():
+            with talky.mail.record_messages() as sent:
+                assert talky.outbox.drain() == (1, 0)
+        assert len(sent) == 1
+
+    def test_outbox_invalid_message(self):
+        with talky.app.app_context():
+            talky.outbox.enqueue(talky.db.session, 'Bad\nSubject', '<p>Body</p>', recipients=['a@domain.org'])
+            talky.outbox.enqueue(talky.db.session, 'Subject', '<p>Body</p>', recipients=['b@domain.org'])
+            talky.db.session.commit()
+            talky.app.config['MAIL_MAX_ATTEMPTS'], max_attempts = 1, talky.app.config['MAIL_MAX_ATTEMPTS']
+            try:
+                # The message which can't be sent doesn't block the one queued after it
+                with talky.mail.record_messages() as sent:
+                    assert talky.outbox.drain() == (1, 1)
+            finally:
+                talky.app.config['MAIL_MAX_ATTEMPTS'] = max_attempts
+        assert [m.recipients for m in sent] == [['b@domain.org']]
+        assert [e.status for e in self.queued_emails()] == ['failed', 'sent']
+
+    def test_digest(self):
+        talk = self.get_talk()
+        talky.app.config['MAIL_DIGEST_INTERVAL'] = 3600
+        try:
+            for text in ['First comment', 'Second comment']:
+                rv = self.client.post(
+                    f'/view/{talk.id}/{talk.view_key}/comment/',
+                    data=dict(parent_comment_id='None', name='Name', email='first.last@domain.org', comment=text),
+                )
+                assert rv.status == '302 FOUND'
+            # Comments are collected for the digest rather than sent
+            assert self.queued_emails() == []
+            with talky.app.app_context():
+                items = talky.schema.DigestItem.query.all()
+                assert [i.recipient for i in items] == [talk.speaker] * 2
+                assert talky.digest.next_due() == items[0].created + timedelta(hours=1)
+                # Not due yet
+                assert talky.digest.send_due_digests() == 0
+
+                # Speakers are still told immediately when they are assigned
+                _talk = talky.schema.Talk.query.get(talk.id)
+                _talk.speaker = 'new.speaker@domain.org'
+                talky.db.session.commit()
+                email, = self.queued_emails()
+                assert email.recipients == 'new.speaker@domain.org'
+
+                talky.schema.DigestItem.query.update({'created': datetime.now() - timedelta(hours=2)})
+                talky.db.session.commit()
+                with talky.mail.record_messages() as sent:
+                    assert talky.outbox.drain() == (2, 0)
+                assert talky.schema.DigestItem.query.count() == 0
+            assert len(sent) == 2
+            assert sent[1].recipients == [talk.speaker]
+            assert sent[1].subject == '2 new notifications from Talky'
+            assert 'First comment' in sent[1].html
+            assert 'Second comment' in sent[1].html
+            assert f'/view/{talk.id}/{talk.view_key}/#comment' in sent[1].html
+        finally:
+            talky.app.config['MAIL_DIGEST_INTERVAL'] = 0
 
 
 if __name__ == '__main__':
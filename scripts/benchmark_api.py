@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""Compare fetching pages of talks from the HTML listing and from the JSON API"""
+import argparse
+from datetime import datetime, timedelta
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+
+def prepare_db(n_talks):
+    from talky import create_database, schema
+    create_database.build_sample_db(fast=True)
+    db = schema.db
+    with db.engine.begin() as connection:
+        n_experiments = connection.execute('SELECT count(*) FROM experiment').scalar()
+        now = datetime.now()
+        connection.execute(schema.Conference.__table__.insert(), [
+            dict(id=1000 + i, name=f'Conference {i}', venue='Venue', start_date=now - timedelta(days=i))
+            for i in range(n_talks // 20 + 1)
+        ])
+        connection.execute(schema.Talk.__table__.insert(), [
+            dict(title=f'Talk {i}', duration='10"', speaker=f'speaker{i}@domain.org', n_submissions=0,
+                 comment_count=0, experiment_id=i % n_experiments + 1, conference_id=1000 + i // 20,
+                 view_key=f'view{i}', upload_key=f'upload{i}')
+            for i in range(n_talks)
+        ])
+
+
+def fetch(client, url, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        rv = client.get(url)
+        timings.append(time.perf_counter() - start)
+        assert rv.status_code == 200, rv.status
+    return statistics.median(timings), len(rv.data)
+
+
+def main(n_talks, page_sizes, repeats):
+    import talky
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        talky.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(tmp_dir, 'talky.sqlite')
+        talky.app.config['FILE_PATH'] = tmp_dir
+        talky.app.config['WTF_CSRF_ENABLED'] = False
+        talky.app.config['API_MAX_PAGE_SIZE'] = max(page_sizes)
+        with talky.app.app_context():
+            prepare_db(n_talks)
+
+        client = talky.app.test_client()
+        rv = client.post('/secure/login/', data=dict(email='userlhcb', password='user'), follow_redirects=True)
+        assert rv.status_code == 200
+
+        print(f'{n_talks} extra talks, median of {repeats} requests')
+        print(f'{"page size":>10} {"HTML ms":>10} {"HTML kB":>10} {"API ms":>10} {"API kB":>10}')
+        for page_size in page_sizes:
+            html_time, html_size = fetch(client, f'/secure/user/all?page_size={page_size}', repeats)
+            api_time, api_size = fetch(client, f'/secure/api/talks?view=all&limit={page_size}', repeats)
+            print(f'{page_size:>10} {html_time * 1000:10.1f} {html_size / 1024:10.1f} '
+                  f'{api_time * 1000:10.1f} {api_size / 1024:10.1f}')
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--talks', type=int, default=5000)
+    parser.add_argument('--page-sizes', type=int, nargs='+', default=[20, 100, 1000])
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+    main(args.talks, args.page_sizes, args.repeats)
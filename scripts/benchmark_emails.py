@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""Measure the time to render each notification email with and without cached CSS inlining"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from premailer import transform
+
+
+def render(template, talk, comment, domain):
+    from talky import messages
+    return messages.env.get_template(template).render(
+        subject=f'Subject - {talk.title}', talk=talk, comment=comment, domain=domain
+    )
+
+
+def main(repeats):
+    import talky
+    from talky import create_database, messages, schema
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        talky.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(tmp_dir, 'talky.sqlite')
+        talky.app.config['FILE_PATH'] = tmp_dir
+        with talky.app.app_context():
+            create_database.build_sample_db(fast=True)
+            comment = schema.Comment.query.first()
+            talk = comment.talk
+            domain = talky.app.config['TALKY_DOMAIN']
+
+            print(f'{"":<26} {"premailer":>10} {"cached":>10}  (ms per email, mean of {repeats})')
+            for template in ['talk_assigned.html', 'new_talk_available.html', 'new_comment.html']:
+                timings = []
+                for inline in [transform, messages.inline_css]:
+                    # Exclude the one-off cost of parsing the stylesheet
+                    inline(render(template, talk, comment, domain))
+                    start = time.perf_counter()
+                    for _ in range(repeats):
+                        inline(render(template, talk, comment, domain))
+                    timings.append((time.perf_counter() - start) / repeats * 1000)
+                print(f'{template:<26} {timings[0]:10.2f} {timings[1]:10.2f}')
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeats', type=int, default=200)
+    args = parser.parse_args()
+    main(args.repeats)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""Compare exporting the talk listing with Flask-Admin and with the streaming export"""
+import argparse
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+
+def prepare_db(n_talks):
+    from talky import create_database, schema
+    create_database.build_sample_db(fast=True)
+    db = schema.db
+    abstract = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 20
+    with db.engine.begin() as connection:
+        n_experiments = connection.execute('SELECT count(*) FROM experiment').scalar()
+        now = datetime.now()
+        connection.execute(schema.Conference.__table__.insert(), [
+            dict(id=1000 + i, name=f'Conference {i}', venue='Venue', start_date=now - timedelta(days=i))
+            for i in range(n_talks // 20 + 1)
+        ])
+        for start in range(0, n_talks, 10000):
+            talk_ids = range(start, min(start + 10000, n_talks))
+            connection.execute(schema.Talk.__table__.insert(), [
+                dict(id=1000 + i, title=f'Talk {i}', duration='10"', speaker=f'speaker{i}@domain.org',
+                     abstract=abstract, n_submissions=0, comment_count=0, experiment_id=i % n_experiments + 1,
+                     conference_id=1000 + i // 20, view_key=f'view{i}', upload_key=f'upload{i}')
+                for i in talk_ids
+            ])
+            connection.execute(schema.interesting_talks_experiment.insert(), [
+                dict(experiment_id=(i + 1) % n_experiments + 1, talk_id=1000 + i) for i in talk_ids
+            ])
+
+
+@contextmanager
+def flask_admin_export():
+    """Use the implementation from Flask-Admin which loads every talk before writing the file"""
+    from flask_admin.model import BaseModelView
+    from talky.interface.home import UserHomeView
+    streaming = UserHomeView._export_csv, UserHomeView._export_tablib
+    UserHomeView._export_csv = BaseModelView._export_csv
+    UserHomeView._export_tablib = BaseModelView._export_tablib
+    try:
+        yield
+    finally:
+        UserHomeView._export_csv, UserHomeView._export_tablib = streaming
+
+
+@contextmanager
+def streaming_export():
+    yield
+
+
+def export(client, export_type):
+    """Return the time to the first byte, the total time and the size of the export"""
+    start = time.perf_counter()
+    rv = client.get(f'/secure/user/export/{export_type}/', buffered=False)
+    assert rv.status_code == 200, rv.status
+    chunks = iter(rv.response)
+    size = len(next(chunks))
+    first_byte = time.perf_counter() - start
+    for chunk in chunks:
+        size += len(chunk)
+    rv.close()
+    return first_byte, time.perf_counter() - start, size
+
+
+def main(n_talks):
+    import talky
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        talky.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(tmp_dir, 'talky.sqlite')
+        talky.app.config['FILE_PATH'] = tmp_dir
+        talky.app.config['WTF_CSRF_ENABLED'] = False
+        with talky.app.app_context():
+            prepare_db(n_talks)
+
+        client = talky.app.test_client()
+        rv = client.post('/secure/login/', data=dict(email='userlhcb', password='user'), follow_redirects=True)
+        assert rv.status_code == 200
+
+        print(f'{n_talks} extra talks')
+        print(f'{"":<24} {"1st byte s":>10} {"total s":>10} {"MB":>8} {"peak MB":>10}')
+        for export_type in ['csv', 'xlsx']:
+            for implementation in [flask_admin_export, streaming_export]:
+                with implementation():
+                    first_byte, total, size = export(client, export_type)
+                    # Measured separately as tracing allocations slows everything down
+                    tracemalloc.start()
+                    export(client, export_type)
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                label = f'{implementation.__name__} {export_type}'
+                print(f'{label:<24} {first_byte:10.2f} {total:10.2f} {size / 1024**2:8.1f} {peak / 1024**2:10.1f}')
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--talks', type=int, default=100000)
+    args = parser.parse_args()
+    main(args.talks)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""Compare finding the recipients of new talk notifications in Python and in SQL"""
+import argparse
+from datetime import datetime
+import os
+import tempfile
+import time
+
+
+def prepare_db(n_users, n_experiments, n_contacts):
+    from talky import schema
+    db = schema.db
+    db.drop_all()
+    db.create_all()
+    with db.engine.begin() as connection:
+        connection.execute(schema.Experiment.__table__.insert(), [
+            dict(id=i, name=f'Experiment {i}') for i in range(1, n_experiments + 1)
+        ])
+        connection.execute(schema.User.__table__.insert(), [
+            dict(name=f'User {i}', email=f'user{i}@domain.org', active=True,
+                 experiment_id=i % n_experiments + 1)
+            for i in range(n_users)
+        ])
+        connection.execute(schema.Contact.__table__.insert(), [
+            # Some contacts are also users
+            dict(id=i, email=f'user{i * 7}@domain.org' if i % 2 else f'contact{i}@domain.org',
+                 experiment_id=1)
+            for i in range(1, n_contacts + 1)
+        ])
+        connection.execute(schema.Category.__table__.insert(), [
+            dict(id=i, name=f'Category {i}', experiment_id=1) for i in range(1, 11)
+        ])
+        connection.execute(schema.categories_contacts.insert(), [
+            dict(contact_id=i, category_id=i % 10 + 1) for i in range(1, n_contacts + 1)
+        ])
+        connection.execute(schema.Conference.__table__.insert().values(
+            id=1, name='Moriond', venue='La Thuile', start_date=datetime.now()))
+        connection.execute(schema.Talk.__table__.insert().values(
+            id=1, title='Title', duration='10"', speaker='speaker@domain.org', n_submissions=0,
+            comment_count=0, experiment_id=1, conference_id=1, view_key='view', upload_key='upload'))
+        connection.execute(schema.interesting_talks_experiment.insert(), [
+            dict(experiment_id=i, talk_id=1) for i in [2, 3]
+        ])
+        connection.execute(schema.talk_categories.insert(), [
+            dict(category_id=i, talk_id=1) for i in [1, 2, 3]
+        ])
+
+
+def python_recipients(talk):
+    """The implementation used before the recipients were found in SQL"""
+    from talky import schema
+    recipients = []
+    for user in schema.User.query.all():
+        if user.experiment == talk.experiment:
+            recipients.append(user.email)
+        elif user.experiment in talk.interesting_to:
+            recipients.append(user.email)
+    for category in talk.categories:
+        recipients.extend([c.email for c in category.contacts])
+    return list(set(recipients))
+
+
+def sql_recipients(talk):
+    from talky import messages, schema
+    return [email for email, in schema.db.session.execute(messages.new_talk_recipients(talk.id))]
+
+
+def main(n_users, n_experiments, n_contacts, repeats):
+    import talky
+    from talky import schema
+
+    fd, fn = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    try:
+        talky.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + fn
+        with talky.app.app_context():
+            prepare_db(n_users, n_experiments, n_contacts)
+            print(f'{n_users} users in {n_experiments} experiments and {n_contacts} category contacts')
+
+            results = {}
+            for func in [python_recipients, sql_recipients]:
+                timings = []
+                for _ in range(repeats):
+                    # Start from an empty session as each upload is a new request
+                    schema.db.session.remove()
+                    talk = schema.Talk.query.get(1)
+                    start = time.perf_counter()
+                    results[func.__name__] = set(func(talk))
+                    timings.append(time.perf_counter() - start)
+                print(f'{func.__name__:<20} {min(timings) * 1000:8.1f} ms '
+                      f'({len(results[func.__name__])} recipients, best of {repeats})')
+            assert results['python_recipients'] == results['sql_recipients']
+    finally:
+        os.unlink(fn)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--experiments', type=int, default=20)
+    parser.add_argument('--contacts', type=int, default=1000)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+    main(args.users, args.experiments, args.contacts, args.repeats)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""Compare concurrent read/write throughput with and without SQLITE_PRAGMAS"""
+import argparse
+from datetime import datetime
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import time
+
+
+def prepare_db(fn, pragmas):
+    import talky
+    from talky import schema
+    talky.app.config['SQLITE_PRAGMAS'] = pragmas
+    engine = schema.db.create_engine('sqlite:///' + fn, {})
+    schema.db.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(schema.Experiment.__table__.insert().values(id=1, name='LHCb'))
+        connection.execute(schema.Conference.__table__.insert().values(
+            id=1, name='Moriond', venue='La Thuile', start_date=datetime.now()))
+        connection.execute(schema.Talk.__table__.insert().values(
+            id=1, title='Title', duration='10"', speaker='speaker@domain.org', n_submissions=0,
+            comment_count=0, experiment_id=1, conference_id=1, view_key='view', upload_key='upload'))
+
+
+def connect(fn, pragmas):
+    from talky import schema
+    # Use the same driver defaults as SQLAlchemy (including the 5 second timeout)
+    connection = sqlite3.connect(fn)
+    schema.apply_sqlite_pragmas(connection, pragmas)
+    return connection
+
+
+def writer(fn, pragmas, duration, results):
+    connection = connect(fn, pragmas)
+    n_ok = n_locked = 0
+    end = time.time() + duration
+    while time.time() < end:
+        try:
+            with connection:
+                connection.execute(
+                    'INSERT INTO comment (name, email, comment, time, talk_id, path, depth) '
+                    'VALUES (?, ?, ?, ?, 1, ?, 0)',
+                    ('Name', 'first.last@domain.org', 'Comment ' * 50, datetime.now(), '')
+                )
+                connection.execute('UPDATE talk SET comment_count = comment_count + 1 WHERE id = 1')
+        except sqlite3.OperationalError:
+            n_locked += 1
+        else:
+            n_ok += 1
+    results.put(('write', n_ok, n_locked))
+
+
+def reader(fn, pragmas, duration, results):
+    connection = connect(fn, pragmas)
+    n_ok = n_locked = 0
+    end = time.time() + duration
+    while time.time() < end:
+        try:
+            connection.execute('SELECT * FROM talk WHERE id = 1').fetchall()
+            connection.execute(
+                'SELECT * FROM comment WHERE talk_id = 1 ORDER BY path DESC LIMIT 50').fetchall()
+        except sqlite3.OperationalError:
+            n_locked += 1
+        else:
+            n_ok += 1
+    results.put(('read', n_ok, n_locked))
+
+
+def benchmark(name, pragmas, n_writers, n_readers, duration):
+    fd, fn = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    try:
+        prepare_db(fn, pragmas)
+        ctx = multiprocessing.get_context('fork')
+        results = ctx.Queue()
+        processes = (
+            [ctx.Process(target=writer, args=(fn, pragmas, duration, results)) for i in range(n_writers)] +
+            [ctx.Process(target=reader, args=(fn, pragmas, duration, results)) for i in range(n_readers)]
+        )
+        for p in processes:
+            p.start()
+        totals = {'read': [0, 0], 'write': [0, 0]}
+        for p in processes:
+            kind, n_ok, n_locked = results.get()
+            totals[kind][0] += n_ok
+            totals[kind][1] += n_locked
+        for p in processes:
+            p.join()
+    finally:
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.isfile(fn + suffix):
+                os.unlink(fn + suffix)
+
+    print(f'{name}:')
+    for kind, (n_ok, n_locked) in totals.items():
+        print(f'    {kind:5}  {n_ok / duration:10.1f} ops/s  {n_locked:8d} "database is locked" errors')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='SQLite pragma benchmark')
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10)
+    args = parser.parse_args()
+
+    from talky import default_config
+    benchmark('SQLite defaults', {}, args.writers, args.readers, args.duration)
+    benchmark('SQLITE_PRAGMAS', default_config.SQLITE_PRAGMAS, args.writers, args.readers, args.duration)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""Measure the startup cost of a worker with and without the template bytecode cache"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+# Run in a fresh interpreter so nothing has been compiled already
+WORKER = '''
+import json, sys, tempfile, time
+start = time.perf_counter()
+import talky
+from talky import template_cache
+imported = time.perf_counter()
+
+talky.app.config['TEMPLATE_CACHE_DIR'] = sys.argv[1] or None
+talky.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + sys.argv[2]
+talky.app.config['FILE_PATH'] = tempfile.mkdtemp()
+template_cache.setup_bytecode_cache()
+if sys.argv[3] == 'precompile':
+    template_cache.precompile()
+ready = time.perf_counter()
+
+with talky.app.app_context():
+    talk = talky.schema.Talk.query.first()
+    url = f'/view/{talk.id}/{talk.view_key}/'
+client = talky.app.test_client()
+before = time.perf_counter()
+assert client.get(url).status_code == 200
+first_request = time.perf_counter() - before
+print(json.dumps([imported - start, ready - imported, first_request]))
+'''
+
+
+def build_db(fn):
+    import talky
+    from talky import create_database
+    talky.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + fn
+    talky.app.config['FILE_PATH'] = tempfile.mkdtemp()
+    with talky.app.app_context():
+        create_database.build_sample_db(fast=True)
+
+
+def run_worker(cache_dir, db_fn, mode):
+    env = dict(os.environ, MPLBACKEND='Agg')
+    output = subprocess.run(
+        [sys.executable, '-c', WORKER, cache_dir or '', db_fn, mode],
+        check=True, stdout=subprocess.PIPE, env=env
+    ).stdout
+    return json.loads(output.decode().splitlines()[-1])
+
+
+def main(repeats):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        db_fn = os.path.join(tmp_dir, 'talky.sqlite')
+        build_db(db_fn)
+        cache_dir = os.path.join(tmp_dir, 'cache')
+
+        print(f'{"":<28} {"import":>8} {"startup":>8} {"1st req":>8}  (median of {repeats}, ms)')
+        for label, use_cache, clear, mode in [
+            ('lazy, no cache', False, False, 'lazy'),
+            ('precompile, no cache', False, False, 'precompile'),
+            ('precompile, cold cache', True, True, 'precompile'),
+            ('precompile, warm cache', True, False, 'precompile'),
+            ('lazy, warm cache', True, False, 'lazy'),
+        ]:
+            results = []
+            for _ in range(repeats):
+                if clear:
+                    shutil.rmtree(cache_dir, ignore_errors=True)
+                results.append(run_worker(cache_dir if use_cache else None, db_fn, mode))
+            medians = [statistics.median(r[i] for r in results) * 1000 for i in range(3)]
+            print(f'{label:<28} ' + ' '.join(f'{m:8.1f}' for m in medians))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+    main(args.repeats)
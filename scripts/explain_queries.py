@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+import argparse
+
+from sqlalchemy import desc
+from sqlalchemy.orm import aliased
+
+
+def hot_queries(talk_id, experiment_name):
+    """Queries issued by view_talk, view_submission and the UserHomeView listings"""
+    from talky import schema
+    Talk, Comment, Submission = schema.Talk, schema.Comment, schema.Submission
+    Conference, Experiment = schema.Conference, schema.Experiment
+    interesting_to = aliased(Experiment)
+
+    def listing(query=Talk.query):
+        return query.join(Talk.conference).order_by(desc(Conference.start_date)).limit(20)
+
+    return {
+        'view_talk: talk': Talk.query.filter(Talk.id == talk_id),
+        'view_talk: comments': Comment.query.filter(Comment.talk_id == talk_id).order_by(Comment.time),
+        'view_talk: submissions': Submission.query.filter(Submission.talk_id == talk_id).order_by(Submission.time),
+        'view_submission': Submission.query.filter(Submission.talk_id == talk_id, Submission.version == 1),
+        'listing: all': listing(),
+        'listing: given': listing(Talk.query.join(Talk.experiment).filter(Experiment.name == experiment_name)),
+        'listing: flagged': listing(Talk.query.join(interesting_to, Talk.interesting_to).filter(
+            interesting_to.name == experiment_name)),
+        'listing: interesting_to': Experiment.query.join(Experiment.interesting_talks).filter(Talk.id == talk_id),
+        'listing: categories': schema.Category.query.join(schema.Category.talks).filter(Talk.id == talk_id),
+    }
+
+
+def query_plan(query):
+    """Return the rows of SQLite's EXPLAIN QUERY PLAN for a query"""
+    from talky import schema
+    compiled = query.statement.compile(dialect=schema.db.engine.dialect)
+    params = [compiled.params[k] for k in compiled.positiontup]
+    cursor = schema.db.session.connection().connection.cursor()
+    cursor.execute('EXPLAIN QUERY PLAN ' + str(compiled), params)
+    return [row[-1] for row in cursor.fetchall()]
+
+
+def explain_queries(fn, talk_id, experiment_name):
+    import talky
+    talky.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + fn
+    with talky.app.app_context():
+        for name, query in hot_queries(talk_id, experiment_name).items():
+            print(name)
+            for detail in query_plan(query):
+                print('   ', detail)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='Query plan checker')
+    parser.add_argument('db', help='DB to inspect')
+    parser.add_argument('--talk-id', type=int, default=1)
+    parser.add_argument('--experiment', default='LHCb')
+    args = parser.parse_args()
+    explain_queries(args.db, args.talk_id, args.experiment)
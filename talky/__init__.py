@@ -7,6 +7,7 @@ from .schema import db
 from . import login
 from . import interface
 from . import database_events
+from .template_cache import setup_bytecode_cache
 
 __all__ = [
     'app', 'mail', 'db', 'login', 'database_events'
@@ -24,3 +25,4 @@ logger.addHandler(handler)
 
 
 interface.create_interface(app, login.security)
+setup_bytecode_cache()
@@ -1,18 +1,53 @@
 import argparse
 
 from .create_database import build_sample_db, build_production_db
+from .upgrade_database import upgrade_db, repair_counters
+from .search import rebuild_index
+from .storage import dedupe_files
+from .previews import rebuild_previews
+from .outbox import send_emails
+from .live import run_hub
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--production', action='store_true')
-    parser.add_argument('--sample', action='store_true')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--production', action='store_true')
+    group.add_argument('--sample', action='store_true')
+    group.add_argument('--upgrade', action='store_true',
+                       help='Upgrade an existing database to the current schema')
+    group.add_argument('--repair-counters', action='store_true',
+                       help='Recompute the comment count and latest activity of every talk')
+    group.add_argument('--rebuild-search', action='store_true',
+                       help='Rebuild the full-text search index of talks and comments')
+    group.add_argument('--dedupe-files', action='store_true',
+                       help='Move submission files into the blob store, hardlinking duplicates')
+    group.add_argument('--rebuild-previews', action='store_true',
+                       help='Render the preview images of every submission')
+    group.add_argument('--send-emails', action='store_true',
+                       help='Handle the pending events and send the emails in the outbox which are due')
+    group.add_argument('--live-hub', action='store_true',
+                       help='Serve the server-sent events of talk pages to nginx')
 
     args = parser.parse_args()
-    if args.sample == args.production:
-        raise ValueError('Invalid arguments passed')
-
     if args.production:
         build_production_db()
     elif args.sample:
         build_sample_db()
+    elif args.upgrade:
+        upgrade_db()
+    elif args.repair_counters:
+        repair_counters()
+    elif args.rebuild_search:
+        rebuild_index()
+    elif args.dedupe_files:
+        n_files, n_bytes = dedupe_files()
+        print(f'Processed {n_files} submission files and reclaimed {n_bytes / 1024**2:.1f} MiB')
+    elif args.rebuild_previews:
+        n_rendered = rebuild_previews()
+        print(f'Rendered previews of {n_rendered} submissions')
+    elif args.send_emails:
+        n_sent, n_failed = send_emails()
+        print(f'Sent {n_sent} emails, {n_failed} failed')
+    elif args.live_hub:
+        run_hub()
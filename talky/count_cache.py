@@ -0,0 +1,62 @@
+from collections import OrderedDict
+from threading import Lock
+import time
+
+from sqlalchemy import select
+from sqlalchemy.orm import Query
+
+from .talky import app
+from .schema import ChangeCounter
+
+
+__all__ = [
+    'CountQuery',
+    'invalidate',
+]
+
+
+_lock = Lock()
+# Maps (database, SQL, parameters) to (count, generation, time)
+_counts = OrderedDict()
+
+counter = ChangeCounter.__table__
+
+
+def invalidate(session):
+    """Mark the counts cached by every process as out of date once session is committed"""
+    session.execute(counter.update().values(value=counter.c.value + 1))
+
+
+class CountQuery(Query):
+    """Query for the number of rows shown in a list view which caches the result
+
+    Cached counts are reused for up to COUNT_CACHE_TIMEOUT seconds as long as
+    the database hasn't been changed by any process, which is checked with a
+    single row lookup. If APPROXIMATE_COUNTS is set changes are only picked up
+    by the timeout so most requests don't need to query the database at all.
+    """
+    def scalar(self):
+        timeout = app.config['COUNT_CACHE_TIMEOUT']
+        if not timeout:
+            return super(CountQuery, self).scalar()
+
+        compiled = self.statement.compile(self.session.get_bind())
+        key = (str(self.session.get_bind().url), str(compiled), repr(sorted(compiled.params.items())))
+        with _lock:
+            count, cached_generation, cached_time = _counts.get(key, (None, None, None))
+        cached = cached_time is not None and time.monotonic() - cached_time < timeout
+        if cached and app.config['APPROXIMATE_COUNTS']:
+            return count
+
+        # Read before counting so a change committed in between leaves the count out of date
+        generation = self.session.execute(select([counter.c.value])).scalar()
+        if cached and cached_generation == generation:
+            return count
+
+        count = super(CountQuery, self).scalar()
+        with _lock:
+            _counts[key] = (count, generation, time.monotonic())
+            _counts.move_to_end(key)
+            while len(_counts) > app.config['COUNT_CACHE_SIZE']:
+                _counts.popitem(last=False)
+        return count
@@ -9,9 +9,10 @@ from matplotlib import pyplot as plt
 from flask_security.utils import encrypt_password
 import lipsum
 
-from .talky import app, mail
+from .talky import app
 from .login import user_datastore
 from .schema import db, Role, Experiment, Conference, Comment, Submission, Category, Talk, Contact
+from . import events
 
 
 __all__ = [
@@ -109,8 +110,11 @@ def build_sample_db(fast=False):
     # Set a seed to avoid flakiness
     random.seed(42)
     # Prevent sending email
-    _send = mail.send
-    mail.send = lambda msg: None
+    with events.suppressed():
+        _build_sample_db(fast)
+
+
+def _build_sample_db(fast):
 
     db.drop_all()
     db.create_all()
@@ -223,6 +227,3 @@ def build_sample_db(fast=False):
             make_submissions(first_names, conference, talk)
 
         db.session.commit()
-
-    # Restore mail sending functionality
-    mail.send = _send
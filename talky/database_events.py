@@ -1,26 +1,243 @@
 import os
-from os.path import join
+from os.path import dirname
 import secrets
 
 from sqlalchemy.event import listens_for
-from sqlalchemy import inspect
+from sqlalchemy import inspect, select, and_, or_, case, func
+from sqlalchemy.orm import object_session
+from sqlalchemy.orm.attributes import set_committed_value
 
 from .talky import app
-from .schema import db, Submission, Talk, Comment
+from .schema import db, Submission, Talk, Comment, Conference, Experiment
+from . import events
 from . import messages
+from . import search
+from . import count_cache
+from . import storage
+from . import previews
 
 
 @listens_for(Submission, 'after_delete')
 def delete_file(mapper, connection, target):
-    """Delete files if a submission has been deleted"""
+    """Remember the files of deleted submissions so they are removed once the deletion is committed"""
     if target.filename and app.config['CLEANUP_FILES']:
+        object_session(target).info.setdefault('deleted_files', []).append(
+            (target.talk_id, target.version, target.filename, target.sha256)
+        )
+
+
+@listens_for(db.session, 'after_commit')
+def delete_files_after_commit(session):
+    """Delete files and previews of deleted submissions, and their blobs once they are unused"""
+    for talk_id, version, filename, sha256 in session.info.pop('deleted_files', []):
+        submission_fn = storage.submission_path(talk_id, version, filename)
+        previews.remove_previews(talk_id, version)
         try:
-            os.remove(join(app.config['FILE_PATH'], str(target.talk.id),
-                      str(target.version), target.filename))
+            os.remove(submission_fn)
+            os.rmdir(dirname(submission_fn))
         except OSError:
             # We don't care if wasn't deleted because it does not exist
             pass
 
+        submissions = Submission.__table__
+        with db.engine.connect() as connection:
+            in_use = connection.execute(
+                select([func.count()]).where(submissions.c.sha256 == sha256)
+            ).scalar()
+        if sha256 and not in_use:
+            storage.remove_blob(sha256)
+
+
+@listens_for(db.session, 'after_rollback')
+def delete_files_after_rollback(session):
+    # The submissions are restored so keep their files
+    session.info.pop('deleted_files', None)
+
+
+@listens_for(Comment, 'after_insert')
+def set_comment_path(mapper, connection, target):
+    """Store the materialized path and depth of new comments"""
+    comments = Comment.__table__
+    if target.parent_comment_id is None:
+        parent_path, depth = '', 0
+    else:
+        parent_path, parent_depth = connection.execute(
+            select([comments.c.path, comments.c.depth])
+            .where(comments.c.id == target.parent_comment_id)
+        ).first()
+        depth = parent_depth + 1
+    path = parent_path + Comment.path_segment(target.id)
+
+    connection.execute(
+        comments.update()
+        .where(comments.c.id == target.id)
+        .values(path=path, depth=depth)
+    )
+    set_committed_value(target, 'path', path)
+    set_committed_value(target, 'depth', depth)
+
+
+@listens_for(Comment, 'after_delete')
+def delete_replies(mapper, connection, target):
+    """Delete all replies to a comment with a single range query"""
+    comments = Comment.__table__
+    session = object_session(target)
+    # Replies which are loaded in the session are deleted by the ORM
+    scheduled = [c.id for c in session.deleted if isinstance(c, Comment)]
+    replies = and_(
+        Comment.subtree_filter(target.talk_id, target.path),
+        comments.c.id != target.id,
+        comments.c.id.notin_(scheduled)
+    )
+    # The mapper hooks aren't called for these so record their removal here
+    reply_ids = [reply_id for reply_id, in connection.execute(select([comments.c.id]).where(replies))]
+    search.unindex_replies(connection, target.talk_id, target.path)
+    result = connection.execute(comments.delete().where(replies))
+    for reply_id in reply_ids:
+        events.record(session, events.TalkActivity(target.talk_id, 'comment-deleted', reply_id))
+
+    talks = Talk.__table__
+    connection.execute(
+        talks.update()
+        .where(talks.c.id == target.talk_id)
+        .values(
+            comment_count=talks.c.comment_count - 1 - result.rowcount,
+            last_activity=last_activity(talks.c.id)
+        )
+    )
+
+
+@listens_for(Talk, 'after_insert')
+@listens_for(Talk, 'after_update')
+def index_talk(mapper, connection, target):
+    """Keep the full-text index of talks up to date"""
+    state = inspect(target)
+    if state.attrs.title.history.has_changes() or state.attrs.abstract.history.has_changes() \
+            or state.attrs.speaker.history.has_changes():
+        search.index_talk(connection, target)
+
+
+@listens_for(Talk, 'after_delete')
+def unindex_talk(mapper, connection, target):
+    search.unindex_talk(connection, target.id)
+
+
+@listens_for(Comment, 'after_insert')
+@listens_for(Comment, 'after_update')
+def index_comment(mapper, connection, target):
+    """Keep the full-text index of comments up to date"""
+    state = inspect(target)
+    if state.attrs.name.history.has_changes() or state.attrs.comment.history.has_changes():
+        search.index_comment(connection, target)
+
+
+@listens_for(Comment, 'after_delete')
+def unindex_comment(mapper, connection, target):
+    search.unindex_comment(connection, target.id)
+
+
+@listens_for(Comment, 'after_insert')
+def comment_added(mapper, connection, target):
+    """Update the activity summary of the talk"""
+    talks = Talk.__table__
+    connection.execute(
+        talks.update()
+        .where(talks.c.id == target.talk_id)
+        .values(
+            comment_count=talks.c.comment_count + 1,
+            last_activity=latest(talks.c.last_activity, target.time)
+        )
+    )
+
+
+@listens_for(Submission, 'after_insert')
+def submission_added(mapper, connection, target):
+    """Update the activity summary of the talk"""
+    talks = Talk.__table__
+    connection.execute(
+        talks.update()
+        .where(talks.c.id == target.talk_id)
+        .values(
+            latest_submission_id=latest_submission_id(talks.c.id),
+            last_activity=latest(talks.c.last_activity, target.time)
+        )
+    )
+
+
+@listens_for(Submission, 'after_delete')
+def submission_removed(mapper, connection, target):
+    """Update the activity summary of the talk"""
+    talks = Talk.__table__
+    connection.execute(
+        talks.update()
+        .where(talks.c.id == target.talk_id)
+        .values(
+            latest_submission_id=latest_submission_id(talks.c.id),
+            last_activity=last_activity(talks.c.id)
+        )
+    )
+
+
+@listens_for(Comment, 'after_insert')
+@listens_for(Submission, 'after_insert')
+def activity_added(mapper, connection, target):
+    """Push new comments and submissions to open talk pages, see live.py"""
+    kind = ACTIVITY_KINDS[type(target)]
+    events.record(object_session(target), events.TalkActivity(target.talk_id, kind, target.id))
+
+
+@listens_for(Comment, 'after_delete')
+@listens_for(Submission, 'after_delete')
+def activity_removed(mapper, connection, target):
+    kind = ACTIVITY_KINDS[type(target)]
+    events.record(object_session(target), events.TalkActivity(target.talk_id, f'{kind}-deleted', target.id))
+
+
+ACTIVITY_KINDS = {
+    Comment: 'comment',
+    Submission: 'submission',
+}
+
+
+def latest(a, b):
+    """SQL expression for the latest of two, possibly NULL, times"""
+    return case([(a > b, a)], else_=func.coalesce(b, a))
+
+
+def comment_count(talk_id):
+    comments = Comment.__table__
+    return select([func.count()]).where(comments.c.talk_id == talk_id).as_scalar()
+
+
+def latest_submission_id(talk_id):
+    submissions = Submission.__table__
+    return (
+        select([submissions.c.id])
+        .where(submissions.c.talk_id == talk_id)
+        .order_by(submissions.c.time.desc(), submissions.c.id.desc())
+        .limit(1)
+        .as_scalar()
+    )
+
+
+def last_activity(talk_id):
+    """SQL expression for the time of the latest comment or submission"""
+    comments, submissions = Comment.__table__, Submission.__table__
+    return latest(
+        select([func.max(comments.c.time)]).where(comments.c.talk_id == talk_id).as_scalar(),
+        select([func.max(submissions.c.time)]).where(submissions.c.talk_id == talk_id).as_scalar()
+    )
+
+
+def repair_talk_counters(connection):
+    """Recompute the activity summary of every talk"""
+    talks = Talk.__table__
+    connection.execute(talks.update().values(
+        comment_count=comment_count(talks.c.id),
+        latest_submission_id=latest_submission_id(talks.c.id),
+        last_activity=last_activity(talks.c.id)
+    ))
+
 
 @listens_for(db.session, 'before_flush')
 def monitor_db_before_flush(session, flush_context, instances):
@@ -44,41 +261,101 @@ def update_upload_key(talk):
 @listens_for(db.session, 'after_flush')
 def monitor_db_after_flush(session, flush_context):
     """Monitor for changes in the database"""
+    if session.new or session.dirty or session.deleted:
+        count_cache.invalidate(session)
+        bump_cache_versions(session)
     changed_objects = session.new.union(session.dirty)
     for obj in changed_objects:
+        route = EVENT_ROUTES.get(type(obj))
+        if route is not None:
+            route(session, obj)
+
+
+def bump_cache_versions(session):
+    """Increment the cache version of every talk whose page has changed"""
+    talk_ids, conference_ids, experiment_ids = set(), set(), set()
+    for obj in session.new.union(session.dirty).union(session.deleted):
         if isinstance(obj, Talk):
-            talk_changed(obj)
-        if isinstance(obj, Submission):
-            submission_received(obj)
-        if isinstance(obj, Comment):
-            new_comment(obj)
+            talk_ids.add(obj.id)
+        elif isinstance(obj, (Submission, Comment)):
+            talk_ids.add(obj.talk_id)
+        elif isinstance(obj, Conference):
+            conference_ids.add(obj.id)
+        elif isinstance(obj, Experiment):
+            experiment_ids.add(obj.id)
 
+    talks = Talk.__table__
+    conditions = [
+        column.in_(ids) for column, ids in [
+            (talks.c.id, talk_ids),
+            (talks.c.conference_id, conference_ids),
+            (talks.c.experiment_id, experiment_ids),
+        ] if ids
+    ]
+    if conditions:
+        session.execute(
+            talks.update()
+            .where(or_(*conditions))
+            .values(cache_version=func.coalesce(talks.c.cache_version, 0) + 1)
+        )
 
-def talk_changed(talk):
+
+def talk_changed(session, talk):
     """If the speaker changes notify them"""
     attribute_state = inspect(talk).attrs.get('speaker')
     # Check if the speaker has been updated
     history = attribute_state.history
     if history.has_changes():
-        # Send a new email to the speaker
-        messages.send_talk_assgined(talk)
+        events.record(session, events.SpeakerAssigned(talk.id))
 
 
-def submission_received(submission):
+def submission_received(session, submission):
     """Send notifications if this is the first submission"""
     attribute_state = inspect(submission).attrs.get('version')
     # Check if the speaker has been updated
     history = attribute_state.history
     # TODO Check for insert rather than assuming the version is immutable
     if history.has_changes() and submission.version == 1:
-        messages.send_new_talk_available(submission)
+        events.record(session, events.TalkUploaded(submission.id))
 
 
-def new_comment(comment):
+def new_comment(session, comment):
     """Send notifications of new comments"""
     attribute_state = inspect(comment).attrs.get('comment')
     # Check if the speaker has been updated
     history = attribute_state.history
     # TODO Check for insert rather than assuming the comment is immutable
     if history.has_changes():
+        events.record(session, events.CommentPosted(comment.id))
+
+
+# The function which records the events caused by changing each type of object
+EVENT_ROUTES = {
+    Talk: talk_changed,
+    Submission: submission_received,
+    Comment: new_comment,
+}
+
+
+@events.subscribe(events.SpeakerAssigned)
+def notify_speaker(session, batch):
+    for talk in load(session, Talk, [e.talk_id for e in batch]):
+        messages.send_talk_assgined(talk)
+
+
+@events.subscribe(events.TalkUploaded)
+def notify_talk_uploaded(session, batch):
+    for submission in load(session, Submission, [e.submission_id for e in batch]):
+        messages.send_new_talk_available(submission)
+
+
+@events.subscribe(events.CommentPosted)
+def notify_comment(session, batch):
+    for comment in load(session, Comment, [e.comment_id for e in batch]):
         messages.send_new_comment(comment)
+
+
+def load(session, model, ids):
+    """Load the objects referred to by a batch of events, skipping any which have since been deleted"""
+    objects = {obj.id: obj for obj in session.query(model).filter(model.id.in_(ids))}
+    return [objects[i] for i in ids if i in objects]
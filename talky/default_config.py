@@ -15,6 +15,21 @@ TALKY_DOMAIN = 'http://localhost:5000'
 # Create secret key so we can use sessions
 SECRET_KEY = 'CHANGE_ME'
 
+# Set to the prefix of an internal nginx location which serves FILE_PATH to
+# send submissions with X-Accel-Redirect rather than from the Python worker
+SUBMISSION_X_ACCEL_REDIRECT = None
+
+# Compiled templates are stored in TEMPLATE_CACHE_DIR so they are shared between
+# workers and reused after restarts, set to None to disable the cache
+TEMPLATE_CACHE_DIR = abspath(join(dirname(__file__), 'template_cache'))
+
+# Thumbnails of the first page and a strip of the first PREVIEW_PAGES pages are
+# rendered for each submission by a pool of PREVIEW_WORKERS threads in each
+# process using pdftoppm (from poppler-utils), set to 0 to disable previews
+PREVIEW_WORKERS = 2
+PREVIEW_PAGES = 6
+PREVIEW_COMMAND = 'pdftoppm'
+
 # Limit uploads to 16MB
 MAX_CONTENT_LENGTH = 16 * 1024 * 1024
 
@@ -23,6 +38,97 @@ DATABASE_FILE = 'sample_db.sqlite'
 SQLALCHEMY_DATABASE_URI = 'sqlite:///' + DATABASE_FILE
 SQLALCHEMY_ECHO = False
 
+# Settings applied to every new SQLite connection (see sqlite.org/pragma.html),
+# WAL lets readers continue while another worker writes and busy_timeout makes
+# writers wait for the lock rather than failing with "database is locked".
+# Set to {} to use the SQLite defaults.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'busy_timeout': 10000,
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -16000,
+    'temp_store': 'MEMORY',
+}
+
+# Routes which only read from the database (talk pages and listings) use a
+# separate read-only session. Set READ_ONLY_DATABASE_URI to send them to a
+# replica, otherwise SQLite databases are reopened in read-only mode and any
+# other database falls back to using SQLALCHEMY_DATABASE_URI.
+READ_ONLY_DATABASE_URI = None
+
+# Maximum total size in characters of the rendered talk pages kept in memory
+# by each process, set to 0 to disable caching talk pages
+TALK_PAGE_CACHE_SIZE = 32 * 1024 * 1024
+
+# Talk pages include COMMENT_INLINE_DEPTH levels of replies, deeper replies and
+# comments with more than COMMENT_INLINE_REPLIES replies in total are shown
+# collapsed and their replies are only loaded when requested
+COMMENT_INLINE_DEPTH = 6
+COMMENT_INLINE_REPLIES = 50
+# Talk pages check for new comments and submissions this often in seconds, set
+# to 0 to only show them when the page is reloaded
+TALK_POLL_INTERVAL = 30
+# New comments and submissions are pushed to open talk pages with server-sent
+# events. With LIVE_EVENTS = 'hub' the workers send them to the process started
+# by "python -m talky --live-hub", which nginx proxies LIVE_X_ACCEL_REDIRECT to.
+# With 'local' each process streams its own events using a thread per open
+# page, which is only suitable for development. None disables them.
+LIVE_EVENTS = 'hub'
+LIVE_X_ACCEL_REDIRECT = '/live-events/'
+LIVE_SOCKET = '/tmp/talky-live.sock'
+LIVE_PUBLISH_SOCKET = '/tmp/talky-live-publish.sock'
+# Seconds between the messages which keep idle connections open
+LIVE_HEARTBEAT = 25
+
+# Talk listings are paged with a cursor so don't need the total number of
+# talks, set to True to count them anyway (costs an extra query per page)
+LISTING_EXACT_COUNT = False
+
+# Default and maximum number of rows returned per page by /secure/api/
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+
+# CSV and XLSX exports of the talk listing load this many talks at a time
+EXPORT_BATCH_SIZE = 1000
+
+# The number of rows in list views is cached until any process modifies the
+# database or for COUNT_CACHE_TIMEOUT seconds (set to 0 to disable caching).
+# APPROXIMATE_COUNTS keeps using cached counts after modifications so most
+# pages only need a single query, at the cost of the count being out of date.
+COUNT_CACHE_TIMEOUT = 60
+COUNT_CACHE_SIZE = 1000
+APPROXIMATE_COUNTS = False
+
+# Changes which cause notifications are recorded as events in the same
+# transaction and handled by a pool of EVENT_WORKERS threads in each process
+# once the change has been committed, or before the commit returns if
+# EVENT_WORKERS = 0. Events left over by a process which died are handled by
+# the outbox (see MAIL_WORKERS). Failures are retried after EVENT_RETRY_DELAY
+# seconds, doubling each time, up to EVENT_MAX_ATTEMPTS.
+EVENT_WORKERS = 2
+EVENT_RETRY_DELAY = 60
+EVENT_MAX_ATTEMPTS = 8
+
+# Notifications are written to an outbox table and sent by a pool of MAIL_WORKERS threads in each
+# process. With MAIL_WORKERS = 0 they are only sent by running
+# "python -m talky --send-emails", e.g. from cron. BCC lists are split between
+# messages of at most MAIL_MAX_BCC addresses and failed messages are retried
+# after MAIL_RETRY_DELAY seconds, doubling each time, up to MAIL_MAX_ATTEMPTS.
+MAIL_WORKERS = 2
+MAIL_MAX_BCC = 50
+MAIL_RETRY_DELAY = 60
+MAIL_MAX_ATTEMPTS = 8
+# Messages which are being sent are retried if they are not sent within this
+# many seconds, e.g. if the process sending them is killed
+MAIL_SEND_TIMEOUT = 600
+# Sent messages are kept in the outbox for this many days
+MAIL_OUTBOX_RETENTION_DAYS = 30
+# If set, notifications of new comments and uploads are collected for this many
+# seconds and sent to each recipient as a single digest email. Speakers are
+# still told immediately when they are assigned to a talk.
+MAIL_DIGEST_INTERVAL = 0
+
 # Flask-Mail config
 MAIL_SERVER = 'CHANGE_ME'
 MAIL_PORT = 465
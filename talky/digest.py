@@ -0,0 +1,108 @@
+from datetime import datetime, timedelta
+import logging as log
+
+from sqlalchemy import and_, func, select
+
+from . import messages
+from . import outbox
+from .talky import app
+from .schema import db, DigestItem
+
+
+__all__ = [
+    'enabled',
+    'add',
+    'send_due_digests',
+    'next_due',
+]
+
+
+items = DigestItem.__table__
+
+
+def enabled():
+    return bool(app.config['MAIL_DIGEST_INTERVAL'])
+
+
+def add(session, recipients, subject, url, summary=''):
+    """Queue a notification for the next digest of each recipient
+
+    Nothing is rendered until the digest is sent so each notification only
+    costs a row per recipient.
+    """
+    recipients = sorted(set(recipients))
+    if not recipients:
+        log.info(f'Not adding "{subject}" to any digests as it has no recipients')
+        return
+    now = datetime.now()
+    session.execute(items.insert(), [
+        dict(recipient=recipient, subject=subject, url=url, summary=summary[:1000], created=now)
+        for recipient in recipients
+    ])
+    # Wake the sender so it schedules the digests
+    session.info['outbox'] = True
+
+
+def send_due_digests():
+    """Move a digest into the outbox for each recipient whose oldest notification has waited MAIL_DIGEST_INTERVAL
+
+    Returns the number of digests which were queued.
+    """
+    cutoff = datetime.now() - timedelta(seconds=app.config['MAIL_DIGEST_INTERVAL'])
+    with db.engine.connect() as connection:
+        recipients = [recipient for recipient, in connection.execute(
+            select([items.c.recipient])
+            .group_by(items.c.recipient)
+            .having(func.min(items.c.created) <= cutoff)
+        )]
+
+    n_digests = 0
+    for recipient in recipients:
+        with db.engine.connect() as connection:
+            with connection.begin() as transaction:
+                rows = connection.execute(
+                    select([items])
+                    .where(items.c.recipient == recipient)
+                    .order_by(items.c.created, items.c.id)
+                ).fetchall()
+                if not rows:
+                    continue
+                # Another worker has already sent this digest if its items are gone
+                result = connection.execute(items.delete().where(and_(
+                    items.c.recipient == recipient,
+                    items.c.id <= max(row.id for row in rows)
+                )))
+                if result.rowcount != len(rows):
+                    transaction.rollback()
+                    continue
+                subject, html = render_digest(rows)
+                outbox.enqueue(connection, subject, html, recipients=[recipient])
+                n_digests += 1
+
+    if n_digests:
+        log.info(f'Queued {n_digests} digest emails')
+    return n_digests
+
+
+def render_digest(rows):
+    if len(rows) == 1:
+        subject = rows[0].subject
+    else:
+        subject = f'{len(rows)} new notifications from Talky'
+    html = messages.inline_css(messages.env.get_template('digest.html').render(
+        subject=subject,
+        items=rows,
+        domain=app.config['TALKY_DOMAIN']
+    ))
+    return subject, html
+
+
+def next_due():
+    """When the oldest pending notification should be sent as part of a digest"""
+    if not enabled():
+        return None
+    with db.engine.connect() as connection:
+        oldest = connection.execute(select([func.min(items.c.created)])).scalar()
+    if oldest is None:
+        return None
+    return oldest + timedelta(seconds=app.config['MAIL_DIGEST_INTERVAL'])
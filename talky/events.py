@@ -0,0 +1,265 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import json
+import logging as log
+import os
+import threading
+
+from sqlalchemy import and_, func, select
+from sqlalchemy.event import listens_for
+
+from .talky import app
+from .schema import db, PendingEvent
+
+
+__all__ = [
+    'SpeakerAssigned',
+    'TalkUploaded',
+    'CommentPosted',
+    'TalkActivity',
+    'subscribe',
+    'record',
+    'suppressed',
+    'batched',
+    'dispatch',
+    'wake',
+    'deliver_pending',
+    'next_due',
+]
+
+
+# Events only contain primary keys so they are cheap to record during a flush,
+# the subscribers load whatever else they need once the change is committed
+SpeakerAssigned = namedtuple('SpeakerAssigned', ['talk_id'])
+TalkUploaded = namedtuple('TalkUploaded', ['submission_id'])
+CommentPosted = namedtuple('CommentPosted', ['comment_id'])
+# A comment or submission was added or deleted, kind is e.g. 'comment-deleted'
+TalkActivity = namedtuple('TalkActivity', ['talk_id', 'kind', 'id'])
+
+# Events which are written to the database as part of the transaction which
+# caused them so they are handled even if the process dies after committing.
+# Others are only kept in memory and are lost in that case.
+PERSISTENT = {
+    event_type.__name__: event_type
+    for event_type in [SpeakerAssigned, TalkUploaded, CommentPosted]
+}
+
+pending = PendingEvent.__table__
+
+# Functions to call with the events of each type
+_subscribers = {}
+
+_local = threading.local()
+
+
+def subscribe(event_type):
+    """Decorator to call a function with each batch of events of event_type
+
+    Subscribers are called as func(session, events) after the change which
+    caused the events has been committed. The session is committed after each
+    subscriber returns, together with the removal of persistent events.
+    """
+    def decorator(func):
+        _subscribers.setdefault(event_type, []).append(func)
+        return func
+    return decorator
+
+
+def record(session, event):
+    """Dispatch event once the transaction of session is committed"""
+    if getattr(_local, 'suppressed', False):
+        return
+    if type(event).__name__ in PERSISTENT:
+        now = datetime.now()
+        session.execute(pending.insert().values(
+            type=type(event).__name__, payload=json.dumps(list(event)),
+            created=now, next_attempt=now, attempts=0
+        ))
+        session.info['pending_events'] = True
+    else:
+        session.info.setdefault('events', []).append(event)
+
+
+@contextmanager
+def suppressed():
+    """Discard the events recorded by this thread within the block, e.g. for sample data"""
+    previous = getattr(_local, 'suppressed', False)
+    _local.suppressed = True
+    try:
+        yield
+    finally:
+        _local.suppressed = previous
+
+
+@contextmanager
+def batched():
+    """Dispatch the events of every transaction committed within the block together"""
+    if getattr(_local, 'batch', None) is not None:
+        yield
+        return
+    _local.batch = []
+    _local.batch_pending = False
+    try:
+        yield
+        batch, batch_pending = _local.batch, _local.batch_pending
+    finally:
+        _local.batch = None
+    dispatch(batch)
+    if batch_pending:
+        wake()
+
+
+@listens_for(db.session, 'after_commit')
+def events_after_commit(session):
+    events = session.info.pop('events', None)
+    has_pending = session.info.pop('pending_events', False)
+    if getattr(_local, 'batch', None) is not None:
+        _local.batch.extend(events or [])
+        _local.batch_pending = _local.batch_pending or has_pending
+        return
+    if events:
+        dispatch(events)
+    if has_pending:
+        wake()
+
+
+@listens_for(db.session, 'after_rollback')
+def events_after_rollback(session):
+    # The persistent events are rolled back with the rest of the transaction
+    session.info.pop('events', None)
+    session.info.pop('pending_events', None)
+
+
+# The pool and the process it was created in, as uWSGI forks after importing talky
+_pool = (None, None)
+
+
+def get_pool():
+    global _pool
+    if _pool[0] != os.getpid():
+        _pool = (os.getpid(), ThreadPoolExecutor(
+            max_workers=app.config['EVENT_WORKERS'], thread_name_prefix='talky-events'
+        ))
+    return _pool[1]
+
+
+def dispatch(events):
+    """Call the subscribers of in-memory events in the background, or now if EVENT_WORKERS is 0"""
+    # Duplicates come from the same object being changed in several flushes
+    events = list(dict.fromkeys(events))
+    if not events:
+        return None
+    if not app.config['EVENT_WORKERS']:
+        return deliver(events)
+    return get_pool().submit(in_app_context, deliver, events)
+
+
+def wake():
+    """Handle the persistent events which are due in the background, or now if EVENT_WORKERS is 0"""
+    if not app.config['EVENT_WORKERS']:
+        return deliver_pending()
+    return get_pool().submit(in_app_context, deliver_pending)
+
+
+def in_app_context(func, *args):
+    # Not used when delivering synchronously as popping the context would
+    # remove the scoped session which is being committed
+    with app.app_context():
+        return func(*args)
+
+
+def deliver(events):
+    """Call the subscribers of each type of event with all of the events of that type"""
+    by_type = {}
+    for event in events:
+        by_type.setdefault(type(event), []).append(event)
+
+    # A new session as this may be called while the original is committing
+    session = db.session.session_factory()
+    try:
+        for event_type, batch in by_type.items():
+            for func in _subscribers.get(event_type, []):
+                try:
+                    func(session, batch)
+                    session.commit()
+                except Exception:
+                    session.rollback()
+                    log.exception(f'Failed to handle {len(batch)} {event_type.__name__} events with {func.__name__}')
+    finally:
+        session.close()
+
+
+def claim():
+    """Reserve the persistent events which are due so no other worker handles them"""
+    now = datetime.now()
+    lease = now + timedelta(seconds=app.config['EVENT_RETRY_DELAY'])
+    claimed = []
+    with db.engine.begin() as connection:
+        rows = connection.execute(
+            select([pending]).where(pending.c.next_attempt <= now).order_by(pending.c.id)
+        ).fetchall()
+        for row in rows:
+            # The lease expires, so the event is handled again, if this process dies
+            result = connection.execute(
+                pending.update()
+                .where(and_(pending.c.id == row.id, pending.c.next_attempt == row.next_attempt))
+                .values(next_attempt=lease, attempts=row.attempts + 1)
+            )
+            if result.rowcount == 1:
+                claimed.append(row)
+    return claimed
+
+
+def deliver_pending():
+    """Call the subscribers of the persistent events which are due
+
+    The events are removed in the same transaction as the changes made by
+    their subscribers. Returns the number of events which were handled.
+    """
+    by_type = {}
+    for row in claim():
+        by_type.setdefault(row.type, []).append(row)
+
+    n_handled = 0
+    session = db.session.session_factory()
+    try:
+        for type_name, rows in by_type.items():
+            try:
+                event_type = PERSISTENT[type_name]
+                batch = list(dict.fromkeys(event_type(*json.loads(row.payload)) for row in rows))
+                for func in _subscribers.get(event_type, []):
+                    func(session, batch)
+                session.execute(pending.delete().where(pending.c.id.in_([row.id for row in rows])))
+                session.commit()
+                n_handled += len(rows)
+            except Exception as e:
+                session.rollback()
+                log.exception(f'Failed to handle {len(rows)} {type_name} events')
+                record_failure(rows, e)
+    finally:
+        session.close()
+    return n_handled
+
+
+def record_failure(rows, error):
+    attempts = max(row.attempts for row in rows) + 1
+    ids = [row.id for row in rows]
+    with db.engine.begin() as connection:
+        if attempts >= app.config['EVENT_MAX_ATTEMPTS']:
+            log.error(f'Giving up handling events {ids} after {attempts} attempts: {error}')
+            connection.execute(pending.delete().where(pending.c.id.in_(ids)))
+        else:
+            delay = app.config['EVENT_RETRY_DELAY'] * 2 ** (attempts - 1)
+            connection.execute(
+                pending.update()
+                .where(pending.c.id.in_(ids))
+                .values(next_attempt=datetime.now() + timedelta(seconds=delay))
+            )
+
+
+def next_due():
+    """When the next persistent event should be handled, e.g. after a failure"""
+    with db.engine.connect() as connection:
+        return connection.execute(select([func.min(pending.c.next_attempt)])).scalar()
@@ -5,14 +5,16 @@ from flask_admin import helpers as admin_helpers
 from .. import schema
 
 from .views import make_view, UserView, AdminView
-from .views import DBCategoryView, DBContactView, DBConferenceView, DBTalkView
+from .views import DBCategoryView, DBContactView, DBConferenceView, DBTalkView, DBOutgoingEmailView
 from .home import UserHomeView
 from . import display
+from . import api
 
 
 __all__ = [
     'create_interface',
-    'display'
+    'display',
+    'api',
 ]
 
 
@@ -49,6 +51,7 @@ def create_interface(app, security):
     admin.add_view(make_view(AdminView, view=DBTalkView))
     admin.add_view(make_view(AdminView, db=schema.Submission))
     admin.add_view(make_view(AdminView, db=schema.Comment))
+    admin.add_view(make_view(AdminView, view=DBOutgoingEmailView))
 
     @security.context_processor
     def security_context_processor_user():
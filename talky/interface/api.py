@@ -0,0 +1,295 @@
+from datetime import date, datetime
+from functools import wraps
+import json
+
+from flask import request, Response
+from flask_security import current_user
+from sqlalchemy import and_, not_, exists
+from werkzeug.exceptions import BadRequest
+
+from ..talky import app
+from .. import schema
+from ..replica import read_only, get_session
+from .views import experiment_filter
+from .home import keyset_filter, decode_cursor
+
+
+__all__ = [
+    'ApiError',
+]
+
+Talk, Conference, Experiment = schema.Talk, schema.Conference, schema.Experiment
+Submission, Comment = schema.Submission, schema.Comment
+
+# Columns which can be selected with ?fields=a,b, the cursor columns are always loaded
+TALK_FIELDS = {
+    'id': Talk.id,
+    'title': Talk.title,
+    'duration': Talk.duration,
+    'speaker': Talk.speaker,
+    'abstract': Talk.abstract,
+    'experiment': Experiment.name,
+    'conference_id': Talk.conference_id,
+    'conference': Conference.name,
+    'conference_date': Conference.start_date,
+    'comment_count': Talk.comment_count,
+    'last_activity': Talk.last_activity,
+    'n_submissions': Talk.n_submissions,
+    'url': Talk.view_key,
+    # Loaded with a query per page
+    'interesting_to': None,
+    'categories': None,
+}
+TALK_DEFAULT_FIELDS = [
+    'id', 'title', 'duration', 'speaker', 'experiment', 'conference', 'conference_date',
+    'comment_count', 'last_activity', 'url'
+]
+
+CONFERENCE_FIELDS = {
+    'id': Conference.id,
+    'name': Conference.name,
+    'venue': Conference.venue,
+    'start_date': Conference.start_date,
+    'url': Conference.url,
+}
+
+SUBMISSION_FIELDS = {
+    'id': Submission.id,
+    'version': Submission.version,
+    'time': Submission.time,
+    'filename': Submission.filename,
+    'size': Submission.size,
+    'sha256': Submission.sha256,
+}
+
+COMMENT_FIELDS = {
+    'id': Comment.id,
+    'parent_comment_id': Comment.parent_comment_id,
+    'name': Comment.name,
+    'email': Comment.email,
+    'comment': Comment.comment,
+    'time': Comment.time,
+    'depth': Comment.depth,
+    'submission_version': Submission.version,
+}
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super(ApiError, self).__init__(message)
+        self.status = status
+
+
+def encode_json(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f'{value!r} is not JSON serializable')
+
+
+def json_response(payload, status=200):
+    # Compact separators make large pages noticeably smaller
+    return Response(
+        json.dumps(payload, separators=(',', ':'), default=encode_json),
+        status=status, mimetype='application/json'
+    )
+
+
+def api_route(rule):
+    """Register a read-only route which requires the same login as the talk listings"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not current_user.is_active or not current_user.is_authenticated:
+                return json_response({'error': 'Authentication required'}, 401)
+            if not current_user.has_role('user'):
+                return json_response({'error': 'Forbidden'}, 403)
+            try:
+                return json_response(func(*args, **kwargs))
+            except ApiError as e:
+                return json_response({'error': str(e)}, e.status)
+        return app.route(f'/secure/api{rule}')(read_only(wrapper))
+    return decorator
+
+
+def requested_fields(available, default=None):
+    fields = request.args.get('fields')
+    if not fields:
+        return list(default or available)
+    fields = fields.split(',')
+    unknown = [f for f in fields if f not in available]
+    if unknown:
+        raise ApiError(f'Unknown fields {", ".join(unknown)}, available fields are {", ".join(available)}')
+    return fields
+
+
+def page_size():
+    try:
+        limit = int(request.args.get('limit', app.config['API_PAGE_SIZE']))
+    except ValueError:
+        raise ApiError('limit must be an integer')
+    if not 1 <= limit <= app.config['API_MAX_PAGE_SIZE']:
+        raise ApiError(f'limit must be between 1 and {app.config["API_MAX_PAGE_SIZE"]}')
+    return limit
+
+
+def scoped_query(model, *columns):
+    """Query columns of model limited in the same way as UserView.get_query"""
+    query = get_session().query(*columns)
+    condition = experiment_filter(model)
+    return query if condition is None else query.filter(condition)
+
+
+def select_rows(query, fields, limit, cursor_of):
+    """Run query for a page of rows and convert them to dictionaries of fields
+
+    Returns the rows and the cursor of the next page, if there is one.
+    """
+    rows = query.limit(limit + 1).all()
+    next_cursor = cursor_of(rows[limit - 1]) if len(rows) > limit else None
+    return [
+        {field: row[i] for i, field in enumerate(fields)}
+        for row in rows[:limit]
+    ], next_cursor
+
+
+def view_filter(view):
+    """Condition matching the flagged, given and other talk listings of UserHomeView"""
+    flagged = exists().where(and_(
+        schema.interesting_talks_experiment.c.talk_id == Talk.id,
+        schema.interesting_talks_experiment.c.experiment_id == current_user.experiment_id
+    ))
+    if view == 'all':
+        return None
+    elif view == 'flagged':
+        return flagged
+    elif view == 'given':
+        return Talk.experiment_id == current_user.experiment_id
+    elif view == 'other':
+        return and_(Talk.experiment_id != current_user.experiment_id, not_(flagged))
+    raise ApiError('view must be one of flagged, given, other or all')
+
+
+def talk_query(fields):
+    columns = [TALK_FIELDS[f] for f in fields if TALK_FIELDS[f] is not None]
+    # Used for the cursor and the URL of the talk page
+    columns += [
+        Talk.id.label('cursor_id'),
+        Conference.start_date.label('cursor_date'),
+        Talk.view_key.label('cursor_key'),
+    ]
+    query = scoped_query(Talk, *columns).select_from(Talk).join(Conference, Talk.conference_id == Conference.id)
+    if 'experiment' in fields:
+        query = query.outerjoin(Experiment, Talk.experiment_id == Experiment.id)
+    return query
+
+
+def talk_rows(query, fields, limit):
+    """Load a page of talks and their list fields"""
+    scalar_fields = [f for f in fields if TALK_FIELDS[f] is not None]
+    rows = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        row = rows[limit - 1]
+        next_cursor = f'{row.cursor_date.isoformat()}_{row.cursor_id}'
+        rows = rows[:limit]
+
+    talks = []
+    for row in rows:
+        talk = {field: row[i] for i, field in enumerate(scalar_fields)}
+        if 'url' in talk:
+            talk['url'] = f'{app.config["TALKY_DOMAIN"]}/view/{row.cursor_id}/{row.cursor_key}/'
+        talks.append(talk)
+
+    talk_ids = [row.cursor_id for row in rows]
+    for field, table, column, name in [
+        ('interesting_to', schema.interesting_talks_experiment, 'experiment_id', Experiment.name),
+        ('categories', schema.talk_categories, 'category_id', schema.Category.name),
+    ]:
+        if field not in fields:
+            continue
+        values = {talk_id: [] for talk_id in talk_ids}
+        for talk_id, value in get_session().query(table.c.talk_id, name).join(
+            name.class_, getattr(table.c, column) == name.class_.id
+        ).filter(table.c.talk_id.in_(talk_ids)).order_by(name):
+            values[talk_id].append(value)
+        for talk, talk_id in zip(talks, talk_ids):
+            talk[field] = values[talk_id]
+    return talks, next_cursor
+
+
+@api_route('/talks')
+def api_talks():
+    """Talks ordered by conference date, newest first, like the talk listings"""
+    fields = requested_fields(TALK_FIELDS, TALK_DEFAULT_FIELDS)
+    query = talk_query(fields)
+    condition = view_filter(request.args.get('view', 'all'))
+    if condition is not None:
+        query = query.filter(condition)
+    if 'conference' in request.args:
+        try:
+            query = query.filter(Talk.conference_id == int(request.args['conference']))
+        except ValueError:
+            raise ApiError('conference must be an id')
+    if 'after' in request.args:
+        try:
+            cursor = decode_cursor(request.args['after'])
+        except BadRequest:
+            raise ApiError('Invalid cursor')
+        query = query.filter(keyset_filter((Conference.start_date, Talk.id), cursor, True))
+    query = query.order_by(Conference.start_date.desc(), Talk.id.desc())
+
+    talks, next_cursor = talk_rows(query, fields, page_size())
+    return {'data': talks, 'next': next_cursor}
+
+
+@api_route('/talks/<int:talk_id>')
+def api_talk(talk_id):
+    fields = requested_fields(TALK_FIELDS, TALK_DEFAULT_FIELDS)
+    talks, _ = talk_rows(talk_query(fields).filter(Talk.id == talk_id), fields, 1)
+    if not talks:
+        raise ApiError('Talk not found', 404)
+    return {'data': talks[0]}
+
+
+def id_page(model, query, fields):
+    """Page through query ordered by the id of model"""
+    if 'after' in request.args:
+        try:
+            query = query.filter(model.id > int(request.args['after']))
+        except ValueError:
+            raise ApiError('Invalid cursor')
+    query = query.order_by(model.id)
+    rows, next_cursor = select_rows(query, fields, page_size(), cursor_of=lambda row: row[-1])
+    return {'data': rows, 'next': next_cursor}
+
+
+@api_route('/conferences')
+def api_conferences():
+    fields = requested_fields(CONFERENCE_FIELDS)
+    columns = [CONFERENCE_FIELDS[f] for f in fields] + [Conference.id]
+    return id_page(Conference, scoped_query(Conference, *columns), fields)
+
+
+def talk_children(talk_id):
+    if scoped_query(Talk, Talk.id).filter(Talk.id == talk_id).first() is None:
+        raise ApiError('Talk not found', 404)
+
+
+@api_route('/talks/<int:talk_id>/submissions')
+def api_submissions(talk_id):
+    talk_children(talk_id)
+    fields = requested_fields(SUBMISSION_FIELDS)
+    columns = [SUBMISSION_FIELDS[f] for f in fields] + [Submission.id]
+    query = scoped_query(Submission, *columns).filter(Submission.talk_id == talk_id)
+    return id_page(Submission, query, fields)
+
+
+@api_route('/talks/<int:talk_id>/comments')
+def api_comments(talk_id):
+    talk_children(talk_id)
+    fields = requested_fields(COMMENT_FIELDS)
+    columns = [COMMENT_FIELDS[f] for f in fields] + [Comment.id]
+    query = scoped_query(Comment, *columns).select_from(Comment).filter(Comment.talk_id == talk_id)
+    if 'submission_version' in fields:
+        query = query.outerjoin(Submission, Comment.submission_id == Submission.id)
+    return id_page(Comment, query, fields)
@@ -1,35 +1,113 @@
 from collections import namedtuple
 from datetime import datetime
 import os
-from os.path import join, isfile, isdir
+from os.path import join, isfile
 import logging as log
 
-from flask import render_template, abort, redirect, request, send_file, flash
+from urllib.parse import quote
+
+from flask import (
+    render_template, abort, redirect, request, send_file, flash, make_response, jsonify, get_template_attribute,
+    Response
+)
 from flask_security import current_user
+from flask_wtf.csrf import generate_csrf
+from sqlalchemy import and_, func, select
+from sqlalchemy.orm import joinedload
+from werkzeug.http import is_resource_modified
 from werkzeug.utils import secure_filename
 
 from ..talky import app
 from .. import schema
-
+from .. import storage
+from .. import previews
+from .. import live
+from ..replica import read_only, get_session
+from ..page_cache import talk_pages
+
+# Cached talk pages are rendered with this in place of the per-user CSRF token
+CSRF_PLACEHOLDER = '__talky_csrf_token__'
+
+# Comments are rendered in a single pass in thread order. replies is set if
+# the following comments are replies to this one, hidden_replies is the number
+# of replies which are only loaded when requested and closes is the number of
+# reply lists which end after this comment.
 Comment = namedtuple(
     'Comment',
-    ['id', 'name', 'email', 'comment', 'time', 'submission_version', 'parent_comment_id']
+    ['id', 'name', 'email', 'comment', 'time', 'submission_version', 'depth',
+     'replies', 'hidden_replies', 'closes']
 )
 
 
-def recurse_comments(comments):
-    # Keep an index to keep the structure flat until the final step
-    comment_index = {None: [None, None, None, None, None, None, []]}
-    for c in comments:
-        parent_comment_id = c.parent_comment_id
-        c = list(c[:-1]) + [[]]
-        comment_index[parent_comment_id][-1].append(c)
-        comment_index[c[0]] = c
-    return comment_index[None][-1]
-
+def load_comments(talk_id, path=None, depth=0):
+    """Load the comments of a talk, or the replies to the comment at path, ready for rendering
 
-def get_talk(talk_id, view_key=None, upload_key=None):
-    talk = schema.Talk.query.get(talk_id)
+    Only COMMENT_INLINE_DEPTH levels of replies are loaded, deeper replies are
+    counted so they can be loaded on demand.
+    """
+    comments = schema.Comment
+    max_depth = depth + app.config['COMMENT_INLINE_DEPTH'] - 1
+    if path is None:
+        thread_filter = comments.talk_id == talk_id
+    else:
+        thread_filter = and_(comments.subtree_filter(talk_id, path), comments.depth >= depth)
+
+    rows = get_session().query(
+        comments.id, comments.name, comments.email, comments.comment, comments.time,
+        schema.Submission.version.label('submission_version'), comments.path, comments.depth
+    ).outerjoin(
+        comments.submission
+    ).filter(
+        thread_filter, comments.depth <= max_depth
+    ).order_by(comments.path).all()
+
+    # Count the replies which are too deep by their ancestor at max_depth
+    prefix = func.substr(comments.path, 1, (max_depth + 1) * len(comments.path_segment(0)))
+    hidden = dict(get_session().query(prefix, func.count()).filter(
+        thread_filter, comments.depth > max_depth
+    ).group_by(prefix).all())
+
+    return flatten_comments(rows, hidden, depth)
+
+
+def flatten_comments(rows, hidden, depth=0):
+    """Choose which of the rows are shown and how they nest, see Comment"""
+    # Count all replies to each comment, including those which were not loaded
+    n_replies = [hidden.get(row.path, 0) for row in rows]
+    ancestors = []
+    for i, row in enumerate(rows):
+        while ancestors and rows[ancestors[-1]].depth >= row.depth:
+            ancestors.pop()
+        for j in ancestors:
+            n_replies[j] += 1 + hidden.get(row.path, 0)
+        ancestors.append(i)
+
+    shown = []
+    collapsed_depth = None
+    for row, n in zip(rows, n_replies):
+        if collapsed_depth is not None and row.depth > collapsed_depth:
+            continue
+        collapsed_depth = None
+        if row.path in hidden or n > app.config['COMMENT_INLINE_REPLIES']:
+            collapsed_depth = row.depth
+            shown.append((row, n))
+        else:
+            shown.append((row, 0))
+
+    comments = []
+    for i, (row, n_hidden) in enumerate(shown):
+        next_depth = shown[i + 1][0].depth if i + 1 < len(shown) else depth
+        replies = next_depth > row.depth
+        comments.append(Comment(
+            row.id, row.name, row.email, row.comment, row.time.strftime("%Y-%m-%d %H:%M"),
+            row.submission_version, row.depth - depth, replies, n_hidden,
+            0 if replies else row.depth - next_depth
+        ))
+    return comments
+
+
+def get_talk(talk_id, view_key=None, upload_key=None, options=()):
+    talk = get_session().query(schema.Talk).options(*options).get(talk_id)
     if not (view_key or upload_key):
         raise RuntimeError()
     if not talk:
@@ -44,9 +122,24 @@ def get_talk(talk_id, view_key=None, upload_key=None):
     return talk
 
 
+def load_talk_page(talk_id, view_key):
+    """Load a talk with its submissions and comments using four queries"""
+    talk = get_talk(talk_id, view_key=view_key, options=[
+        joinedload(schema.Talk.conference), joinedload(schema.Talk.experiment)
+    ])
+
+    submissions = get_session().query(
+        schema.Submission.id, schema.Submission.version, schema.Submission.time, schema.Submission.preview_pages
+    ).filter(
+        schema.Submission.talk_id == talk.id
+    ).order_by(schema.Submission.time).all()
+
+    return talk, submissions, load_comments(talk.id)
+
+
 def user_can_edit(talk):
     return current_user.is_authenticated and (
-        current_user.experiment == talk.experiment or
+        current_user.experiment_id == talk.experiment_id or
         current_user.has_role('superuser')
     )
 
@@ -80,30 +173,23 @@ def upload_submission(talk_id=None, upload_key=None):
             flash('Invalid filename or extension (only pdf is permitted)', 'error')
             return redirect(request.url)
 
-        # Prepare the upload folder
-        talk.n_submissions += 1
-        version = talk.n_submissions
-        submission_dir = join(app.config['FILE_PATH'], str(talk.id), str(version))
-        if isdir(submission_dir):
-            log.warning('Submission directory already exists, recovering')
-            while isdir(submission_dir):
-                talk.n_submissions += 1
-                version = talk.n_submissions
-                submission_dir = join(app.config['FILE_PATH'], str(talk.id), str(version))
-        os.makedirs(submission_dir)
-
+        upload = file.stream
         filename = secure_filename(file.filename)
-        log.info(f'Uploading submission v{version} for talk {talk_id} with '
-                 f'filename {filename} to {submission_dir}')
-        file.save(join(submission_dir, filename))
-
+        version = storage.allocate_version(talk)
         submission = schema.Submission(
             talk=talk, time=datetime.now(), version=version,
-            filename=filename
+            filename=filename, sha256=upload.sha256, size=upload.size
         )
         schema.db.session.add(submission)
         schema.db.session.commit()
+
+        # Only move the file into place once the submission exists
+        submission_fn = storage.submission_path(talk.id, version, filename)
+        log.info(f'Storing submission v{version} for talk {talk_id} with '
+                 f'filename {filename} ({upload.size} bytes) as {submission_fn}')
+        storage.store_upload(upload, submission_fn)
         log.info(f'Submission {submission.id} successfully uploaded')
+        previews.schedule_previews(talk.id, version, filename)
         return redirect(f'/view/{talk.id}/{talk.view_key}/')
     else:
         return render_template(
@@ -115,19 +201,33 @@ def upload_submission(talk_id=None, upload_key=None):
 
 
 @app.route('/view/<talk_id>/<view_key>/')
+@read_only
 def view_talk(talk_id=None, view_key=None):
-    talk = get_talk(talk_id, view_key=view_key)
+    talk = get_session().query(
+        schema.Talk.id, schema.Talk.view_key, schema.Talk.experiment_id, schema.Talk.cache_version
+    ).filter(schema.Talk.id == talk_id).first()
+    if not talk or talk.view_key != view_key:
+        # Let get_talk handle logging and aborting
+        get_talk(talk_id, view_key=view_key)
+
+    modify = user_can_edit(talk)
+    key, stamp = (talk.id, modify), (talk.view_key, talk.cache_version or 0)
+    page = talk_pages.get(key, stamp)
+    if page is None:
+        page = render_talk_page(talk_id, view_key, modify)
+        if app.config['TALK_PAGE_CACHE_SIZE']:
+            talk_pages.set(key, stamp, page)
+    return page.replace(CSRF_PLACEHOLDER, generate_csrf())
+
+
+def render_talk_page(talk_id, view_key, modify):
+    talk, submissions, comments = load_talk_page(talk_id, view_key)
 
     submissions = [
-        [s.id, s.version, s.time.strftime("%Y-%m-%d %H:%M")]
-        for s in sorted(talk.submissions, key=lambda s: s.time)
+        [s.id, s.version, s.time.strftime("%Y-%m-%d %H:%M"), s.preview_pages]
+        for s in submissions
     ]
 
-    comments = recurse_comments([Comment(
-        c.id, c.name, c.email, c.comment, c.time.strftime("%Y-%m-%d %H:%M"),
-        c.submission.version if c.submission else None, c.parent_comment_id
-    ) for c in sorted(talk.comments, key=lambda c: c.time)])
-
     return render_template(
         'view_talk.html',
         talk_id=talk_id,
@@ -143,11 +243,124 @@ def view_talk(talk_id=None, view_key=None):
         conference_start_date=talk.conference.start_date.date(),
         submissions=submissions,
         comments=comments,
-        modify=user_can_edit(talk),
-        n_submissions=talk.n_submissions
+        latest_version=len(submissions),
+        modify=modify,
+        n_submissions=talk.n_submissions,
+        cursor=talk_cursor(talk),
+        poll_interval=app.config['TALK_POLL_INTERVAL'],
+        live_events=bool(app.config['LIVE_EVENTS']),
+        show_previews=bool(app.config['PREVIEW_WORKERS']) and any(s[3] for s in submissions),
+        csrf_token=lambda: CSRF_PLACEHOLDER
     )
 
 
+def talk_cursor(talk):
+    """Position in the history of a talk from which talk_updates continues"""
+    comments, submissions = schema.Comment, schema.Submission
+    max_comment_id, max_submission_id = get_session().query(
+        select([func.max(comments.id)]).where(comments.talk_id == talk.id).as_scalar(),
+        select([func.max(submissions.id)]).where(submissions.talk_id == talk.id).as_scalar(),
+    ).one()
+    return f'{talk.cache_version or 0}.{max_comment_id or 0}.{max_submission_id or 0}'
+
+
+@app.route('/view/<talk_id>/<view_key>/updates/')
+@read_only
+def talk_updates(talk_id=None, view_key=None):
+    """Comments and submissions added since the cursor of the page or of a previous poll
+
+    The ids of every remaining comment and submission are included so the page
+    can remove those which were deleted.
+    """
+    talk = get_session().query(
+        schema.Talk.id, schema.Talk.view_key, schema.Talk.experiment_id, schema.Talk.cache_version
+    ).filter(schema.Talk.id == talk_id).first()
+    if not talk or talk.view_key != view_key:
+        # Let get_talk handle logging and aborting
+        get_talk(talk_id, view_key=view_key)
+
+    try:
+        cache_version, comment_id, submission_id = request.args['since'].split('.')
+        comment_id, submission_id = int(comment_id), int(submission_id)
+    except (KeyError, ValueError):
+        abort(400)
+    # Any new or deleted comment or submission increments the cache version,
+    # an unusable version (e.g. "None" from an old page) gets a fresh cursor
+    if cache_version == str(talk.cache_version or 0):
+        return make_response('', 304)
+
+    comments, submissions = schema.Comment, schema.Submission
+    new_comments = get_session().query(
+        comments.id, comments.name, comments.email, comments.comment, comments.time,
+        submissions.version.label('submission_version'), comments.parent_comment_id
+    ).outerjoin(
+        comments.submission
+    ).filter(
+        comments.talk_id == talk.id, comments.id > comment_id
+    ).order_by(comments.path).all()
+    new_submissions = get_session().query(
+        submissions.id, submissions.version, submissions.time
+    ).filter(
+        submissions.talk_id == talk.id, submissions.id > submission_id
+    ).order_by(submissions.time).all()
+    comment_ids = [i for i, in get_session().query(comments.id).filter(comments.talk_id == talk.id)]
+    submission_ids = [i for i, in get_session().query(submissions.id).filter(submissions.talk_id == talk.id)]
+    latest_version = len(submission_ids)
+
+    modify = user_can_edit(talk)
+    submission_label = get_template_attribute('submission_label.html', 'submission_label')
+    response = jsonify(
+        cursor=f'{talk.cache_version or 0}.{max([c.id for c in new_comments], default=comment_id)}.'
+               f'{max([s.id for s in new_submissions], default=submission_id)}',
+        comments=[dict(
+            id=c.id,
+            parent_comment_id=c.parent_comment_id,
+            html=render_template(
+                'comment_thread.html',
+                comments=[Comment(
+                    c.id, c.name, c.email, c.comment, c.time.strftime("%Y-%m-%d %H:%M"),
+                    c.submission_version, 0, False, 0, 0
+                )],
+                latest_version=latest_version,
+                modify=modify,
+                replies_only=c.parent_comment_id is not None,
+            )
+        ) for c in new_comments],
+        submissions=[dict(
+            id=s.id,
+            version=s.version,
+            html=str(submission_label(
+                s.id, s.version, s.time.strftime("%Y-%m-%d %H:%M"), i == len(new_submissions) - 1, modify
+            ))
+        ) for i, s in enumerate(new_submissions)],
+        comment_ids=comment_ids,
+        submission_ids=submission_ids,
+    )
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@app.route('/view/<talk_id>/<view_key>/live/')
+@read_only
+def talk_live(talk_id=None, view_key=None):
+    """Stream of server-sent events telling the page to fetch talk_updates"""
+    talk = get_session().query(schema.Talk.id, schema.Talk.view_key).filter(schema.Talk.id == talk_id).first()
+    if not talk or talk.view_key != view_key:
+        # Let get_talk handle logging and aborting
+        get_talk(talk_id, view_key=view_key)
+
+    if app.config['LIVE_EVENTS'] == 'hub':
+        # The connection is handed to the hub so no worker is held while it is open
+        response = make_response('')
+        response.headers['X-Accel-Redirect'] = f'{app.config["LIVE_X_ACCEL_REDIRECT"]}{talk.id}'
+        return response
+    elif app.config['LIVE_EVENTS'] == 'local':
+        response = Response(live.local_stream(talk.id), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    abort(404)
+
+
 @app.route('/view/<talk_id>/<view_key>/comment/', methods=['POST'])
 def submit_comment(talk_id=None, view_key=None):
     talk = get_talk(talk_id, view_key=view_key)
@@ -166,21 +379,16 @@ def submit_comment(talk_id=None, view_key=None):
         except Exception:
             abort(400)
         else:
-            if not any(parent_comment_id == c.id for c in talk.comments):
+            if schema.Comment.query.filter_by(id=parent_comment_id, talk_id=talk.id).first() is None:
                 abort(400)
 
-    if talk.submissions.all():
-        submission = sorted(talk.submissions, key=lambda s: s.time)[-1]
-    else:
-        submission = None
-
     comment = schema.Comment(
         name=request.form['name'].strip(),
         email=request.form['email'].strip(),
         comment=request.form['comment'].strip(),
         time=datetime.now(),
         talk=talk,
-        submission=submission,
+        submission=talk.latest_submission,
         parent_comment_id=parent_comment_id
     )
     schema.db.session.add(comment)
@@ -189,6 +397,34 @@ def submit_comment(talk_id=None, view_key=None):
     return redirect(f'/view/{talk_id}/{view_key}/')
 
 
+@app.route('/view/<talk_id>/<view_key>/comment/<comment_id>/replies/')
+@read_only
+def view_replies(talk_id=None, view_key=None, comment_id=None):
+    """Render the replies to a comment which were not included in the talk page"""
+    talk = get_talk(talk_id, view_key=view_key)
+
+    try:
+        comment_id = int(comment_id)
+    except Exception:
+        abort(404)
+
+    parent = get_session().query(schema.Comment.path, schema.Comment.depth).filter(
+        schema.Comment.id == comment_id, schema.Comment.talk_id == talk.id
+    ).first()
+    if parent is None:
+        abort(404)
+
+    return render_template(
+        'comment_thread.html',
+        comments=load_comments(talk.id, parent.path, parent.depth + 1),
+        latest_version=get_session().query(func.count(schema.Submission.id)).filter(
+            schema.Submission.talk_id == talk.id
+        ).scalar(),
+        modify=user_can_edit(talk),
+        replies_only=True,
+    )
+
+
 @app.route('/view/<talk_id>/<view_key>/comment/<comment_id>/delete/', methods=['GET'])
 def delete_comment(talk_id=None, view_key=None, comment_id=None):
     talk = get_talk(talk_id, view_key=view_key)
@@ -210,8 +446,7 @@ def delete_comment(talk_id=None, view_key=None, comment_id=None):
     return redirect(f'/view/{talk_id}/{view_key}/')
 
 
-@app.route('/view/<talk_id>/<view_key>/submission/v<version>/', methods=['GET'])
-def view_submission(talk_id=None, view_key=None, version=None):
+def get_submission(talk_id, view_key, version):
     talk = get_talk(talk_id, view_key=view_key)
 
     try:
@@ -224,16 +459,65 @@ def view_submission(talk_id=None, view_key=None, version=None):
     if not submission:
         log.warning(f'Failed to find submission submission v{version} in talk {talk_id}')
         abort(404)
+    return talk, submission
 
-    submission_fn = join(app.config['FILE_PATH'], str(talk.id), str(submission.version), submission.filename)
 
-    if isfile(submission_fn):
-        log.info(f'Sending {submission_fn} for submission v{version} in talk {talk_id}')
-        return send_file(submission_fn)
-    else:
+def send_stored_file(path, etag, last_modified, mimetype):
+    """Send a file relative to FILE_PATH, using X-Accel-Redirect if it is enabled"""
+    filename = join(app.config['FILE_PATH'], path)
+
+    if app.config['SUBMISSION_X_ACCEL_REDIRECT']:
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            response = make_response('', 304)
+        else:
+            # nginx sends the file (including range requests) from an internal location
+            log.info(f'Redirecting to {path}')
+            response = make_response('')
+            response.headers['X-Accel-Redirect'] = app.config['SUBMISSION_X_ACCEL_REDIRECT'] + quote(path)
+            response.mimetype = mimetype
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        return response
+
+    log.info(f'Sending {filename}')
+    response = send_file(filename, mimetype=mimetype, add_etags=False, last_modified=last_modified)
+    response.set_etag(etag)
+    return response.make_conditional(request, accept_ranges=True, complete_length=os.path.getsize(filename))
+
+
+@app.route('/view/<talk_id>/<view_key>/submission/v<version>/', methods=['GET'])
+@read_only
+def view_submission(talk_id=None, view_key=None, version=None):
+    talk, submission = get_submission(talk_id, view_key, version)
+
+    submission_path = join(str(talk.id), str(submission.version), submission.filename)
+    if not isfile(join(app.config['FILE_PATH'], submission_path)):
         log.warning(f'Failed to find file submission v{version} for talk {talk_id}')
         abort(410)
 
+    # Submissions are never modified so (talk, version, id) identifies the contents
+    etag = f'{talk.id}-{submission.version}-{submission.id}'
+    return send_stored_file(submission_path, etag, submission.time, 'application/pdf')
+
+
+@app.route('/view/<talk_id>/<view_key>/submission/v<version>/preview/<name>', methods=['GET'])
+@read_only
+def view_preview(talk_id=None, view_key=None, version=None, name=None):
+    if not previews.PREVIEW_NAME_RE.match(name):
+        abort(404)
+    talk, submission = get_submission(talk_id, view_key, version)
+
+    preview_path = join(str(talk.id), str(submission.version), 'previews', name)
+    try:
+        mtime = os.path.getmtime(join(app.config['FILE_PATH'], preview_path))
+    except OSError:
+        # Previews are rendered in the background so may not exist yet
+        abort(404)
+
+    # Previews are replaced when they are rebuilt
+    etag = f'{talk.id}-{submission.version}-{submission.id}-{name}-{mtime:.0f}'
+    return send_stored_file(preview_path, etag, datetime.fromtimestamp(int(mtime)), 'image/png')
+
 
 @app.route('/view/<talk_id>/<view_key>/submission/<submission_id>/delete/', methods=['GET'])
 def delete_submission(talk_id=None, view_key=None, submission_id=None):
@@ -0,0 +1,127 @@
+"""Stream exports of the talk listing in batches
+
+Flask-Admin loads every exported talk, with its relationships, before writing
+the first byte. Here the ordered talk ids are read with a server-side cursor on
+a separate connection and the exported values are loaded for each batch of ids
+with plain column queries, so memory use is bounded by EXPORT_BATCH_SIZE.
+"""
+import csv
+import io
+import tempfile
+
+from sqlalchemy import func
+
+from ..talky import app
+from .. import schema
+
+try:
+    from openpyxl import Workbook
+    from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+except ImportError:
+    Workbook = None
+
+
+__all__ = [
+    'EXPORT_COLUMNS',
+    'talk_batches',
+    'csv_chunks',
+    'write_xlsx',
+]
+
+Talk, Conference, Experiment = schema.Talk, schema.Conference, schema.Experiment
+
+# The value of each column in UserHomeView.column_export_list, as an SQL expression
+EXPORT_COLUMNS = {
+    'conference_date': func.date(Conference.start_date),
+    'conference': Conference.name,
+    'title': Talk.title,
+    'experiment': Experiment.name,
+    # Loaded with a query per batch
+    'interesting_to': None,
+    'duration': Talk.duration,
+    'speaker': Talk.speaker,
+    'abstract': Talk.abstract,
+}
+
+
+def talk_batches(session, ids_query, columns):
+    """Yield lists of rows of the values of columns for the talks in ids_query, in order"""
+    batch_size = app.config['EXPORT_BATCH_SIZE']
+    # A separate connection so the batches can be loaded while the ids are being read
+    with session.get_bind().connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(ids_query.statement)
+        try:
+            while True:
+                talk_ids = [talk_id for talk_id, in result.fetchmany(batch_size)]
+                if not talk_ids:
+                    break
+                yield load_rows(session, talk_ids, columns)
+        finally:
+            result.close()
+
+
+def load_rows(session, talk_ids, columns):
+    scalar_columns = [c for c in columns if EXPORT_COLUMNS[c] is not None]
+    values = {
+        row[0]: list(row[1:])
+        for row in session.query(Talk.id, *[EXPORT_COLUMNS[c].label(c) for c in scalar_columns])
+        .select_from(Talk)
+        .join(Conference, Talk.conference_id == Conference.id)
+        .join(Experiment, Talk.experiment_id == Experiment.id)
+        .filter(Talk.id.in_(talk_ids))
+    }
+
+    if 'interesting_to' in columns:
+        interesting_to = {talk_id: [] for talk_id in talk_ids}
+        for talk_id, name in session.query(schema.interesting_talks_experiment.c.talk_id, Experiment.name).join(
+            Experiment, schema.interesting_talks_experiment.c.experiment_id == Experiment.id
+        ).filter(schema.interesting_talks_experiment.c.talk_id.in_(talk_ids)).order_by(Experiment.name):
+            interesting_to[talk_id].append(name)
+
+    rows = []
+    for talk_id in talk_ids:
+        if talk_id not in values:
+            # Deleted since the ids were read
+            continue
+        scalar_values = iter(values[talk_id])
+        rows.append([
+            ', '.join(interesting_to[talk_id]) if EXPORT_COLUMNS[c] is None else next(scalar_values)
+            for c in columns
+        ])
+    return rows
+
+
+def csv_chunks(titles, batches):
+    """Encode each batch of rows as a chunk of CSV"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(titles)
+    for rows in batches:
+        writer.writerows(['' if v is None else v for v in row] for row in rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def write_xlsx(title, titles, batches):
+    """Write the rows to a temporary XLSX file and return it
+
+    The worksheet is written in openpyxl's write-only mode which keeps the rows
+    in a temporary file rather than in memory. The format is a zip archive of
+    the whole sheet so nothing can be sent until every row has been written.
+    """
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet(title)
+    worksheet.append(titles)
+    for rows in batches:
+        for row in rows:
+            worksheet.append([
+                ILLEGAL_CHARACTERS_RE.sub('', v) if isinstance(v, str) else v
+                for v in row
+            ])
+    fp = tempfile.TemporaryFile()
+    workbook.save(fp)
+    fp.seek(0)
+    return fp
@@ -1,13 +1,22 @@
+from datetime import datetime
 from math import ceil
 
 from flask_admin.base import expose
 from flask_security import current_user
+from flask_admin.contrib.sqla import tools
 from flask_admin.helpers import get_redirect_target
 from flask_admin.model.helpers import get_mdict_item_or_list
-from flask import request, redirect, flash, url_for
+from flask import request, redirect, flash, url_for, abort, send_file, stream_with_context, Response
 from flask_admin.babel import gettext
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import joinedload
+from werkzeug.utils import secure_filename
 
+from ..talky import app
 from .. import schema
+from .. import search
+from ..replica import read_only, get_session
+from . import export as talk_export
 from . import views
 
 
@@ -34,12 +43,16 @@ class UserHomeView(views.DBTalkView, views.UserView):
     details_modal = False
 
     # Customizations
-    column_list = ['conference_date', 'conference', 'title', 'experiment', 'interesting_to', 'duration', 'speaker']
+    column_list = [
+        'conference_date', 'conference', 'title', 'experiment', 'interesting_to', 'duration', 'speaker',
+        'comment_count', 'last_activity'
+    ]
     column_details_list = ['conference_date', 'conference', 'title', 'experiment', 'interesting_to', 'duration', 'speaker', 'abstract']
     column_details_exclude_list = None
     column_export_exclude_list = None
     column_formatters = {
-        'conference_date': lambda v, c, m, n: str(m.conference_date.date())
+        'conference_date': lambda v, c, m, n: str(m.conference_date.date()),
+        'last_activity': lambda v, c, m, n: str(m.last_activity.date()) if m.last_activity else ''
     }
     column_export_list = ['conference_date', 'conference', 'title', 'experiment', 'interesting_to', 'duration', 'speaker', 'abstract']
     column_formatters_export = None
@@ -48,7 +61,9 @@ class UserHomeView(views.DBTalkView, views.UserView):
     column_default_sort = ('conference.start_date', True)
     column_editable_list = None
     column_choices = None
-    column_filters = ['title', 'experiment.name', 'interesting_to.name', 'conference', 'title', 'abstract', 'duration', 'speaker']
+    # Titles and abstracts are searched using the full-text index rather than filters
+    column_searchable_list = ['title']
+    column_filters = ['experiment.name', 'interesting_to.name', 'conference', 'duration', 'speaker']
     named_filter_urls = True
     column_display_actions = True
     column_extra_row_actions = None
@@ -57,7 +72,7 @@ class UserHomeView(views.DBTalkView, views.UserView):
         ('experiment', 'experiment.name'),
         ('conference_date', 'conference.start_date'),
         ('conference', 'conference.name'),
-        'title', 'duration', 'speaker'
+        'title', 'duration', 'speaker', 'comment_count', 'last_activity'
     ]
     form = None
     # form_base_class = BaseForm
@@ -117,6 +132,128 @@ class UserHomeView(views.DBTalkView, views.UserView):
 
         return redirect(f'/view/{talk.id}/{talk.view_key}')
 
+    def _apply_search(self, query, count_query, joins, count_joins, search_string):
+        """Restrict to talks in the full-text index and order them by relevance"""
+        if not search.fts_query(search_string):
+            return query, count_query, joins, count_joins
+        matches = search.talk_matches(search_string)
+        query = query.join(matches, matches.c.talk_id == schema.Talk.id).order_by(matches.c.rank)
+        if count_query is not None:
+            count_query = count_query.join(matches, matches.c.talk_id == schema.Talk.id)
+        return query, count_query, joins, count_joins
+
+    def _apply_sorting(self, query, joins, sort_column, sort_desc):
+        # Sorting by a column replaces the relevance ordering of search results
+        if sort_column is not None:
+            query = query.order_by(None)
+        return super(UserHomeView, self)._apply_sorting(query, joins, sort_column, sort_desc)
+
+    @expose('/export/<export_type>/')
+    @read_only
+    def export(self, export_type):
+        return super(UserHomeView, self).export(export_type)
+
+    def _export_ids_query(self):
+        """Query for the ids of the exported talks, searched, filtered and sorted like the listing"""
+        view_args = self._get_list_extra_args()
+        sort_column = self._get_column_by_idx(view_args.sort)
+        if sort_column is not None:
+            sort_column = sort_column[0]
+
+        joins = {}
+        query = self.get_query()
+        if self._search_supported and view_args.search:
+            query, _, joins, _ = self._apply_search(query, None, joins, {}, view_args.search)
+        if view_args.filters and self._filters:
+            query, _, joins, _ = self._apply_filters(query, None, joins, {}, view_args.filters)
+        query, joins = self._apply_sorting(query, joins, sort_column, view_args.sort_desc)
+        # Break ties so the order doesn't depend on the query plan
+        return query.with_entities(schema.Talk.id).order_by(schema.Talk.id)
+
+    def _export_batches(self):
+        columns = [name for name, _ in self._export_columns]
+        return talk_export.talk_batches(get_session(), self._export_ids_query(), columns)
+
+    def _export_csv(self, return_url):
+        """Stream the CSV export a batch of talks at a time"""
+        titles = [title for _, title in self._export_columns]
+        filename = secure_filename(self.get_export_name(export_type='csv'))
+        return Response(
+            stream_with_context(talk_export.csv_chunks(titles, self._export_batches())),
+            headers={'Content-Disposition': f'attachment;filename={filename}'},
+            mimetype='text/csv'
+        )
+
+    def _export_tablib(self, export_type, return_url):
+        """Write XLSX exports with openpyxl in write-only mode rather than building them in memory with tablib"""
+        if export_type != 'xlsx':
+            return super(UserHomeView, self)._export_tablib(export_type, return_url)
+        if talk_export.Workbook is None:
+            flash(gettext('openpyxl is required to export XLSX files.'), 'error')
+            return redirect(return_url)
+        titles = [title for _, title in self._export_columns]
+        fp = talk_export.write_xlsx(self.name, titles, self._export_batches())
+        return send_file(
+            fp, as_attachment=True, cache_timeout=0,
+            attachment_filename=secure_filename(self.get_export_name(export_type)),
+            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        )
+
+    def _get_keyset_sort(self, view_args, sort_column):
+        """Return if the listing is sorted descending if it can be paged with a cursor, else None"""
+        if view_args.page or view_args.search:
+            # Keep supporting links to numbered pages and order searches by relevance
+            return None
+        if sort_column is None:
+            return self.column_default_sort[1]
+        if sort_column == 'conference_date':
+            return view_args.sort_desc
+        return None
+
+    def get_keyset_list(self, sort_desc, filters, page_size, after=None, before=None):
+        """Return a page of talks after (or before) a cursor of (conference.start_date, talk.id)
+
+        Unlike OFFSET based pagination the cost doesn't grow with the page
+        number. The total count is only calculated if LISTING_EXACT_COUNT is set.
+        """
+        joins = {}
+        count_joins = {}
+        query = self.get_query()
+        count_query = self.get_count_query() if app.config['LISTING_EXACT_COUNT'] else None
+        if filters and self._filters:
+            query, count_query, joins, count_joins = self._apply_filters(
+                query, count_query, joins, count_joins, filters)
+        count = count_query.scalar() if count_query else None
+
+        attr, path = tools.get_field_with_path(self.model, 'conference.start_date')
+        query, joins, alias = self._apply_path_joins(query, joins, path, inner_join=False)
+        key = (attr if alias is None else getattr(alias, attr.key), schema.Talk.id)
+
+        backwards = before is not None
+        descending = sort_desc != backwards
+        cursor = before if backwards else after
+        if cursor is not None:
+            query = query.filter(keyset_filter(key, decode_cursor(cursor), descending))
+        query = query.order_by(*[k.desc() if descending else k for k in key])
+
+        for j in self._auto_joins:
+            query = query.options(joinedload(j))
+        if page_size:
+            query = query.limit(page_size + 1)
+        data = query.all()
+
+        has_more = bool(page_size) and len(data) > page_size
+        data = data[:page_size] if page_size else data
+        if backwards:
+            data = data[::-1]
+
+        cursors = {'previous': None, 'next': None}
+        if data and (has_more if backwards else cursor is not None):
+            cursors['previous'] = encode_cursor(data[0])
+        if data and (backwards or has_more):
+            cursors['next'] = encode_cursor(data[-1])
+        return count, data, cursors
+
     def _get_list_url(self, view_args):
         """
             Generate page URL with current page, sort column and
@@ -191,8 +328,16 @@ class UserHomeView(views.DBTalkView, views.UserView):
             raise RuntimeError(view_type)
 
         # Get count and data
-        count, data = self.get_list(view_args.page, sort_column, view_args.sort_desc,
-                                    view_args.search, filters, page_size=page_size)
+        keyset_sort = self._get_keyset_sort(view_args, sort_column)
+        if keyset_sort is None:
+            count, data = self.get_list(view_args.page, sort_column, view_args.sort_desc,
+                                        view_args.search, filters, page_size=page_size)
+            cursors = None
+        else:
+            count, data, cursors = self.get_keyset_list(
+                keyset_sort, filters, page_size,
+                after=request.args.get('after'), before=request.args.get('before')
+            )
 
         list_forms = {}
         if self.column_editable_list:
@@ -215,6 +360,18 @@ class UserHomeView(views.DBTalkView, views.UserView):
 
             return self._get_list_url(view_args.clone(page=p))
 
+        def cursor_url(name, cursor):
+            return self._get_list_url(view_args.clone(extra_args=dict(view_args.extra_args, **{name: cursor})))
+
+        if cursors is None:
+            cursor_urls = None
+        else:
+            cursor_urls = {
+                'first': self._get_list_url(view_args) if cursors['previous'] else None,
+                'previous': cursors['previous'] and cursor_url('before', cursors['previous']),
+                'next': cursors['next'] and cursor_url('after', cursors['next']),
+            }
+
         def sort_url(column, invert=False, desc=None):
             if not desc and invert and not view_args.sort_desc:
                 desc = 1
@@ -258,6 +415,7 @@ class UserHomeView(views.DBTalkView, views.UserView):
             count=count,
             pager_url=pager_url,
             num_pages=num_pages,
+            cursor_urls=cursor_urls,
             can_set_page_size=self.can_set_page_size,
             page_size_url=page_size_url,
             page=view_args.page,
@@ -292,18 +450,43 @@ class UserHomeView(views.DBTalkView, views.UserView):
         )
 
     @expose('/all')
+    @read_only
     def all_view(self):
         return self._show_list_view('all')
 
     @expose('/')
     @expose('/flagged')
+    @read_only
     def index_view(self):
         return self._show_list_view('flagged')
 
     @expose('/given')
+    @read_only
     def given_view(self):
         return self._show_list_view('given')
 
     @expose('/other')
+    @read_only
     def other_view(self):
         return self._show_list_view('other')
+
+
+def keyset_filter(key, cursor, descending):
+    """SQL expression for the rows which come after the cursor"""
+    (start_date, talk_id), (cursor_date, cursor_id) = key, cursor
+    if descending:
+        return or_(start_date < cursor_date, and_(start_date == cursor_date, talk_id < cursor_id))
+    else:
+        return or_(start_date > cursor_date, and_(start_date == cursor_date, talk_id > cursor_id))
+
+
+def encode_cursor(talk):
+    return f'{talk.conference.start_date.isoformat()}_{talk.id}'
+
+
+def decode_cursor(cursor):
+    try:
+        start_date, talk_id = cursor.split('_')
+        return datetime.fromisoformat(start_date), int(talk_id)
+    except ValueError:
+        abort(400)
@@ -1,8 +1,15 @@
-from flask import url_for, redirect, request, abort
+from datetime import datetime
+
+from flask import url_for, redirect, request, abort, flash
 from flask_security import current_user
+from flask_admin.actions import action
+from flask_admin.base import expose
 from flask_admin.contrib import sqla
 
 from .. import schema
+from .. import outbox
+from ..count_cache import CountQuery
+from ..replica import read_only, get_session
 
 
 class BaseView(sqla.ModelView):
@@ -23,6 +30,18 @@ class BaseView(sqla.ModelView):
             else:
                 return redirect(url_for('security.login', next=request.url))
 
+    @expose('/')
+    @read_only
+    def index_view(self):
+        return super(BaseView, self).index_view()
+
+    def get_query(self):
+        return get_session().query(self.model)
+
+    def get_count_query(self):
+        # Cache the number of rows rather than counting them for every page
+        return CountQuery([sqla.view.func.count('*')], get_session()()).select_from(self.model)
+
     def _make_filter(self, table):
         def filter_by_experiment():
             return table.query.filter_by(
@@ -87,18 +106,16 @@ class UserView(BaseView):
             return self.form_columns
 
     def get_query(self):
-        if hasattr(self.model, 'experiment') and self.model != schema.Talk:
-            # Limit this view to only the current user's experiment
-            return self.session.query(self.model).filter(
-                self.model.experiment == current_user.experiment)
+        condition = experiment_filter(self.model)
+        if condition is not None:
+            return super(UserView, self).get_query().filter(condition)
         else:
             return super(UserView, self).get_query()
 
     def get_count_query(self):
-        if hasattr(self.model, 'experiment') and self.model != schema.Talk:
-            # Limit this view to only the current user's experiment
-            return self.session.query(sqla.view.func.count('*')).filter(
-                self.model.experiment == current_user.experiment)
+        condition = experiment_filter(self.model)
+        if condition is not None:
+            return super(UserView, self).get_count_query().filter(condition)
         else:
             return super(UserView, self).get_count_query()
 
@@ -124,6 +141,13 @@ class UserView(BaseView):
         super(UserView, self).on_model_change(form, model, is_created)
 
 
+def experiment_filter(model):
+    """Condition limiting users to the rows of model from their experiment, or None if all are shared"""
+    if hasattr(model, 'experiment') and model != schema.Talk:
+        return model.experiment_id == current_user.experiment_id
+    return None
+
+
 class DBCategoryView(object):
     _table_class = schema.Category
     _form_columns = ('name', 'contacts', 'experiment')
@@ -185,6 +209,38 @@ class DBTalkView(object):
         return form
 
 
+class DBOutgoingEmailView(object):
+    _table_class = schema.OutgoingEmail
+    list_template = 'outbox_listing.html'
+    can_create = False
+    can_edit = False
+    can_view_details = True
+    column_default_sort = ('id', True)
+    column_filters = ['status']
+    _column_list = ('created', 'subject', 'status', 'attempts', 'next_attempt', 'sent', 'last_error')
+    column_details_list = (
+        'created', 'subject', 'recipients', 'bcc', 'status', 'attempts', 'next_attempt', 'sent', 'last_error'
+    )
+
+    def render(self, template, **kwargs):
+        # Show the number of queued and failed messages above the list
+        kwargs['outbox_stats'] = outbox.queue_stats()
+        return super(DBOutgoingEmailView, self).render(template, **kwargs)
+
+    @action('retry', 'Retry', 'Are you sure you want to send the selected emails again?')
+    def action_retry(self, ids):
+        emails = schema.OutgoingEmail.__table__
+        result = schema.db.session.execute(
+            emails.update()
+            .where(emails.c.id.in_([int(i) for i in ids]))
+            .where(emails.c.status == 'failed')
+            .values(status='pending', attempts=0, next_attempt=datetime.now())
+        )
+        schema.db.session.commit()
+        outbox.wake()
+        flash(f'{result.rowcount} failed emails will be sent again', 'success')
+
+
 def make_view(user_view, view=None, db=None):
     if view is None and db is not None:
         class CustomView(user_view):
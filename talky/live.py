@@ -0,0 +1,209 @@
+"""Push the activity of talks to open talk pages with server-sent events
+
+Events are published once the change has been committed. With LIVE_EVENTS =
+'hub' the uWSGI workers send them as datagrams to a single asyncio process
+started with "python -m talky --live-hub", and talky_live redirects each
+browser to it with X-Accel-Redirect, so idle connections only cost a socket in
+nginx and the hub. With LIVE_EVENTS = 'local' each process fans out its own
+events to streams served by its own threads, which is only suitable for the
+development server.
+"""
+import asyncio
+import json
+import logging as log
+import os
+import queue
+import socket
+import threading
+
+from .talky import app
+from . import events
+
+
+__all__ = [
+    'publish',
+    'local_stream',
+    'run_hub',
+]
+
+
+def format_event(message):
+    """Encode a published message as a server-sent event"""
+    data = json.dumps({k: v for k, v in message.items() if k not in ('talk_id', 'kind')})
+    return f'event: {message["kind"]}\ndata: {data}\n\n'.encode()
+
+
+# Sent first to ask browsers to wait before reconnecting
+RETRY = b'retry: 10000\n\n'
+# Comment lines keep idle connections open through proxies
+HEARTBEAT = b':\n\n'
+
+
+@events.subscribe(events.TalkActivity)
+def publish_activity(session, batch):
+    for event in batch:
+        publish(dict(event._asdict()))
+
+
+def publish(message):
+    """Send message to the open pages of message['talk_id']"""
+    if app.config['LIVE_EVENTS'] == 'hub':
+        send_to_hub(message)
+    elif app.config['LIVE_EVENTS'] == 'local':
+        local_broker.publish(message)
+
+
+def send_to_hub(message):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        # Never delay the caller, the pages catch up when they next poll
+        sock.setblocking(False)
+        sock.sendto(json.dumps(message).encode(), app.config['LIVE_PUBLISH_SOCKET'])
+    except (BlockingIOError, FileNotFoundError, ConnectionRefusedError) as e:
+        log.warning(f'Failed to send {message["kind"]} event for talk {message["talk_id"]} to the hub: {e}')
+    finally:
+        sock.close()
+
+
+class LocalBroker(object):
+    """Stand-in for the hub which fans out the events of this process to its own streams"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queues = {}
+
+    def subscribe(self, talk_id):
+        q = queue.Queue()
+        with self.lock:
+            self.queues.setdefault(talk_id, set()).add(q)
+        return q
+
+    def unsubscribe(self, talk_id, q):
+        with self.lock:
+            self.queues[talk_id].discard(q)
+            if not self.queues[talk_id]:
+                del self.queues[talk_id]
+
+    def publish(self, message):
+        with self.lock:
+            queues = list(self.queues.get(message['talk_id'], ()))
+        for q in queues:
+            q.put(message)
+
+
+local_broker = LocalBroker()
+
+
+def local_stream(talk_id):
+    """Generate the events of talk_id, holding the calling thread until the client disconnects"""
+    q = local_broker.subscribe(talk_id)
+    try:
+        yield RETRY
+        while True:
+            try:
+                message = q.get(timeout=app.config['LIVE_HEARTBEAT'])
+            except queue.Empty:
+                yield HEARTBEAT
+            else:
+                yield format_event(message)
+    finally:
+        local_broker.unsubscribe(talk_id, q)
+
+
+class Hub(object):
+    """Single threaded fan-out of the published events to every open page"""
+    # Clients which fall this far behind are disconnected
+    MAX_BUFFER = 256 * 1024
+
+    def __init__(self, prefix, heartbeat):
+        self.prefix = prefix
+        self.heartbeat = heartbeat
+        self.clients = {}
+
+    def datagram_received(self, data, addr):
+        try:
+            message = json.loads(data)
+            talk_id = int(message['talk_id'])
+            chunk = format_event(message)
+        except (ValueError, KeyError, TypeError):
+            log.warning(f'Ignoring invalid message {data!r}')
+            return
+        for writer in list(self.clients.get(talk_id, ())):
+            self.write(writer, chunk)
+
+    def write(self, writer, chunk):
+        if writer.transport.get_write_buffer_size() > self.MAX_BUFFER:
+            writer.close()
+        else:
+            writer.write(chunk)
+
+    async def handle(self, reader, writer):
+        """Serve the stream of the talk in the path nginx redirected to"""
+        try:
+            request_line = await reader.readline()
+            # Skip the headers
+            while (await reader.readline()).strip():
+                pass
+            method, path, _ = request_line.decode('latin-1').split(' ', 2)
+            talk_id = int(path[len(self.prefix):].strip('/')) if path.startswith(self.prefix) else None
+        except (ValueError, ConnectionError):
+            talk_id = None
+        if talk_id is None:
+            writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            writer.close()
+            return
+
+        writer.write(
+            b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n'
+            b'X-Accel-Buffering: no\r\nConnection: close\r\n\r\n' + RETRY
+        )
+        self.clients.setdefault(talk_id, set()).add(writer)
+        try:
+            # nginx closes the connection when the browser goes away
+            while await reader.read(4096):
+                pass
+        except ConnectionError:
+            pass
+        finally:
+            self.clients[talk_id].discard(writer)
+            if not self.clients[talk_id]:
+                del self.clients[talk_id]
+            writer.close()
+
+    async def send_heartbeats(self):
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            for writers in list(self.clients.values()):
+                for writer in list(writers):
+                    self.write(writer, HEARTBEAT)
+
+
+async def serve_hub(hub, socket_path, publish_path):
+    for path in [socket_path, publish_path]:
+        if os.path.exists(path):
+            os.remove(path)
+
+    publish_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    publish_socket.bind(publish_path)
+    loop = asyncio.get_event_loop()
+    transport, _ = await loop.create_datagram_endpoint(lambda: HubProtocol(hub), sock=publish_socket)
+    server = await asyncio.start_unix_server(hub.handle, path=socket_path)
+    log.info(f'Serving live events on {socket_path}, publish to {publish_path}')
+    try:
+        await asyncio.gather(server.serve_forever(), hub.send_heartbeats())
+    finally:
+        server.close()
+        transport.close()
+
+
+class HubProtocol(asyncio.DatagramProtocol):
+    def __init__(self, hub):
+        self.hub = hub
+
+    def datagram_received(self, data, addr):
+        self.hub.datagram_received(data, addr)
+
+
+def run_hub():
+    """Run the hub until it is killed, e.g. as a daemon attached to uWSGI"""
+    hub = Hub(app.config['LIVE_X_ACCEL_REDIRECT'], app.config['LIVE_HEARTBEAT'])
+    asyncio.run(serve_hub(hub, app.config['LIVE_SOCKET'], app.config['LIVE_PUBLISH_SOCKET']))
@@ -1,13 +1,15 @@
 import logging
-from threading import Thread
 
-from flask_mail import Message
 from jinja2 import Environment, PackageLoader, select_autoescape
-from premailer import transform
+from premailer import Premailer
 import cssutils
+from sqlalchemy import select, union
+from sqlalchemy.orm import object_session
 
 from . import schema
-from .talky import app, mail
+from . import digest
+from . import outbox
+from .talky import app
 
 # Suppress error messages from premailer
 cssutils.log.setLevel(logging.CRITICAL)
@@ -18,10 +20,38 @@ env = Environment(
 )
 
 
-def send_async_email(app, msg):
-    with app.app_context():
-        # TODO Notify me if this goes wrong
-        mail.send(msg)
+class CachedPremailer(Premailer):
+    """Premailer which only parses and serialises each stylesheet once
+
+    Every email shares the stylesheet of base.html so only the elements of the
+    rendered message need to be processed when inlining the CSS.
+    """
+    # Keyed by the contents of the <style> elements, of which there are few
+    _style_rules = {}
+    _leftover_css = {}
+
+    def _parse_style_rules(self, css_body, ruleset_index):
+        key = (css_body, ruleset_index)
+        if key not in self._style_rules:
+            rules, leftover = super(CachedPremailer, self)._parse_style_rules(css_body, ruleset_index)
+            self._style_rules[key] = (tuple(rules), tuple(leftover))
+        rules, leftover = self._style_rules[key]
+        return list(rules), leftover
+
+    def _css_rules_to_string(self, rules):
+        # The leftover rules are the same objects each time so can be used as the key
+        key = tuple(rules)
+        if key not in self._leftover_css:
+            self._leftover_css[key] = super(CachedPremailer, self)._css_rules_to_string(rules)
+        return self._leftover_css[key]
+
+
+premailer = CachedPremailer()
+
+
+def inline_css(html):
+    """Move the CSS of an email into style attributes"""
+    return premailer.transform(html, pretty_print=False)
 
 
 def _validate_emails(emails):
@@ -44,61 +74,69 @@ def _validate_emails(emails):
 
 
 def send_talk_assgined(talk):
+    # Always sent immediately as the speaker needs the upload link
     subject = f'You have been assigned to a talk - {talk.title}'
-    msg = Message(subject)
-    msg.html = transform(env.get_template('talk_assigned.html').render(
+    html = inline_css(env.get_template('talk_assigned.html').render(
         subject=subject,
         talk=talk,
         domain=app.config['TALKY_DOMAIN']
     ))
-    msg.recipients = _validate_emails([talk.speaker])
-
-    thr = Thread(target=send_async_email, args=[app, msg])
-    thr.start()
+    outbox.enqueue(object_session(talk), subject, html, recipients=_validate_emails([talk.speaker]))
 
 
 def send_new_talk_available(submission):
     talk = submission.talk
     subject = f'New talk uploaded - {submission.talk.title}'
-
-    msg = Message(subject)
-    msg.html = transform(env.get_template('new_talk_available.html').render(
+    session = object_session(talk)
+    recipients = [email for email, in session.execute(new_talk_recipients(talk.id))]
+
+    if digest.enabled():
+        digest.add(
+            session, _validate_emails(recipients), subject,
+            f'{app.config["TALKY_DOMAIN"]}/view/{talk.id}/{talk.view_key}/',
+            f'{talk.speaker} will present this at {talk.conference.name} starting on {talk.conference_date}'
+        )
+        return
+
+    html = inline_css(env.get_template('new_talk_available.html').render(
         subject=subject,
         talk=talk,
         domain=app.config['TALKY_DOMAIN']
     ))
-
-    # Send notifications to the members of this and flagged experiments
-    recipients = []
-    for user in schema.User.query.all():
-        if user.experiment == talk.experiment:
-            recipients.append(user.email)
-        elif user.experiment in talk.interesting_to:
-            recipients.append(user.email)
-    # Send notifications to members of flagged categories
-    for category in talk.categories:
-        recipients.extend([c.email for c in category.contacts])
-    # Remove duplicates
-    recipients = list(set(recipients))
     # Sent the email
-    msg.bcc = _validate_emails(recipients)
-
-    thr = Thread(target=send_async_email, args=[app, msg])
-    thr.start()
+    outbox.enqueue(session, subject, html, bcc=_validate_emails(recipients))
+
+
+def new_talk_recipients(talk_id):
+    """Query for the deduplicated addresses to notify when a talk is first uploaded
+
+    These are the members of the talk's experiment and the experiments it is
+    flagged as interesting to, and the contacts of the talk's categories.
+    """
+    users, talks, contacts = schema.User.__table__, schema.Talk.__table__, schema.Contact.__table__
+    interesting = schema.interesting_talks_experiment
+    talk_categories, categories_contacts = schema.talk_categories, schema.categories_contacts
+    return union(
+        select([users.c.email]).where(
+            users.c.experiment_id == select([talks.c.experiment_id]).where(talks.c.id == talk_id).as_scalar()
+        ),
+        select([users.c.email])
+        .select_from(users.join(interesting, interesting.c.experiment_id == users.c.experiment_id))
+        .where(interesting.c.talk_id == talk_id),
+        select([contacts.c.email])
+        .select_from(
+            contacts
+            .join(categories_contacts, categories_contacts.c.contact_id == contacts.c.id)
+            .join(talk_categories, talk_categories.c.category_id == categories_contacts.c.category_id)
+        )
+        .where(talk_categories.c.talk_id == talk_id),
+    )
 
 
 def send_new_comment(comment):
     talk = comment.talk
     subject = f'New comment received on {comment.talk.title}'
 
-    msg = Message(subject)
-    msg.html = transform(env.get_template('new_comment.html').render(
-        subject=subject,
-        talk=talk,
-        comment=comment,
-        domain=app.config['TALKY_DOMAIN']
-    ))
-
     # Always sent notification if replies to the speaker
     recipients = [talk.speaker]
     # TODO Send notification of the replies to any parent commentators
@@ -107,8 +145,20 @@ def send_new_comment(comment):
     # Remove the commenter if they are in the recipients
     if comment.email in recipients:
         recipients.pop(recipients.index(comment.email))
-    # Sent the email
-    msg.bcc = _validate_emails(recipients)
 
-    thr = Thread(target=send_async_email, args=[app, msg])
-    thr.start()
+    if digest.enabled():
+        digest.add(
+            object_session(talk), _validate_emails(recipients), subject,
+            f'{app.config["TALKY_DOMAIN"]}/view/{talk.id}/{talk.view_key}/#comment{comment.id}',
+            f'{comment.name}: {comment.comment}'
+        )
+        return
+
+    html = inline_css(env.get_template('new_comment.html').render(
+        subject=subject,
+        talk=talk,
+        comment=comment,
+        domain=app.config['TALKY_DOMAIN']
+    ))
+    # Sent the email
+    outbox.enqueue(object_session(talk), subject, html, bcc=_validate_emails(recipients))
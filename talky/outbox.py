@@ -0,0 +1,291 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import logging as log
+import os
+import smtplib
+import threading
+
+from flask_mail import Message
+from sqlalchemy import and_, func, select
+from sqlalchemy.event import listens_for
+
+from .talky import app, mail
+from .schema import db, DigestItem, OutgoingEmail
+from . import events
+
+
+__all__ = [
+    'enqueue',
+    'wake',
+    'drain',
+    'send_emails',
+    'queue_stats',
+]
+
+
+outgoing = OutgoingEmail.__table__
+
+
+def enqueue(session, subject, html, recipients=(), bcc=()):
+    """Add an email to the outbox as part of the transaction of session
+
+    Large BCC lists are split between messages of up to MAIL_MAX_BCC addresses
+    which are sent, and retried, independently.
+    """
+    recipients, bcc = sorted(set(recipients)), sorted(set(bcc))
+    if not (recipients or bcc):
+        log.info(f'Not sending "{subject}" as it has no recipients')
+        return
+
+    size = app.config['MAIL_MAX_BCC']
+    chunks = [bcc[i:i + size] for i in range(0, len(bcc), size)] or [[]]
+    now = datetime.now()
+    session.execute(outgoing.insert(), [
+        dict(
+            subject=subject, html=html,
+            # Only the first message is sent to the direct recipients
+            recipients='\n'.join(recipients if i == 0 else []), bcc='\n'.join(chunk),
+            status='pending', created=now, next_attempt=now, attempts=0
+        ) for i, chunk in enumerate(chunks)
+    ])
+    session.info['outbox'] = True
+
+
+@listens_for(db.session, 'after_commit')
+def outbox_after_commit(session):
+    if session.info.pop('outbox', False):
+        wake()
+
+
+@listens_for(db.session, 'after_rollback')
+def outbox_after_rollback(session):
+    session.info.pop('outbox', None)
+
+
+class Sender(object):
+    """Pool of up to MAIL_WORKERS threads which drain the outbox"""
+    def __init__(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=app.config['MAIL_WORKERS'], thread_name_prefix='talky-mail')
+        self.running = 0
+        # Set when there might be new messages since a worker last looked
+        self.woken = False
+        self.retry_timer = None
+        self.retry_time = None
+
+    def wake(self):
+        with self.lock:
+            self.woken = True
+            if self.running >= app.config['MAIL_WORKERS']:
+                return
+            self.running += 1
+        self.pool.submit(self.work)
+
+    def work(self):
+        with app.app_context():
+            while True:
+                with self.lock:
+                    self.woken = False
+                try:
+                    n_sent, n_failed = drain()
+                    # Don't keep reconnecting if the server is unavailable
+                    self.schedule_retry(app.config['MAIL_RETRY_DELAY'] if n_failed else 0)
+                except Exception:
+                    log.exception('Failed to send emails from the outbox')
+                with self.lock:
+                    if not self.woken:
+                        self.running -= 1
+                        return
+
+    def schedule_retry(self, min_delay):
+        """Wake up again when the next pending message is due
+
+        This retries messages and events which failed and those whose lease
+        expired as the process handling them died, and sends digests once they
+        are due.
+        """
+        from . import digest
+        with db.engine.connect() as connection:
+            next_attempt = connection.execute(
+                select([func.min(outgoing.c.next_attempt)]).where(outgoing.c.status == 'pending')
+            ).scalar()
+        due = [t for t in [next_attempt, digest.next_due(), events.next_due()] if t is not None]
+        if not due:
+            return
+        next_attempt = min(due)
+        next_attempt = max(next_attempt, datetime.now() + timedelta(seconds=min_delay))
+        with self.lock:
+            if self.retry_time is not None and self.retry_time <= next_attempt:
+                return
+            if self.retry_timer is not None:
+                self.retry_timer.cancel()
+            delay = max((next_attempt - datetime.now()).total_seconds(), 0) + 1
+            self.retry_time = next_attempt
+            self.retry_timer = threading.Timer(delay, self.retry)
+            self.retry_timer.daemon = True
+            self.retry_timer.start()
+
+    def retry(self):
+        with self.lock:
+            self.retry_time = self.retry_timer = None
+        self.wake()
+
+
+# The sender of this process, as uWSGI forks after importing talky
+_sender = None
+
+
+def wake():
+    """Start sending the emails in the outbox in the background"""
+    global _sender
+    if not app.config['MAIL_WORKERS']:
+        return
+    if _sender is None or _sender.pid != os.getpid():
+        _sender = Sender()
+    _sender.wake()
+
+
+def claim():
+    """Reserve the next message which is due so no other worker sends it"""
+    while True:
+        now = datetime.now()
+        with db.engine.begin() as connection:
+            row = connection.execute(
+                select([outgoing])
+                .where(and_(outgoing.c.status == 'pending', outgoing.c.next_attempt <= now))
+                .order_by(outgoing.c.next_attempt, outgoing.c.id)
+                .limit(1)
+            ).first()
+            if row is None:
+                return None
+            # The lease expires if this process dies while sending the message
+            result = connection.execute(
+                outgoing.update()
+                .where(and_(
+                    outgoing.c.id == row.id,
+                    outgoing.c.status == 'pending',
+                    outgoing.c.next_attempt == row.next_attempt
+                ))
+                .values(
+                    next_attempt=now + timedelta(seconds=app.config['MAIL_SEND_TIMEOUT']),
+                    attempts=row.attempts + 1
+                )
+            )
+        if result.rowcount == 1:
+            return row
+
+
+def make_message(row):
+    return Message(
+        row.subject,
+        html=row.html,
+        recipients=row.recipients.split('\n') if row.recipients else [],
+        bcc=row.bcc.split('\n') if row.bcc else []
+    )
+
+
+def connect():
+    connection = mail.connect()
+    connection.__enter__()
+    return connection
+
+
+def disconnect(connection):
+    try:
+        connection.__exit__(None, None, None)
+    except (smtplib.SMTPException, OSError):
+        # The connection is already broken
+        pass
+
+
+def drain():
+    """Send every message which is due, reusing the SMTP connection between them
+
+    Returns the number of messages which were sent and which failed.
+    """
+    # Imported here as digest renders its emails using messages
+    from . import digest
+    # Events which weren't handled after they were committed, e.g. as the process died
+    events.deliver_pending()
+    if digest.enabled():
+        digest.send_due_digests()
+
+    n_sent = n_failed = 0
+    connection = None
+    try:
+        for row in iter(claim, None):
+            connected = connection is not None
+            try:
+                message = make_message(row)
+                if connection is None:
+                    connection = connect()
+                connection.send(message)
+            except (smtplib.SMTPException, OSError) as e:
+                n_failed += 1
+                record_failure(row, e)
+                if connection is not None:
+                    disconnect(connection)
+                    connection = None
+                if not connected:
+                    # The server is unavailable so leave the rest for later
+                    break
+            except Exception as e:
+                # Only this message is broken (e.g. an invalid header) so carry on with the others
+                log.exception(f'Failed to send email {row.id}')
+                n_failed += 1
+                record_failure(row, e)
+            else:
+                n_sent += 1
+                with db.engine.begin() as db_connection:
+                    db_connection.execute(
+                        outgoing.update()
+                        .where(outgoing.c.id == row.id)
+                        .values(status='sent', sent=datetime.now(), last_error=None)
+                    )
+    finally:
+        if connection is not None:
+            disconnect(connection)
+
+    if n_sent or n_failed:
+        log.info(f'Sent {n_sent} emails from the outbox, {n_failed} failed')
+        remove_old_emails()
+    return n_sent, n_failed
+
+
+def record_failure(row, error):
+    attempts = row.attempts + 1
+    values = dict(last_error=(str(error) or type(error).__name__)[:1000])
+    if attempts >= app.config['MAIL_MAX_ATTEMPTS']:
+        log.error(f'Giving up sending email {row.id} after {attempts} attempts: {error}')
+        values['status'] = 'failed'
+    else:
+        delay = app.config['MAIL_RETRY_DELAY'] * 2 ** (attempts - 1)
+        log.warning(f'Failed to send email {row.id}, retrying in {delay} seconds: {error}')
+        values['next_attempt'] = datetime.now() + timedelta(seconds=delay)
+    with db.engine.begin() as connection:
+        connection.execute(outgoing.update().where(outgoing.c.id == row.id).values(**values))
+
+
+def remove_old_emails():
+    cutoff = datetime.now() - timedelta(days=app.config['MAIL_OUTBOX_RETENTION_DAYS'])
+    with db.engine.begin() as connection:
+        connection.execute(
+            outgoing.delete().where(and_(outgoing.c.status == 'sent', outgoing.c.sent < cutoff))
+        )
+
+
+def send_emails():
+    """Send the emails in the outbox which are due, for use without MAIL_WORKERS"""
+    with app.app_context():
+        return drain()
+
+
+def queue_stats():
+    """Number of emails in the outbox with each status and of notifications waiting for a digest"""
+    stats = {'pending': 0, 'sent': 0, 'failed': 0}
+    stats.update(db.session.execute(
+        select([outgoing.c.status, func.count()]).group_by(outgoing.c.status)
+    ).fetchall())
+    stats['digest'] = db.session.execute(select([func.count()]).select_from(DigestItem.__table__)).scalar()
+    return stats
@@ -0,0 +1,56 @@
+from collections import OrderedDict
+from threading import Lock
+
+from .talky import app
+
+
+__all__ = [
+    'PageCache',
+    'talk_pages',
+]
+
+
+class PageCache(object):
+    """LRU cache of rendered pages which is limited by the total length of the pages
+
+    Each entry stores a version stamp alongside the page so a lookup with a
+    newer stamp is a miss, and storing the newer page replaces the old one.
+    """
+    def __init__(self, config_key):
+        self.config_key = config_key
+        self._lock = Lock()
+        self._pages = OrderedDict()
+        self._size = 0
+
+    def get(self, key, stamp):
+        with self._lock:
+            cached = self._pages.get(key)
+            if cached is None or cached[0] != stamp:
+                return None
+            self._pages.move_to_end(key)
+            return cached[1]
+
+    def set(self, key, stamp, page):
+        max_size = app.config[self.config_key]
+        with self._lock:
+            self._discard(key)
+            if len(page) > max_size:
+                return
+            self._pages[key] = (stamp, page)
+            self._size += len(page)
+            while self._size > max_size:
+                self._discard(next(iter(self._pages)))
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+            self._size = 0
+
+    def _discard(self, key):
+        cached = self._pages.pop(key, None)
+        if cached is not None:
+            self._size -= len(cached[1])
+
+
+# Rendered talk pages keyed by (talk id, modify) and stamped with (view key, cache version)
+talk_pages = PageCache('TALK_PAGE_CACHE_SIZE')
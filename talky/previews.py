@@ -0,0 +1,148 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+from glob import glob
+import logging as log
+import os
+from os.path import join, isdir, isfile, dirname, basename
+import re
+import shutil
+import subprocess
+import tempfile
+
+from .talky import app
+from .schema import db, Submission
+from . import storage
+
+
+__all__ = [
+    'preview_dir',
+    'count_pages',
+    'schedule_previews',
+    'remove_previews',
+    'rebuild_previews',
+]
+
+
+# Names of the files in a preview directory
+PREVIEW_NAME_RE = re.compile(r'^(thumb|page-[1-9][0-9]*)\.png$')
+
+# The pool and the process it was created in, as uWSGI forks after importing talky
+_pool = (None, None)
+
+
+def get_pool():
+    global _pool
+    if _pool[0] != os.getpid():
+        _pool = (os.getpid(), ThreadPoolExecutor(
+            max_workers=app.config['PREVIEW_WORKERS'], thread_name_prefix='talky-previews'
+        ))
+    return _pool[1]
+
+
+def preview_dir(talk_id, version):
+    """Directory containing the images of a submission, alongside the file itself"""
+    return join(app.config['FILE_PATH'], str(talk_id), str(version), 'previews')
+
+
+def count_pages(output_dir):
+    """Number of pages in the strip of previews in output_dir"""
+    return len(glob(join(output_dir, 'page-*.png')))
+
+
+def schedule_previews(talk_id, version, filename):
+    """Render the previews of a submission in the background"""
+    if not app.config['PREVIEW_WORKERS']:
+        return None
+    return get_pool().submit(
+        render_previews,
+        talk_id,
+        version,
+        storage.submission_path(talk_id, version, filename),
+        preview_dir(talk_id, version),
+        app.config['PREVIEW_COMMAND'],
+        app.config['PREVIEW_PAGES'],
+        storage.upload_dir()
+    )
+
+
+def render_previews(talk_id, version, *args):
+    """Generate the previews and record how many pages they have so the talk page shows them"""
+    n_pages = generate_previews(*args)
+    if n_pages is None:
+        return None
+    with app.app_context():
+        submission = Submission.query.filter_by(talk_id=talk_id, version=version).first()
+        if submission is None:
+            log.info(f'Submission v{version} of talk {talk_id} was removed while rendering previews')
+            return None
+        # Also changes the cache version of the talk so its page is rendered again
+        submission.preview_pages = n_pages
+        db.session.commit()
+    return n_pages
+
+
+def generate_previews(submission_fn, output_dir, command, n_pages, tmp_dir):
+    """Render the first page and a strip of small pages, then move them into output_dir
+
+    Runs without an application context so the configuration is passed in.
+    Returns the number of pages in the strip, or None if rendering failed.
+    """
+    if not isfile(submission_fn):
+        log.warning(f'Unable to render previews of {submission_fn} as it does not exist')
+        return None
+    if shutil.which(command) is None:
+        log.warning(f'{command} is not installed, unable to render previews of {submission_fn}')
+        return None
+
+    os.makedirs(tmp_dir, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=tmp_dir, suffix='.previews')
+    try:
+        subprocess.run(
+            [command, '-png', '-singlefile', '-f', '1', '-scale-to', '320',
+             submission_fn, join(tmp, 'thumb')],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=60
+        )
+        subprocess.run(
+            [command, '-png', '-f', '1', '-l', str(n_pages), '-scale-to', '120',
+             submission_fn, join(tmp, 'page')],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=60
+        )
+        # The page numbers are zero padded depending on the length of the document
+        for fn in glob(join(tmp, 'page-*.png')):
+            page = int(basename(fn)[len('page-'):-len('.png')])
+            os.rename(fn, join(tmp, f'page-{page}.png'))
+        for fn in os.listdir(tmp):
+            os.chmod(join(tmp, fn), 0o644)
+        os.chmod(tmp, 0o755)
+
+        if not isdir(dirname(output_dir)):
+            log.info(f'{submission_fn} was removed while rendering previews')
+            return None
+        # Swap in the new previews so a rebuild never leaves a partial directory
+        if isdir(output_dir):
+            os.rename(output_dir, tmp + '.old')
+        os.rename(tmp, output_dir)
+        shutil.rmtree(tmp + '.old', ignore_errors=True)
+    except (OSError, subprocess.SubprocessError) as e:
+        stderr = getattr(e, 'stderr', None) or b''
+        log.error(f'Failed to render previews of {submission_fn}: {e} {stderr.decode(errors="replace")}')
+        return None
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    log.info(f'Rendered previews of {submission_fn}')
+    return count_pages(output_dir)
+
+
+def remove_previews(talk_id, version):
+    shutil.rmtree(preview_dir(talk_id, version), ignore_errors=True)
+
+
+def rebuild_previews():
+    """Render the previews of every submission, returning the number which succeeded"""
+    with app.app_context():
+        futures = [
+            schedule_previews(s.talk_id, s.version, s.filename)
+            for s in Submission.query.order_by(Submission.id)
+        ]
+    futures = [f for f in futures if f is not None]
+    wait(futures)
+    return sum(f.result() is not None for f in futures)
@@ -0,0 +1,94 @@
+from functools import wraps
+import logging as log
+import sqlite3
+from urllib.parse import quote
+
+from flask import g, _app_ctx_stack
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.event import listens_for
+from sqlalchemy.orm import Session, scoped_session
+from sqlalchemy.pool import QueuePool
+
+from .talky import app
+from .schema import db
+
+
+__all__ = [
+    'session',
+    'read_only',
+    'get_session',
+]
+
+
+class ReadOnlySession(Session):
+    """Session for routes which only read from the database"""
+
+
+@listens_for(ReadOnlySession, 'before_flush')
+def prevent_writes(session, flush_context, instances):
+    raise RuntimeError('Attempted to modify the database using the read-only session')
+
+
+# The URI and engine used by read-only sessions
+_engine = (None, None)
+
+
+def get_engine():
+    """Get the engine used for read-only sessions
+
+    This connects to READ_ONLY_DATABASE_URI if it is set, for example to use a
+    replica. Otherwise SQLite databases are opened a second time in read-only
+    mode and any other database falls back to the primary engine.
+    """
+    global _engine
+    uri = app.config['READ_ONLY_DATABASE_URI'] or app.config['SQLALCHEMY_DATABASE_URI']
+    if _engine[0] == uri:
+        return _engine[1]
+
+    url = make_url(uri)
+    if app.config['READ_ONLY_DATABASE_URI']:
+        log.info(f'Using {url!r} for read-only sessions')
+        engine = create_engine(url)
+    elif url.drivername == 'sqlite' and url.database:
+        path = url.database
+
+        def connect():
+            return sqlite3.connect(f'file:{quote(path)}?mode=ro', uri=True, check_same_thread=False)
+        # The URL is for an in-memory database, which would otherwise keep a connection per thread
+        engine = create_engine('sqlite://', creator=connect, poolclass=QueuePool)
+    else:
+        log.warning('READ_ONLY_DATABASE_URI is not set, read-only sessions will use the primary database')
+        engine = db.engine
+
+    if _engine[1] is not None and _engine[1] is not db.engine:
+        _engine[1].dispose()
+    _engine = (uri, engine)
+    return engine
+
+
+session = scoped_session(
+    lambda: ReadOnlySession(bind=get_engine(), autoflush=False),
+    scopefunc=_app_ctx_stack.__ident_func__
+)
+
+
+@app.teardown_appcontext
+def remove_session(exception=None):
+    session.remove()
+
+
+def read_only(func):
+    """Run a route using the read-only session (see get_session)"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        g.read_only = True
+        return func(*args, **kwargs)
+    return wrapper
+
+
+def get_session():
+    """Get the session to use for the current request"""
+    if g.get('read_only', False):
+        return session
+    return db.session
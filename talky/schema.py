@@ -1,42 +1,62 @@
 # [SublimeLinter flake8-max-line-length:120]
 import secrets
+import sqlite3
 
 from flask_sqlalchemy import SQLAlchemy
 from flask_security import UserMixin, RoleMixin
+from sqlalchemy.engine import Engine
+from sqlalchemy.event import listens_for
 from sqlalchemy.ext.hybrid import hybrid_property
 
 from .talky import app
 
 __all__ = [
     'db', 'Role', 'User', 'Experiment', 'Conference', 'Comment', 'Submission',
-    'Category', 'Talk', 'Contact'
+    'Category', 'Talk', 'Contact', 'OutgoingEmail', 'DigestItem', 'PendingEvent', 'ChangeCounter'
 ]
 
 
 db = SQLAlchemy(app)
 
+
+@listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Apply SQLITE_PRAGMAS to every new SQLite connection"""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        apply_sqlite_pragmas(dbapi_connection, app.config['SQLITE_PRAGMAS'])
+
+
+def apply_sqlite_pragmas(dbapi_connection, pragmas):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+    cursor.close()
+
+
+# Association tables use a composite primary key, which also serves lookups
+# by the first column, and index the second column for the reverse direction
 roles_users = db.Table(
     'roles_users',
-    db.Column('user_id', db.Integer(), db.ForeignKey('user.id')),
-    db.Column('role_id', db.Integer(), db.ForeignKey('role.id'))
+    db.Column('user_id', db.Integer(), db.ForeignKey('user.id'), primary_key=True),
+    db.Column('role_id', db.Integer(), db.ForeignKey('role.id'), primary_key=True, index=True)
 )
 
 categories_contacts = db.Table(
     'categories_contacts',
-    db.Column('contact_id', db.Integer(), db.ForeignKey('contact.id')),
-    db.Column('category_id', db.Integer(), db.ForeignKey('category.id'))
+    db.Column('contact_id', db.Integer(), db.ForeignKey('contact.id'), primary_key=True),
+    db.Column('category_id', db.Integer(), db.ForeignKey('category.id'), primary_key=True, index=True)
 )
 
 interesting_talks_experiment = db.Table(
     'interesting_talks_experiment',
-    db.Column('experiment_id', db.Integer(), db.ForeignKey('experiment.id')),
-    db.Column('talk_id', db.Integer(), db.ForeignKey('talk.id')),
+    db.Column('experiment_id', db.Integer(), db.ForeignKey('experiment.id'), primary_key=True),
+    db.Column('talk_id', db.Integer(), db.ForeignKey('talk.id'), primary_key=True, index=True),
 )
 
 talk_categories = db.Table(
     'talk_categories',
-    db.Column('category_id', db.Integer(), db.ForeignKey('category.id')),
-    db.Column('talk_id', db.Integer(), db.ForeignKey('talk.id')),
+    db.Column('category_id', db.Integer(), db.ForeignKey('category.id'), primary_key=True),
+    db.Column('talk_id', db.Integer(), db.ForeignKey('talk.id'), primary_key=True, index=True),
 )
 
 
@@ -62,7 +82,8 @@ class User(db.Model, UserMixin):
     confirmed_at = db.Column(db.DateTime())
     roles = db.relationship('Role', secondary=roles_users, backref=db.backref('users'))
 
-    experiment_id = db.Column(db.Integer, db.ForeignKey('experiment.id', ondelete='CASCADE'), nullable=False)
+    experiment_id = db.Column(db.Integer, db.ForeignKey('experiment.id', ondelete='CASCADE'), nullable=False,
+                              index=True)
     experiment = db.relationship('Experiment', backref=db.backref('users', cascade='all, delete-orphan'))
 
     def __str__(self):
@@ -86,14 +107,20 @@ class Conference(db.Model):
     name = db.Column(db.String(200), nullable=False)
     url = db.Column(db.String(1000))
     venue = db.Column(db.String(200), nullable=False)
-    start_date = db.Column(db.DateTime(), nullable=False)
+    start_date = db.Column(db.DateTime(), nullable=False, index=True)
 
     def __str__(self):
         return self.name
 
 
 class Comment(db.Model):
-    __table_args__ = {'sqlite_autoincrement': True}
+    __table_args__ = (
+        # Comments are always listed per talk in chronological order
+        db.Index('ix_comment_talk_id_time', 'talk_id', 'time'),
+        # Threads and subtrees are fetched as a range of paths
+        db.Index('ix_comment_talk_id_path', 'talk_id', 'path'),
+        {'sqlite_autoincrement': True}
+    )
 
     id = db.Column(db.Integer(), primary_key=True)
     name = db.Column(db.String(80), nullable=False)
@@ -104,18 +131,42 @@ class Comment(db.Model):
     talk_id = db.Column(db.Integer, db.ForeignKey('talk.id', ondelete='CASCADE'), nullable=False)
     talk = db.relationship('Talk', backref=db.backref('comments', cascade='all, delete-orphan'))
 
-    submission_id = db.Column(db.Integer, db.ForeignKey('submission.id'), nullable=True)
+    submission_id = db.Column(db.Integer, db.ForeignKey('submission.id'), nullable=True, index=True)
     submission = db.relationship('Submission', backref=db.backref('comments'))
 
-    parent_comment_id = db.Column(db.Integer, db.ForeignKey('comment.id', ondelete='CASCADE'), nullable=True)
-    children = db.relationship('Comment', cascade='all', backref=db.backref('parent', remote_side=[id]))
+    parent_comment_id = db.Column(db.Integer, db.ForeignKey('comment.id', ondelete='CASCADE'), nullable=True,
+                                  index=True)
+    # Replies are deleted in SQL by database_events.delete_replies
+    children = db.relationship('Comment', cascade='all', passive_deletes=True,
+                               backref=db.backref('parent', remote_side=[id]))
+
+    # Materialized path of the ids from the top level comment, e.g.
+    # "0000000001/0000000004/", which is set by database_events.set_comment_path
+    path = db.Column(db.String(1000), nullable=False, default='')
+    depth = db.Column(db.Integer(), nullable=False, default=0)
+
+    @staticmethod
+    def path_segment(comment_id):
+        return f'{comment_id:010d}/'
+
+    @classmethod
+    def subtree_filter(cls, talk_id, path):
+        """Filter for the comment with the given path and all of its replies"""
+        # All paths starting with "…/" sort between "…/" and "…0"
+        return db.and_(cls.talk_id == talk_id, cls.path >= path, cls.path < path[:-1] + '0')
 
     def __str__(self):
         return 'TODO'
 
 
 class Submission(db.Model):
-    __table_args__ = {'sqlite_autoincrement': True}
+    __table_args__ = (
+        # Each version number can only be used once per talk
+        db.Index('ix_submission_talk_id_version', 'talk_id', 'version', unique=True),
+        # Used to find the latest submission of a talk
+        db.Index('ix_submission_talk_id_time', 'talk_id', 'time'),
+        {'sqlite_autoincrement': True}
+    )
 
     id = db.Column(db.Integer(), primary_key=True)
     time = db.Column(db.DateTime())
@@ -124,6 +175,11 @@ class Submission(db.Model):
 
     version = db.Column(db.Integer(), nullable=False)
     filename = db.Column(db.String(200), nullable=False)
+    # Calculated while the file is uploaded, also the key in the blob store
+    sha256 = db.Column(db.String(64), nullable=True, index=True)
+    size = db.Column(db.Integer(), nullable=True)
+    # Number of pages in the strip of previews, None until they are rendered
+    preview_pages = db.Column(db.Integer(), nullable=True)
 
     def __str__(self):
         return 'TODO'
@@ -135,7 +191,8 @@ class Category(db.Model):
     id = db.Column(db.Integer(), primary_key=True)
     name = db.Column(db.String(80), nullable=False)
 
-    experiment_id = db.Column(db.Integer, db.ForeignKey('experiment.id', ondelete='CASCADE'), nullable=False)
+    experiment_id = db.Column(db.Integer, db.ForeignKey('experiment.id', ondelete='CASCADE'), nullable=False,
+                              index=True)
     experiment = db.relationship('Experiment', backref=db.backref('categories', cascade='all, delete-orphan'))
 
     contacts = db.relationship('Contact', secondary=categories_contacts, backref=db.backref('categories'))
@@ -154,12 +211,24 @@ class Talk(db.Model):
     speaker = db.Column(db.String(200), nullable=False)
     n_submissions = db.Column(db.Integer(), nullable=False, default=int)
 
-    experiment_id = db.Column(db.Integer, db.ForeignKey('experiment.id', ondelete='CASCADE'), nullable=False)
+    experiment_id = db.Column(db.Integer, db.ForeignKey('experiment.id', ondelete='CASCADE'), nullable=False,
+                              index=True)
     experiment = db.relationship('Experiment', backref=db.backref('talks', cascade='all, delete-orphan'))
 
-    conference_id = db.Column(db.Integer, db.ForeignKey('conference.id', ondelete='CASCADE'), nullable=False)
+    conference_id = db.Column(db.Integer, db.ForeignKey('conference.id', ondelete='CASCADE'), nullable=False,
+                              index=True)
     conference = db.relationship('Conference', backref=db.backref('talks', cascade='all, delete-orphan'))
 
+    # Denormalized activity summary which is maintained by database_events
+    comment_count = db.Column(db.Integer(), nullable=False, default=0)
+    latest_submission_id = db.Column(db.Integer(), nullable=True)
+    latest_submission = db.relationship(
+        'Submission', primaryjoin='foreign(Talk.latest_submission_id) == Submission.id', viewonly=True
+    )
+    last_activity = db.Column(db.DateTime(), nullable=True, index=True)
+    # Incremented whenever the talk page changes, used to invalidate cached pages
+    cache_version = db.Column(db.Integer(), nullable=False, default=0)
+
     @hybrid_property
     def conference_date(self):
         return self.conference.start_date
@@ -187,8 +256,86 @@ class Contact(db.Model):
     id = db.Column(db.Integer(), primary_key=True)
     email = db.Column(db.String(200), nullable=False)
 
-    experiment_id = db.Column(db.Integer, db.ForeignKey('experiment.id', ondelete='CASCADE'), nullable=False)
+    experiment_id = db.Column(db.Integer, db.ForeignKey('experiment.id', ondelete='CASCADE'), nullable=False,
+                              index=True)
     experiment = db.relationship('Experiment', backref=db.backref('contacts', cascade='all, delete-orphan'))
 
     def __str__(self):
         return self.email
+
+
+class OutgoingEmail(db.Model):
+    """Notification which is sent in the background, see outbox.py"""
+    __table_args__ = (
+        # Used to find the messages which are due to be sent
+        db.Index('ix_outgoing_email_status_next_attempt', 'status', 'next_attempt'),
+        {'sqlite_autoincrement': True}
+    )
+
+    id = db.Column(db.Integer(), primary_key=True)
+    subject = db.Column(db.String(1000), nullable=False)
+    html = db.Column(db.Text(), nullable=False)
+    # Newline separated lists of addresses
+    recipients = db.Column(db.Text(), nullable=False, default='')
+    bcc = db.Column(db.Text(), nullable=False, default='')
+
+    # One of "pending", "sent" or "failed"
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    created = db.Column(db.DateTime(), nullable=False)
+    # Also used as a lease while the message is being sent
+    next_attempt = db.Column(db.DateTime(), nullable=False)
+    attempts = db.Column(db.Integer(), nullable=False, default=0)
+    sent = db.Column(db.DateTime(), nullable=True)
+    last_error = db.Column(db.String(1000), nullable=True)
+
+    def __str__(self):
+        return self.subject
+
+
+class DigestItem(db.Model):
+    """Notification waiting to be sent as part of a digest, see digest.py"""
+    __table_args__ = (
+        # Items are collected per recipient in chronological order
+        db.Index('ix_digest_item_recipient_created', 'recipient', 'created'),
+        {'sqlite_autoincrement': True}
+    )
+
+    id = db.Column(db.Integer(), primary_key=True)
+    recipient = db.Column(db.String(200), nullable=False)
+    subject = db.Column(db.String(1000), nullable=False)
+    url = db.Column(db.String(1000), nullable=False)
+    summary = db.Column(db.String(1000), nullable=False, default='')
+    created = db.Column(db.DateTime(), nullable=False, index=True)
+
+    def __str__(self):
+        return self.subject
+
+
+class PendingEvent(db.Model):
+    """Event recorded by a transaction which hasn't been handled by its subscribers yet, see events.py"""
+    __table_args__ = (
+        {'sqlite_autoincrement': True},
+    )
+
+    id = db.Column(db.Integer(), primary_key=True)
+    # Name of the event type and JSON list of its fields
+    type = db.Column(db.String(80), nullable=False)
+    payload = db.Column(db.String(1000), nullable=False)
+    created = db.Column(db.DateTime(), nullable=False)
+    # Also used as a lease while the event is being handled
+    next_attempt = db.Column(db.DateTime(), nullable=False, index=True)
+    attempts = db.Column(db.Integer(), nullable=False, default=0)
+
+    def __str__(self):
+        return f'{self.type}{self.payload}'
+
+
+class ChangeCounter(db.Model):
+    """Single row which is incremented by every flush which modifies the database, see count_cache.py"""
+    id = db.Column(db.Integer(), primary_key=True)
+    value = db.Column(db.Integer(), nullable=False, default=0)
+
+
+@listens_for(ChangeCounter.__table__, 'after_create')
+def create_change_counter(table, connection, **kwargs):
+    connection.execute(table.insert().values(id=1, value=0))
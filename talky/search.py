@@ -0,0 +1,105 @@
+import re
+
+from sqlalchemy import Float, Integer, column, inspect, table, text
+from sqlalchemy.event import listens_for
+
+from .talky import app
+from .schema import db, Comment
+
+
+__all__ = [
+    'talk_matches',
+    'rebuild_index',
+]
+
+
+# FTS5 indexes of talks and comments where the rowid is the id of the talk or comment
+talk_search = table('talk_search', column('rowid'), column('title'), column('abstract'), column('speaker'))
+comment_search = table('comment_search', column('rowid'), column('name'), column('comment'))
+
+
+@listens_for(db.metadata, 'after_create')
+def create_index(target, connection, **kwargs):
+    for index in [talk_search, comment_search]:
+        columns = ', '.join(c.name for c in index.columns if c.name != 'rowid')
+        connection.execute(f'CREATE VIRTUAL TABLE IF NOT EXISTS {index.name} USING fts5({columns})')
+
+
+@listens_for(db.metadata, 'after_drop')
+def drop_index(target, connection, **kwargs):
+    for index in [talk_search, comment_search]:
+        connection.execute(f'DROP TABLE IF EXISTS {index.name}')
+
+
+def index_exists(connection):
+    return talk_search.name in inspect(connection).get_table_names()
+
+
+def index_talk(connection, talk):
+    unindex_talk(connection, talk.id)
+    connection.execute(talk_search.insert().values(
+        rowid=talk.id, title=talk.title, abstract=talk.abstract or '', speaker=talk.speaker
+    ))
+
+
+def unindex_talk(connection, talk_id):
+    connection.execute(talk_search.delete().where(talk_search.c.rowid == talk_id))
+
+
+def index_comment(connection, comment):
+    unindex_comment(connection, comment.id)
+    connection.execute(comment_search.insert().values(
+        rowid=comment.id, name=comment.name, comment=comment.comment
+    ))
+
+
+def unindex_comment(connection, comment_id):
+    connection.execute(comment_search.delete().where(comment_search.c.rowid == comment_id))
+
+
+def unindex_replies(connection, talk_id, path):
+    comments = Comment.__table__
+    connection.execute(comment_search.delete().where(comment_search.c.rowid.in_(
+        db.select([comments.c.id]).where(Comment.subtree_filter(talk_id, path))
+    )))
+
+
+def fts_query(search):
+    """Convert a search from the user into an FTS5 query matching every term as a prefix"""
+    return ' '.join(f'"{term}"*' for term in re.findall(r'\w+', search))
+
+
+def talk_matches(search):
+    """Selectable of (talk_id, rank) for the talks matching a search
+
+    Talks match if their title, abstract, speaker or any of their comments
+    contain every term. Better matches have a lower rank, with titles weighted
+    above abstracts and speakers and matches in comments counting for half.
+    """
+    return text(
+        'SELECT talk_id, min(rank) AS rank FROM ('
+        '  SELECT rowid AS talk_id, bm25(talk_search, 10.0, 2.0, 1.0) AS rank'
+        '  FROM talk_search WHERE talk_search MATCH :query'
+        '  UNION ALL'
+        '  SELECT comment.talk_id AS talk_id, 0.5 * bm25(comment_search) AS rank'
+        '  FROM comment_search JOIN comment ON comment.id = comment_search.rowid'
+        '  WHERE comment_search MATCH :query'
+        ') GROUP BY talk_id'
+    ).bindparams(query=fts_query(search)).columns(talk_id=Integer, rank=Float).alias('talk_matches')
+
+
+def rebuild_index():
+    """Recreate the full-text indexes from the talk and comment tables"""
+    with app.app_context():
+        with db.engine.begin() as connection:
+            create_index(db.metadata, connection)
+            connection.execute(talk_search.delete())
+            connection.execute(
+                'INSERT INTO talk_search (rowid, title, abstract, speaker) '
+                "SELECT id, title, coalesce(abstract, ''), speaker FROM talk"
+            )
+            connection.execute(comment_search.delete())
+            connection.execute(
+                'INSERT INTO comment_search (rowid, name, comment) '
+                'SELECT id, name, comment FROM comment'
+            )
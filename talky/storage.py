@@ -0,0 +1,205 @@
+import hashlib
+import logging as log
+import os
+from os.path import join, isdir, isfile, dirname, samefile
+import secrets
+import shutil
+import tempfile
+
+from flask import Request
+from sqlalchemy import select
+
+from .talky import app
+from .schema import db, Talk, Submission
+
+
+__all__ = [
+    'UploadFile',
+    'UploadRequest',
+    'allocate_version',
+    'store_upload',
+    'dedupe_files',
+]
+
+
+def upload_dir():
+    """Directory for uploads in progress, on the same filesystem as FILE_PATH"""
+    return join(app.config['FILE_PATH'], '.uploads')
+
+
+class UploadFile(object):
+    """Temporary file which calculates the size and SHA-256 of an upload as it is written"""
+    def __init__(self):
+        os.makedirs(upload_dir(), exist_ok=True)
+        fd, self.name = tempfile.mkstemp(dir=upload_dir(), suffix='.part')
+        self._file = os.fdopen(fd, 'w+b')
+        self._hash = hashlib.sha256()
+        self.size = 0
+        self.moved = False
+
+    def write(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    @property
+    def sha256(self):
+        return self._hash.hexdigest()
+
+    def move(self, path):
+        """Atomically rename the completed upload to its final location"""
+        os.makedirs(dirname(path), exist_ok=True)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        # mkstemp only makes the file readable by the owner
+        os.chmod(self.name, 0o644)
+        os.rename(self.name, path)
+        self.moved = True
+
+    def discard(self):
+        """Remove the file unless it has been moved into place"""
+        self._file.close()
+        if not self.moved:
+            try:
+                os.remove(self.name)
+            except FileNotFoundError:
+                pass
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class UploadRequest(Request):
+    """Request which streams uploaded files to UploadFiles instead of buffering them
+
+    Any uploads which haven't been moved into place are removed when the
+    request is closed, including when the client disconnects mid-upload.
+    """
+    def __init__(self, *args, **kwargs):
+        super(UploadRequest, self).__init__(*args, **kwargs)
+        self.uploads = []
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        upload = UploadFile()
+        self.uploads.append(upload)
+        return upload
+
+    def close(self):
+        super(UploadRequest, self).close()
+        for upload in self.uploads:
+            upload.discard()
+
+
+app.request_class = UploadRequest
+
+
+def allocate_version(talk):
+    """Reserve the next version number of a talk
+
+    The increment is a single UPDATE so concurrent uploads can't be given the
+    same version, and the talk stays locked until the transaction is committed.
+    """
+    talks = Talk.__table__
+    while True:
+        db.session.execute(
+            talks.update()
+            .where(talks.c.id == talk.id)
+            .values(n_submissions=talks.c.n_submissions + 1)
+        )
+        version = db.session.execute(
+            select([talks.c.n_submissions]).where(talks.c.id == talk.id)
+        ).scalar()
+        if not isdir(join(app.config['FILE_PATH'], str(talk.id), str(version))):
+            break
+        # Files of deleted submissions are kept if CLEANUP_FILES is False
+        log.warning(f'Submission directory for v{version} of talk {talk.id} already exists, skipping')
+    db.session.expire(talk, ['n_submissions'])
+    return version
+
+
+def blob_path(sha256):
+    """Location of a file in the content-addressed blob store"""
+    return join(app.config['FILE_PATH'], 'blobs', sha256[:2], sha256)
+
+
+def submission_path(talk_id, version, filename):
+    return join(app.config['FILE_PATH'], str(talk_id), str(version), filename)
+
+
+def link(src, dst):
+    """Atomically replace dst with a hardlink to src"""
+    os.makedirs(dirname(dst), exist_ok=True)
+    tmp = f'{dst}.{secrets.token_hex(8)}.tmp'
+    try:
+        os.link(src, tmp)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        log.warning(f'Failed to hardlink {src}, copying instead')
+        shutil.copyfile(src, tmp)
+        os.chmod(tmp, 0o644)
+    os.rename(tmp, dst)
+
+
+def store_upload(upload, path):
+    """Add an upload to the blob store, unless it is already present, and link it to path"""
+    blob = blob_path(upload.sha256)
+    if isfile(blob):
+        try:
+            link(blob, path)
+        except FileNotFoundError:
+            # Removed since checking for it, e.g. as the last submission using it was deleted
+            log.warning(f'Blob {upload.sha256} was removed while reusing it for {path}, storing it again')
+        else:
+            log.info(f'Reusing existing blob {upload.sha256} for {path}')
+            upload.discard()
+            return
+    upload.move(blob)
+    link(blob, path)
+
+
+def remove_blob(sha256):
+    try:
+        os.remove(blob_path(sha256))
+    except OSError:
+        # We don't care if wasn't deleted because it does not exist
+        pass
+
+
+def hash_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def dedupe_files():
+    """Move existing submission files into the blob store, replacing duplicates with hardlinks
+
+    Returns the number of files processed and the number of bytes reclaimed.
+    """
+    n_files = n_bytes = 0
+    with app.app_context():
+        for submission in Submission.query.order_by(Submission.id):
+            path = submission_path(submission.talk_id, submission.version, submission.filename)
+            if not isfile(path):
+                log.warning(f'Missing file for submission {submission.id}: {path}')
+                continue
+            if submission.sha256 is None:
+                submission.sha256 = hash_file(path)
+                submission.size = os.path.getsize(path)
+
+            blob = blob_path(submission.sha256)
+            if not isfile(blob):
+                link(path, blob)
+            elif not samefile(path, blob):
+                # Only the last link to a file frees space when it is replaced
+                if os.stat(path).st_nlink == 1:
+                    n_bytes += os.path.getsize(path)
+                link(blob, path)
+            n_files += 1
+        db.session.commit()
+    log.info(f'Deduplicated {n_files} submission files, reclaiming {n_bytes} bytes')
+    return n_files, n_bytes
@@ -0,0 +1,74 @@
+import logging as log
+import os
+import tempfile
+import time
+
+from jinja2 import FileSystemBytecodeCache, TemplateError
+
+from .talky import app
+
+
+__all__ = [
+    'setup_bytecode_cache',
+    'precompile',
+]
+
+
+class AtomicBytecodeCache(FileSystemBytecodeCache):
+    """Bytecode cache which can be shared by several processes
+
+    Jinja writes cache files in place so other workers could read a partially
+    written file, instead write to a temporary file and rename it into place.
+    """
+    def dump_bytecode(self, bucket):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                bucket.write_bytecode(f)
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, self._get_cache_filename(bucket))
+        except OSError:
+            log.warning(f'Failed to write template bytecode to {self.directory}')
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+
+def get_environments():
+    # Imported here as messages uses setup_bytecode_cache for its environment
+    from .messages import env
+    return [app.jinja_env, env]
+
+
+def setup_bytecode_cache():
+    """Use TEMPLATE_CACHE_DIR to store compiled templates of the app and emails"""
+    cache = None
+    if app.config['TEMPLATE_CACHE_DIR']:
+        os.makedirs(app.config['TEMPLATE_CACHE_DIR'], exist_ok=True)
+        cache = AtomicBytecodeCache(app.config['TEMPLATE_CACHE_DIR'])
+    for env in get_environments():
+        env.bytecode_cache = cache
+        # Templates already loaded with a different cache are recompiled
+        if env.cache is not None:
+            env.cache.clear()
+
+
+def precompile():
+    """Compile every template so the first requests of a worker don't have to
+
+    Returns the number of templates which were loaded.
+    """
+    start = time.perf_counter()
+    n_templates = 0
+    for env in get_environments():
+        for name in sorted(set(env.list_templates())):
+            try:
+                env.get_template(name)
+            except TemplateError as e:
+                # Some templates from extensions are only used with other settings
+                log.debug(f'Skipped precompiling {name}: {e}')
+            else:
+                n_templates += 1
+    log.info(f'Precompiled {n_templates} templates in {time.perf_counter() - start:.2f} seconds')
+    return n_templates
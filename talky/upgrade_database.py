@@ -0,0 +1,132 @@
+import logging as log
+from os.path import isdir
+
+from sqlalchemy import inspect, literal
+
+from .talky import app
+from .schema import (
+    db, roles_users, categories_contacts, interesting_talks_experiment, talk_categories, Comment, Submission
+)
+from .database_events import repair_talk_counters
+from . import previews
+from . import search
+
+
+__all__ = [
+    'upgrade_db',
+    'repair_counters',
+]
+
+
+def upgrade_db():
+    """Bring an existing database up to date with the current schema."""
+    with app.app_context():
+        with db.engine.connect() as connection:
+            missing_search_index = not search.index_exists(connection)
+
+        # Create any tables which don't exist yet
+        db.create_all()
+
+        with db.engine.begin() as connection:
+            for table in [roles_users, categories_contacts, interesting_talks_experiment, talk_categories]:
+                add_primary_key(connection, table)
+            for table in db.metadata.sorted_tables:
+                add_missing_columns(connection, table)
+                create_missing_indexes(connection, table)
+            set_comment_paths(connection)
+            set_preview_pages(connection)
+            repair_talk_counters(connection)
+
+    if missing_search_index:
+        log.info('Building the full-text search index')
+        search.rebuild_index()
+
+
+def repair_counters():
+    """Recompute the denormalized activity summary of every talk"""
+    with app.app_context():
+        with db.engine.begin() as connection:
+            repair_talk_counters(connection)
+
+
+def add_primary_key(connection, table):
+    """Rebuild association tables which were created without a primary key
+
+    SQLite can't add a primary key to an existing table so the rows are copied
+    into a new table, dropping any duplicated or incomplete rows.
+    """
+    if inspect(connection).get_pk_constraint(table.name)['constrained_columns']:
+        return
+
+    log.info(f'Rebuilding {table.name} with a composite primary key')
+    old_name = f'{table.name}_old'
+    columns = ', '.join(c.name for c in table.columns)
+    not_null = ' AND '.join(f'{c.name} IS NOT NULL' for c in table.columns)
+    connection.execute(f'ALTER TABLE {table.name} RENAME TO {old_name}')
+    table.create(connection)
+    connection.execute(
+        f'INSERT OR IGNORE INTO {table.name} ({columns}) '
+        f'SELECT {columns} FROM {old_name} WHERE {not_null}'
+    )
+    connection.execute(f'DROP TABLE {old_name}')
+
+
+def add_missing_columns(connection, table):
+    existing = {column['name'] for column in inspect(connection).get_columns(table.name)}
+    for column in table.columns:
+        if column.name not in existing:
+            log.info(f'Adding column {column.name} to {table.name}')
+            definition = f'{column.name} {column.type.compile(connection.dialect)}'
+            if column.default is not None and column.default.is_scalar:
+                # Existing rows are given the default rather than NULL
+                value = literal(column.default.arg).compile(
+                    dialect=connection.dialect, compile_kwargs={'literal_binds': True}
+                )
+                definition += f'{"" if column.nullable else " NOT NULL"} DEFAULT {value}'
+            connection.execute(f'ALTER TABLE {table.name} ADD COLUMN {definition}')
+
+
+def set_comment_paths(connection):
+    """Fill in the materialized path and depth of comments created before they existed"""
+    comments = Comment.__table__
+    paths = {}
+    rows = connection.execute(
+        db.select([comments.c.id, comments.c.parent_comment_id, comments.c.path, comments.c.depth])
+        .order_by(comments.c.id)
+    ).fetchall()
+    for comment_id, parent_comment_id, old_path, old_depth in rows:
+        # Replies always have a larger id than their parent
+        path = old_path or paths.get(parent_comment_id, '') + Comment.path_segment(comment_id)
+        depth = path.count('/') - 1
+        if (path, depth) != (old_path, old_depth):
+            connection.execute(
+                comments.update()
+                .where(comments.c.id == comment_id)
+                .values(path=path, depth=depth)
+            )
+        paths[comment_id] = path
+
+
+def set_preview_pages(connection):
+    """Record the number of pages of previews rendered before it was stored"""
+    submissions = Submission.__table__
+    rows = connection.execute(
+        db.select([submissions.c.id, submissions.c.talk_id, submissions.c.version])
+        .where(submissions.c.preview_pages.is_(None))
+    ).fetchall()
+    for submission_id, talk_id, version in rows:
+        output_dir = previews.preview_dir(talk_id, version)
+        if isdir(output_dir):
+            connection.execute(
+                submissions.update()
+                .where(submissions.c.id == submission_id)
+                .values(preview_pages=previews.count_pages(output_dir))
+            )
+
+
+def create_missing_indexes(connection, table):
+    existing = {index['name'] for index in inspect(connection).get_indexes(table.name)}
+    for index in table.indexes:
+        if index.name not in existing:
+            log.info(f'Creating index {index.name} on {table.name}')
+            index.create(connection)
@@ -0,0 +1,34 @@
+"""Entry point for uWSGI which compiles every template before serving requests
+
+Without --lazy-apps uWSGI imports this once in the master process so workers,
+including those started when a worker is recycled, inherit the templates.
+"""
+from . import app
+from .schema import db
+from .template_cache import precompile
+from .outbox import wake
+
+try:
+    import uwsgi
+    from uwsgidecorators import postfork
+except ImportError:
+    # Not running under uWSGI
+    uwsgi = None
+
+__all__ = ['app']
+
+
+def start_worker():
+    """Prepare a process which serves requests"""
+    # Connections can't be shared with the process this was forked from
+    db.engine.dispose()
+    # Send any emails which were left in the outbox when talky was last stopped
+    wake()
+
+
+precompile()
+if uwsgi is not None and uwsgi.worker_id() == 0:
+    # This is the master process, which doesn't serve requests, so start each worker after it forks
+    postfork(start_worker)
+else:
+    start_worker()